@@ -0,0 +1,75 @@
+# Author: Md Fahim Hasan
+# Email: Fahim.Hasan@colostate.edu
+
+import timeit
+import numpy as np
+from Raster_operations import normalized_convolution, gaussian_kernel
+
+
+def make_benchmark_raster(resolution=0.02, nan_fraction=0.3, seed=0):
+    """
+    Create a synthetic global raster (float32) with land-like nan regions for benchmarking.
+
+    Parameters:
+    resolution : Pixel size in degree. Defaults to 0.02 (the model grid, 9000 x 18000 pixels).
+    nan_fraction : Approximate fraction of nan (ocean) pixels. Defaults to 0.3.
+    seed : Random seed. Defaults to 0.
+
+    Returns : Raster array.
+    """
+    nrows, ncols = int(round(180 / resolution)), int(round(360 / resolution))
+    rng = np.random.default_rng(seed)
+    raster_arr = rng.gamma(2, 50, size=(nrows, ncols)).astype(np.float32)
+
+    # coarse random mask upsampled to the grid, so nan pixels come in contiguous patches
+    coarse_mask = rng.random((nrows // 100 + 1, ncols // 100 + 1)) < nan_fraction
+    raster_arr[np.repeat(np.repeat(coarse_mask, 100, axis=0), 100, axis=1)[:nrows, :ncols]] = np.nan
+
+    return raster_arr
+
+
+def benchmark_gaussian_filter(sigmas=range(1, 21), resolution=0.02, methods=('direct', 'fft'), max_direct_sigma=20,
+                              fft_min_kernel_size=11, block_rows=256, max_workers=4):
+    """
+    Benchmark normalized_convolution() with the Gaussian kernels of apply_gaussian_filter() on a global grid, for
+    direct and FFT convolution over a range of sigma. Prints the run time of each method, the method 'auto' picks and
+    the largest difference between the methods.
+
+    Parameters:
+    sigmas : Sigma values to benchmark. Defaults to 1-20.
+    resolution : Pixel size of the global grid in degree. Defaults to 0.02.
+    methods : Convolution methods to time. Defaults to ('direct', 'fft').
+    max_direct_sigma : Largest sigma timed with direct convolution (its cost grows with kernel area). Defaults to 20.
+    fft_min_kernel_size : Kernel width from which 'auto' switches to FFT convolution. Defaults to 11.
+    block_rows : Number of rows convolved in each block. Defaults to 256.
+    max_workers : Number of threads. Defaults to 4.
+
+    Returns : Dictionary of {(sigma, method): run time in seconds}.
+    """
+    raster_arr = make_benchmark_raster(resolution=resolution)
+    print('Benchmark raster:', raster_arr.shape, 'pixels')
+
+    runtimes = {}
+    for sigma in sigmas:
+        kernel = gaussian_kernel(sigma)
+        auto_method = 'fft' if kernel.shape[0] >= fft_min_kernel_size else 'direct'
+        convolved = {}
+        for method in methods:
+            if method == 'direct' and sigma > max_direct_sigma:
+                continue
+            start = timeit.default_timer()
+            convolved[method] = normalized_convolution(raster_arr, kernel, block_rows=block_rows,
+                                                       max_workers=max_workers, method=method,
+                                                       fft_min_kernel_size=fft_min_kernel_size)
+            runtimes[(sigma, method)] = timeit.default_timer() - start
+
+        max_diff = np.nanmax(np.abs(convolved['direct'] - convolved['fft'])) if len(convolved) == 2 else np.nan
+        timings = ', '.join('{}: {:.1f} s'.format(method, runtimes[(sigma, method)]) for method in convolved)
+        print('sigma {:2d} (kernel {}x{}, auto -> {}) {} | max difference {:.2e}'.format(
+            sigma, kernel.shape[0], kernel.shape[1], auto_method, timings, max_diff))
+
+    return runtimes
+
+
+if __name__ == '__main__':
+    benchmark_gaussian_filter()
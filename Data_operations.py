@@ -1,21 +1,38 @@
 # Author: Md Fahim Hasan
 # Email: Fahim.Hasan@colostate.edu
 
+import os
 import ee
 import pickle
-import shutil
 import zipfile
+import json
+import asyncio
+import time
+import hashlib
+import threading
 import requests
+import numpy as np
+import pandas as pd
+import rasterio as rio
+import geopandas as gpd
+from glob import glob
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from Raster_operations import *
 from PCA import *
 from datetime import datetime
-from Training_InSAR_processing import process_primary_insar_data, rasterize_coastal_subsidence
+from Training_InSAR_processing import process_primary_insar_data, rasterize_coastal_subsidence, \
+    classify_subsidence_arr, subsidence_class_nodata
 
 No_Data_Value = -9999
 
 referenceraster = '../Data/Reference_rasters_shapes/Global_continents_ref_raster.tif'
 
 csv = '../Data/Reference_rasters_shapes/GEE_Download_coords_modified.csv'
+
+# getDownloadURL limits of Google Earth Engine
+GEE_max_request_bytes = 33554432  # 32 MB
+GEE_max_grid_dimension = 10000  # pixels
 os.chdir('../Codes_Global_GW')
 
 
@@ -39,14 +56,464 @@ def extract_data(zip_dir, out_dir, searchby="*.zip", rename_file=True):
     print('Extracting zip files.....')
     makedirs([out_dir])
     for zip_file in glob(os.path.join(zip_dir, searchby)):
-        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-            if rename_file:
-                zip_key = zip_file[zip_file.rfind(os.sep) + 1:zip_file.rfind(".")]
-                zip_info = zip_ref.infolist()[0]
-                zip_info.filename = zip_key + '.tif'
-                zip_ref.extract(zip_info, path=out_dir)
+        extract_zip_file(zip_file, out_dir, rename_file=rename_file)
+
+
+def extract_zip_file(zip_file, out_dir, rename_file=True):
+    """
+    Extract a single zip file.
+
+    Parameters:
+    zip_file : Zip filepath.
+    out_dir : File Location where data will be extracted.
+    rename_file : True if the (first) file should be extracted as <zip name>.tif.
+
+    Returns : Extracted filepath (if rename_file is True).
+    """
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        if rename_file:
+            zip_key = zip_file[zip_file.rfind(os.sep) + 1:zip_file.rfind(".")]
+            zip_info = zip_ref.infolist()[0]
+            zip_info.filename = zip_key + '.tif'
+            zip_ref.extract(zip_info, path=out_dir)
+            return os.path.join(out_dir, zip_info.filename)
+        else:
+            zip_ref.extractall(path=out_dir)
+
+
+# # Download engine shared by all GEE/URL downloads
+def make_download_session(pool_size=8):
+    """
+    Create a requests session with a connection pool, so that all tiles of a download reuse the same connections.
+
+    Parameters:
+    pool_size : Maximum number of pooled connections per host. Should be >= number of download threads.
+
+    Returns : requests.Session object.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+def download_file(url, local_file, session=None, max_retries=5, backoff=2, timeout=(30, 600),
+                  chunk_size=1024 * 1024):
+    """
+    Stream download a file from url in chunks. The file is written as local_file + '.part' and renamed at the end, so
+    an interrupted download never leaves a truncated file. Connection errors, timeouts and 429/5xx responses are
+    retried with exponential backoff.
+
+    Parameters:
+    url : Download url.
+    local_file : Filepath to save the download.
+    session : requests.Session to download with. Defaults to None (a new connection is made).
+    max_retries : Number of retries before giving up. Defaults to 5.
+    backoff : Wait (backoff ** attempt) seconds before each retry. Defaults to 2.
+    timeout : (connect, read) timeout in seconds. Defaults to (30, 600).
+    chunk_size : Bytes written in each chunk. Defaults to 1 MB.
+
+    Returns : Size of downloaded file in bytes and sha256 checksum of the file.
+    """
+    session = session if session is not None else requests
+    part_file = local_file + '.part'
+
+    for attempt in range(max_retries + 1):
+        try:
+            with session.get(url, stream=True, timeout=timeout, allow_redirects=True) as r:
+                r.raise_for_status()
+                size, checksum = 0, hashlib.sha256()
+                with open(part_file, 'wb') as file:
+                    for chunk in r.iter_content(chunk_size=chunk_size):
+                        file.write(chunk)
+                        checksum.update(chunk)
+                        size += len(chunk)
+            os.replace(part_file, local_file)
+            return size, checksum.hexdigest()
+
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError,
+                requests.exceptions.ChunkedEncodingError) as error:
+            status_code = error.response.status_code if error.response is not None else None
+            retryable = status_code is None or status_code == 429 or status_code >= 500
+            if not retryable or attempt == max_retries:
+                if os.path.exists(part_file):
+                    os.remove(part_file)
+                raise
+            print('Retrying', os.path.basename(local_file), 'after error:', error)
+            time.sleep(backoff ** attempt)
+
+
+def file_checksum(filepath, chunk_size=1024 * 1024):
+    """
+    Compute sha256 checksum of a file.
+
+    Parameters:
+    filepath : Filepath.
+    chunk_size : Bytes read at a time. Defaults to 1 MB.
+
+    Returns : sha256 checksum (hex string).
+    """
+    checksum = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            checksum.update(chunk)
+
+    return checksum.hexdigest()
+
+
+def read_download_manifest(manifest_file):
+    """
+    Read a download manifest (json). The manifest has an entry for each downloaded tile (keyed by filename) with
+    download parameters, byte size, sha256 checksum and status.
+
+    Parameters:
+    manifest_file : Filepath of the manifest.
+
+    Returns : Manifest dictionary. Empty if the manifest doesn't exist.
+    """
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as file:
+            return json.load(file)
+    return {}
+
+
+def write_download_manifest(manifest, manifest_file):
+    """
+    Write a download manifest (json). Written to a temporary file first and renamed, so the manifest is never left
+    half written.
+
+    Parameters:
+    manifest : Manifest dictionary.
+    manifest_file : Filepath of the manifest.
+
+    Returns : None.
+    """
+    with open(manifest_file + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+
+def is_tile_complete(manifest_entry, params, local_file):
+    """
+    Check if a tile has already been downloaded completely with the same parameters (file exists, size and checksum
+    match the manifest).
+
+    Parameters:
+    manifest_entry : Manifest entry of the tile (None if not in the manifest).
+    params : Download parameters of the tile.
+    local_file : Filepath of the downloaded tile.
+
+    Returns : True if the tile doesn't need to be downloaded again.
+    """
+    if manifest_entry is None or manifest_entry.get('status') != 'complete' or manifest_entry['params'] != params:
+        return False
+    if not os.path.exists(local_file) or os.path.getsize(local_file) != manifest_entry['size']:
+        return False
+
+    return file_checksum(local_file) == manifest_entry['sha256']
+
+
+def estimate_gee_request_size(bounds, gee_scale, num_bands=1, bytes_per_pixel=4):
+    """
+    Estimate the size of a getDownloadURL request in EPSG:4326 (GEE converts the scale in meter to degree with
+    111319.49 m per degree).
+
+    Parameters:
+    bounds : Tile bounds (minx, miny, maxx, maxy) in degree.
+    gee_scale : Download Scale in meter.
+    num_bands : Number of bands in the image. Defaults to 1.
+    bytes_per_pixel : Bytes per pixel of each band. Defaults to 4 (float32).
+
+    Returns : Width (pixels), height (pixels) and size (bytes) of the request.
+    """
+    minx, miny, maxx, maxy = bounds
+    pixel_size = gee_scale / 111319.49
+    width, height = int(np.ceil((maxx - minx) / pixel_size)), int(np.ceil((maxy - miny) / pixel_size))
+
+    return width, height, width * height * num_bands * bytes_per_pixel
+
+
+def split_tile_bounds(bounds):
+    """
+    Split tile bounds into 4 quadrants.
+
+    Parameters:
+    bounds : Tile bounds (minx, miny, maxx, maxy).
+
+    Returns : List of quadrant bounds (upper left, upper right, lower left, lower right).
+    """
+    minx, miny, maxx, maxy = bounds
+    midx, midy = (minx + maxx) / 2, (miny + maxy) / 2
+
+    return [[minx, midy, midx, maxy], [midx, midy, maxx, maxy], [minx, miny, midx, midy], [midx, miny, maxx, midy]]
+
+
+def quadtree_split_tile(shape, bounds, gee_scale, num_bands=1, bytes_per_pixel=4,
+                        max_request_bytes=GEE_max_request_bytes, max_dimension=GEE_max_grid_dimension):
+    """
+    Recursively split a download tile into quadrants (quadtree) until each request is within the GEE size limits.
+    Quadrants are named <shape>_q0 to <shape>_q3.
+
+    Parameters:
+    shape : Tile name.
+    bounds : Tile bounds (minx, miny, maxx, maxy) in degree.
+    gee_scale : Download Scale in meter.
+    num_bands : Number of bands in the image. Defaults to 1.
+    bytes_per_pixel : Bytes per pixel of each band. Defaults to 4 (float32).
+    max_request_bytes : Maximum request size in bytes. Defaults to GEE_max_request_bytes.
+    max_dimension : Maximum width/height of a request in pixels. Defaults to GEE_max_grid_dimension.
+
+    Returns : List of (tile name, tile bounds).
+    """
+    width, height, size = estimate_gee_request_size(bounds, gee_scale, num_bands, bytes_per_pixel)
+    if size <= max_request_bytes and max(width, height) <= max_dimension:
+        return [(shape, list(bounds))]
+
+    tiles = []
+    for num, quadrant in enumerate(split_tile_bounds(bounds)):
+        tiles.extend(quadtree_split_tile(shape + '_q' + str(num), quadrant, gee_scale, num_bands, bytes_per_pixel,
+                                         max_request_bytes, max_dimension))
+    return tiles
+
+
+def is_gee_limit_error(error):
+    """
+    Check if a download error means that GEE refused the tile for its size/computation, so splitting the tile may
+    help. GEE raises ee.EEException from getDownloadURL for requests over the size limits, while memory and
+    computation limit failures come back as a 400 (or 413) response when the download url is fetched.
+
+    Parameters:
+    error : Exception raised while downloading a tile.
+
+    Returns : True if the tile should be split into quadrants.
+    """
+    if isinstance(error, ee.EEException):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code in (400, 413)
+
+    return False
+
+
+def download_gee_tiles(gee_image, shapecsv, output_dir, name, file_suffix='', gee_scale=2000, max_workers=8,
+                       tile_callback=None, callback_workers=2, queue_size=8, num_bands=1, max_split_depth=3,
+                       **download_kwargs):
+    """
+    Download an ee.Image for each download grid (tile) of shapecsv in parallel. Tiles too large for a single GEE
+    request at gee_scale are split into quadrants beforehand (quadtree_split_tile), and tiles that GEE still refuses
+    (see is_gee_limit_error()) are split again at run time (up to max_split_depth), so data is always downloaded at
+    the requested scale. Each tile is saved as output_dir/<shape><file_suffix>.zip and recorded in
+    output_dir/download_manifest.json (download parameters, size, checksum, status). On rerun only missing, corrupt or
+    changed (different image/scale/extent) tiles are downloaded.
+
+    Downloads run as an asyncio pipeline: finished tiles go through a bounded queue to tile_callback (i.e. extract and
+    mosaic) running in a separate thread pool, so processing of finished tiles overlaps with downloading the rest.
+
+    Parameters:
+    gee_image : ee.Image to download.
+    shapecsv : Csv of coordinates for download extent (columns shape, minx, miny, maxx, maxy).
+    output_dir : File directory path to downloaded data.
+    name : Name of the image in the download.
+    file_suffix : String added after the grid name in the downloaded filename. Defaults to ''.
+    gee_scale : Download Scale. Defaults to 2000.
+    max_workers : Number of tiles downloaded at a time. Defaults to 8.
+    tile_callback : Function called with each downloaded (or already complete) zip filepath. Defaults to None.
+    callback_workers : Number of threads running tile_callback. Defaults to 2.
+    queue_size : Maximum number of downloaded tiles waiting for tile_callback. Defaults to 8.
+    num_bands : Number of bands in gee_image (used to estimate request size). Defaults to 1.
+    max_split_depth : Maximum number of times a tile refused by GEE is split at run time. Defaults to 3.
+    download_kwargs : Keyword arguments passed to download_file (max_retries, backoff, timeout, chunk_size).
+
+    Returns : List of downloaded zip filepaths.
+    """
+    makedirs([output_dir])
+    coords_df = pd.read_csv(shapecsv)
+
+    manifest_file = os.path.join(output_dir, 'download_manifest.json')
+    manifest = read_download_manifest(manifest_file)
+    image_id = hashlib.sha256(gee_image.serialize().encode()).hexdigest()
+
+    def tile_file(shape):
+        return os.path.join(output_dir, shape + file_suffix + '.zip')
+
+    def tile_params(bounds):
+        return {'image': image_id, 'name': name, 'crs': 'EPSG:4326', 'scale': int(gee_scale),
+                'region': [float(bound) for bound in bounds]}
+
+    # tiles that are missing, corrupt or downloaded with different parameters. Tiles split in an earlier run are
+    # replaced by their quadrants.
+    downloaded_files, pending_tiles = [], []
+
+    def add_tile(shape, bounds):
+        entry = manifest.get(os.path.basename(tile_file(shape)))
+        if entry is not None and entry.get('status') == 'split' and entry['params'] == tile_params(bounds):
+            for num, quadrant in enumerate(split_tile_bounds(bounds)):
+                add_tile(shape + '_q' + str(num), quadrant)
+        elif is_tile_complete(entry, tile_params(bounds), tile_file(shape)):
+            downloaded_files.append(tile_file(shape))
+        else:
+            pending_tiles.append((shape, bounds))
+
+    for _, row in coords_df.iterrows():
+        bounds = (row['minx'], row['miny'], row['maxx'], row['maxy'])
+        for shape, tile_bounds in quadtree_split_tile(row['shape'], bounds, gee_scale, num_bands=num_bands):
+            add_tile(shape, tile_bounds)
+    print(len(downloaded_files), 'of', len(downloaded_files) + len(pending_tiles), name, 'tiles already downloaded')
+
+    session = make_download_session(pool_size=max_workers)
+
+    def download_tile(local_file_name, params):
+        gee_extent = ee.Geometry.Rectangle(params['region'])
+        data_url = gee_image.getDownloadURL({'name': name,
+                                             'crs': params['crs'],
+                                             'scale': params['scale'],
+                                             'region': gee_extent})
+        size, checksum = download_file(data_url, local_file_name, session=session, **download_kwargs)
+        if not zipfile.is_zipfile(local_file_name):
+            raise ValueError('downloaded file is not a zip archive')
+
+        return size, checksum
+
+    failed_tiles = []
+
+    async def run_pipeline():
+        loop = asyncio.get_running_loop()
+        tile_queue = asyncio.Queue(maxsize=queue_size)
+        num_done, num_total = [0], [len(pending_tiles)]
+
+        async def fetch(shape, bounds, depth=0):
+            local_file_name, params = tile_file(shape), tile_params(bounds)
+            tile_key = os.path.basename(local_file_name)
+            try:
+                size, checksum = await loop.run_in_executor(download_executor, download_tile, local_file_name, params)
+                entry = {'params': params, 'size': size, 'sha256': checksum, 'status': 'complete'}
+                status = 'Downloaded ' + local_file_name + ' (' + str(round(size / 1e6, 2)) + ' MB)'
+            except (ee.EEException, requests.HTTPError) as error:
+                if not is_gee_limit_error(error):
+                    entry = {'params': params, 'status': 'failed', 'error': str(error)}
+                    status = 'Failed ' + tile_key + ' : ' + str(error)
+                elif depth >= max_split_depth:
+                    entry = {'params': params, 'status': 'failed', 'error': str(error)}
+                    status = 'Failed ' + tile_key + ' : ' + str(error)
+                else:
+                    entry = {'params': params, 'status': 'split', 'error': str(error)}
+                    status = 'Splitting ' + tile_key + ' into quadrants : ' + str(error)
+            except Exception as error:
+                entry = {'params': params, 'status': 'failed', 'error': str(error)}
+                status = 'Failed ' + tile_key + ' : ' + str(error)
+
+            # manifest is only updated from the event loop, so no lock is needed
+            manifest[tile_key] = entry
+            write_download_manifest(manifest, manifest_file)
+            num_done[0] += 1
+            print('[' + str(num_done[0]) + '/' + str(num_total[0]) + ']', status)
+
+            if entry['status'] == 'complete':
+                downloaded_files.append(local_file_name)
+                if tile_callback is not None:
+                    await tile_queue.put(local_file_name)
+            elif entry['status'] == 'split':
+                num_total[0] += 4
+                await asyncio.gather(*(fetch(shape + '_q' + str(num), quadrant, depth + 1)
+                                       for num, quadrant in enumerate(split_tile_bounds(bounds))))
             else:
-                zip_ref.extractall(path=out_dir)
+                failed_tiles.append(tile_key)
+
+        async def process():
+            while True:
+                local_file_name = await tile_queue.get()
+                if local_file_name is None:
+                    break
+                # a failed callback must not stop the consumer, else fetch() blocks forever on the full queue
+                try:
+                    await loop.run_in_executor(callback_executor, tile_callback, local_file_name)
+                except Exception as error:
+                    tile_key = os.path.basename(local_file_name)
+                    print('Failed processing', tile_key, ':', error)
+                    failed_tiles.append(tile_key + ' (processing: ' + str(error) + ')')
+
+        async def enqueue_downloaded(local_files):
+            for local_file_name in local_files:
+                await tile_queue.put(local_file_name)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as download_executor, \
+                ThreadPoolExecutor(max_workers=callback_workers) as callback_executor:
+            processors, producers = [], []
+            if tile_callback is not None:
+                processors = [asyncio.ensure_future(process()) for _ in range(callback_workers)]
+                # already downloaded tiles are queued alongside the new downloads, so downloads start right away
+                producers.append(enqueue_downloaded(list(downloaded_files)))
+
+            await asyncio.gather(*producers, *(fetch(shape, bounds) for shape, bounds in pending_tiles))
+
+            for _ in processors:
+                await tile_queue.put(None)
+            await asyncio.gather(*processors)
+
+    asyncio.run(run_pipeline())
+    session.close()
+
+    if failed_tiles:
+        raise RuntimeError('Download/processing failed for ' + name + ' tiles: ' + ', '.join(failed_tiles))
+
+    return downloaded_files
+
+
+def download_mosaic_gee_tiles(gee_image, shapecsv, output_dir, name, mosaic_dir, mosaic_name, file_suffix='',
+                              gee_scale=2000, max_workers=8, ref_raster=referenceraster, resolution=0.02,
+                              nodata=No_Data_Value, extract_tiles=False, delete_zips=False):
+    """
+    Download an ee.Image tile by tile (download_gee_tiles) and mosaic it. Each tile is read straight from the
+    downloaded zip file (GDAL /vsizip/) and pasted on the mosaic as soon as it is downloaded, so mosaicking overlaps
+    with the downloads and the tiles are never unpacked to disk.
+
+    Parameters:
+    gee_image : ee.Image to download.
+    shapecsv : Csv of coordinates for download extent.
+    output_dir : File directory path to downloaded data.
+    name : Name of the image in the download.
+    mosaic_dir : Mosaic raster directory.
+    mosaic_name : Mosaic raster name.
+    file_suffix : String added after the grid name in the downloaded filename. Defaults to ''.
+    gee_scale : Download Scale. Defaults to 2000.
+    max_workers : Number of tiles downloaded at a time. Defaults to 8.
+    ref_raster : Reference raster. Defaults to referenceraster.
+    resolution : Resolution of the mosaic. Defaults to 0.02.
+    nodata : No Data value. Defaults to -9999.
+    extract_tiles : Set True to also extract the tiles as <zip name>.tif (for debugging). Defaults to False.
+    delete_zips : Set True to delete the downloaded zip files after the mosaic is written and verified (all tiles
+                  pasted and the mosaic raster readable with the expected shape). Defaults to False.
+
+    Returns : Mosaic array and mosaic raster filepath.
+    """
+    mosaic_arr, mosaic_transform = create_empty_mosaic(ref_raster=ref_raster, resolution=resolution, no_data=nodata)
+    mosaic_lock = threading.Lock()
+    pasted_tiles = []
+
+    def paste_tile(zip_file):
+        if extract_tiles:
+            extract_zip_file(zip_file, output_dir, rename_file=True)
+        paste_tile_on_mosaic(vsizip_path(zip_file), mosaic_arr, mosaic_transform, resolution=resolution,
+                             no_data=nodata, lock=mosaic_lock)
+        pasted_tiles.append(zip_file)
+
+    zip_files = download_gee_tiles(gee_image, shapecsv, output_dir, name=name, file_suffix=file_suffix,
+                                   gee_scale=gee_scale, max_workers=max_workers, tile_callback=paste_tile)
+    merged_arr, mosaic_raster = write_mosaic(mosaic_arr, mosaic_dir, mosaic_name, ref_raster=ref_raster,
+                                             no_data=nodata)
+
+    if delete_zips:
+        with rio.open(mosaic_raster) as mosaic_file:
+            verified = len(pasted_tiles) == len(zip_files) and mosaic_file.shape == mosaic_arr.shape
+        if verified:
+            for zip_file in zip_files:
+                os.remove(zip_file)
+        else:
+            print('Mosaic', mosaic_raster, 'could not be verified. Zip files are kept.')
+
+    return merged_arr, mosaic_raster
 
 
 # # ImageCollection Data Yearly Sum Download
@@ -72,8 +539,6 @@ def download_imagecollection_gee_yearly_sum(yearlist, start_month, end_month, ou
     """
     # Initialize
     ee.Initialize()
-    # Define Extent
-    coords_df = pd.read_csv(shapecsv)
     # Date range
     for year in yearlist:
         start_date = ee.Date.fromYMD(year, start_month, 1)
@@ -85,35 +550,15 @@ def download_imagecollection_gee_yearly_sum(yearlist, start_month, end_month, ou
         if start_month <= end_month:
             start_date = ee.Date.fromYMD(year - 1, start_month, 1)
 
-        for index, row in coords_df.iterrows():
-            minx = row['minx']
-            miny = row['miny']
-            maxx = row['maxx']
-            maxy = row['maxy']
-            gee_extent = ee.Geometry.Rectangle((minx, miny, maxx, maxy))
-
-            # Get URL
-            data_download = ee.ImageCollection(imagecollection).select(bandname).filterDate(start_date, end_date) \
-                .sum().multiply(factor).toFloat()  # Change the function sum() based on purpose
-
-            data_url = data_download.getDownloadURL({'name': dataname,
-                                                     'crs': "EPSG:4326",
-                                                     'scale': gee_scale,
-                                                     'region': gee_extent})
-            # downloading the data
-            download_dir = makedirs([os.path.join(output_dir, str(year))])
-            key_word = row['shape']
-            local_file_name = os.path.join(download_dir, key_word + str(year) + '.zip')
-            print('Downloading', local_file_name, '.....')
-            r = requests.get(data_url, allow_redirects=True)
-            open(local_file_name, 'wb').write(r.content)
-
-            if index == coords_df.index[-1]:
-                extract_data(zip_dir=download_dir, out_dir=download_dir, rename_file=True)
-                mosaic_dir = makedirs([os.path.join(output_dir, 'merged_rasters')])
-                mosaic_name = dataname + '_' + str(year) + '.tif'
-                mosaic_rasters(input_dir=download_dir, output_dir=mosaic_dir, raster_name=mosaic_name,
-                               ref_raster=referenceraster, search_by='*.tif', resolution=0.02, no_data=No_Data_Value)
+        data_download = ee.ImageCollection(imagecollection).select(bandname).filterDate(start_date, end_date) \
+            .sum().multiply(factor).toFloat()  # Change the function sum() based on purpose
+
+        # downloading the data
+        download_dir = makedirs([os.path.join(output_dir, str(year))])
+        mosaic_dir = os.path.join(output_dir, 'merged_rasters')
+        mosaic_name = dataname + '_' + str(year) + '.tif'
+        download_mosaic_gee_tiles(data_download, shapecsv, download_dir, name=dataname, mosaic_dir=mosaic_dir,
+                                  mosaic_name=mosaic_name, file_suffix=str(year), gee_scale=gee_scale)
 
 
 def download_gee_data(yearlist, start_month, end_month, output_dir, dataname, shapecsv=csv,
@@ -208,53 +653,26 @@ def download_gee_data(yearlist, start_month, end_month, output_dir, dataname, sh
     elif dataname == 'TRCLM_ET':
         data = data_collection.select('aet').filterDate(start_date, end_date).mean().multiply(0.1).toFloat()
 
-    makedirs([output_dir])
-    coords_df = pd.read_csv(shapecsv)
-    for index, row in coords_df.iterrows():
-        # Define Extent
-        minx = row['minx']
-        miny = row['miny']
-        maxx = row['maxx']
-        maxy = row['maxy']
-        gee_extent = ee.Geometry.Rectangle((minx, miny, maxx, maxy))
-
-        if dataname == 'MODIS_EVI':
-            gee_scale = 3000  # gee_scale 2000 can't download data for some grids, so select it >=3000 for MODIS EVI
-
-        # Download URL
-        data_url = data.getDownloadURL({'name': dataname,
-                                        'crs': "EPSG:4326",
-                                        'scale': gee_scale,
-                                        'region': gee_extent})
-        # dowloading the data
-        key_word = row['shape']
-        local_file_name = os.path.join(output_dir, key_word + str(yearlist[0]) + '_' + str(yearlist[1]) + '.zip')
-        print('Downloading', local_file_name, '.....')
-        r = requests.get(data_url, allow_redirects=True)
-        open(local_file_name, 'wb').write(r.content)
-
-        if index == coords_df.index[-1]:
-            extract_data(zip_dir=output_dir, out_dir=output_dir, rename_file=True)
-            mosaic_dir = makedirs([os.path.join(output_dir, 'merged_rasters')])
-            mosaic_name = dataname + '_' + str(yearlist[0]) + '_' + str(yearlist[1]) + '.tif'
-            merged_arr, merged_raster = mosaic_rasters(input_dir=output_dir, output_dir=mosaic_dir,
-                                                       raster_name=mosaic_name,
-                                                       ref_raster=referenceraster, search_by='*.tif', resolution=0.02,
-                                                       no_data=No_Data_Value)
-            if month_conversion:
-                start_date = datetime(yearlist[0], start_month, 1)
-                end_date = datetime(yearlist[1], end_month,
-                                    31)  # Set to 31 as end month for the project is December
-                days_between = (end_date - start_date).days
-
-                merged_arr[merged_arr == nodata] = np.nan
-                monthly_arr = merged_arr * 30 / days_between
-                monthly_arr[np.isnan(monthly_arr)] = nodata
-
-                output_name = dataname + '_' + str(yearlist[0]) + '_' + str(yearlist[1]) + '_monthly' + '.tif'
-                ref_arr, ref_file = read_raster_arr_object(referenceraster)
-                write_raster(raster_arr=monthly_arr, raster_file=ref_file, transform=ref_file.transform,
-                             outfile_path=os.path.join(mosaic_dir, output_name), no_data_value=nodata)
+    # dowloading the data
+    mosaic_dir = os.path.join(output_dir, 'merged_rasters')
+    mosaic_name = dataname + '_' + str(yearlist[0]) + '_' + str(yearlist[1]) + '.tif'
+    merged_arr, merged_raster = download_mosaic_gee_tiles(data, shapecsv, output_dir, name=dataname,
+                                                          mosaic_dir=mosaic_dir, mosaic_name=mosaic_name,
+                                                          file_suffix=str(yearlist[0]) + '_' + str(yearlist[1]),
+                                                          gee_scale=gee_scale)
+    if month_conversion:
+        start_date = datetime(yearlist[0], start_month, 1)
+        end_date = datetime(yearlist[1], end_month, 31)  # Set to 31 as end month for the project is December
+        days_between = (end_date - start_date).days
+
+        merged_arr[merged_arr == nodata] = np.nan
+        monthly_arr = merged_arr * 30 / days_between
+        monthly_arr[np.isnan(monthly_arr)] = nodata
+
+        output_name = dataname + '_' + str(yearlist[0]) + '_' + str(yearlist[1]) + '_monthly' + '.tif'
+        ref_arr, ref_file = read_raster_arr_object(referenceraster)
+        write_raster(raster_arr=monthly_arr, raster_file=ref_file, transform=ref_file.transform,
+                     outfile_path=os.path.join(mosaic_dir, output_name), no_data_value=nodata)
 
 
 # Download clay data for different layer from GEE
@@ -303,38 +721,15 @@ def download_clay_data(yearlist, output_dir, dataname, shapecsv=csv, gee_scale=2
     elif dataname == 'clay_content_200cm':
         data = data_collection.select('b200').toFloat()
 
-    makedirs([output_dir])
-    coords_df = pd.read_csv(shapecsv)
-    for index, row in coords_df.iterrows():
-        # Define Extent
-        minx = row['minx']
-        miny = row['miny']
-        maxx = row['maxx']
-        maxy = row['maxy']
-        gee_extent = ee.Geometry.Rectangle((minx, miny, maxx, maxy))
-
-        # Download URL
-        data_url = data.getDownloadURL({'name': dataname,
-                                        'crs': "EPSG:4326",
-                                        'scale': gee_scale,
-                                        'region': gee_extent})
-        # dowloading the data
-        key_word = row['shape']
-        local_file_name = os.path.join(output_dir, key_word + str(yearlist[0]) + '_' + str(yearlist[1]) + '.zip')
-        print('Downloading', local_file_name, '.....')
-        r = requests.get(data_url, allow_redirects=True)
-        open(local_file_name, 'wb').write(r.content)
-
-        if index == coords_df.index[-1]:
-            extract_data(zip_dir=output_dir, out_dir=output_dir, rename_file=True)
-            mosaic_dir = makedirs([os.path.join(output_dir, 'merged_rasters')])
-            mosaic_name = dataname + '_' + str(yearlist[0]) + '_' + str(yearlist[1]) + '.tif'
-            merged_arr, merged_raster = mosaic_rasters(input_dir=output_dir, output_dir=mosaic_dir,
-                                                       raster_name=mosaic_name,
-                                                       ref_raster=referenceraster, search_by='*.tif', resolution=0.02,
-                                                       no_data=nodata)
-
-            return merged_raster
+    # dowloading the data
+    mosaic_dir = os.path.join(output_dir, 'merged_rasters')
+    mosaic_name = dataname + '_' + str(yearlist[0]) + '_' + str(yearlist[1]) + '.tif'
+    merged_arr, merged_raster = download_mosaic_gee_tiles(data, shapecsv, output_dir, name=dataname,
+                                                          mosaic_dir=mosaic_dir, mosaic_name=mosaic_name,
+                                                          file_suffix=str(yearlist[0]) + '_' + str(yearlist[1]),
+                                                          gee_scale=gee_scale, nodata=nodata)
+
+    return merged_raster
 
 
 # #Download GRACE ensemble data gradient over the year
@@ -389,34 +784,12 @@ def download_grace_gradient(yearlist, start_month, end_month, output_dir, shapec
     grace_ensemble_avg = grace_csr_trend.select(0).add(grace_gfz_trend.select(0)).select(0) \
         .add(grace_jpl_trend.select(0)).select(0).divide(3)
 
-    makedirs([output_dir])
-    coords_df = pd.read_csv(shapecsv)
-    for index, row in coords_df.iterrows():
-        # Define Extent
-        minx = row['minx']
-        miny = row['miny']
-        maxx = row['maxx']
-        maxy = row['maxy']
-        gee_extent = ee.Geometry.Rectangle((minx, miny, maxx, maxy))
-
-        download_url = grace_ensemble_avg.getDownloadURL({'name': 'Grace',
-                                                          'crs': "EPSG:4326",
-                                                          'scale': gee_scale,
-                                                          'region': gee_extent})
-        # dowloading the data
-        key_word = row['shape'] + 'Grace_'
-        local_file_name = os.path.join(output_dir, key_word + str(yearlist[0]) + '_' + str(yearlist[1]) + '.zip')
-        print('Downloading', local_file_name, '.....')
-        r = requests.get(download_url, allow_redirects=True)
-        open(local_file_name, 'wb').write(r.content)
-
-        if index == coords_df.index[-1]:
-            extract_data(zip_dir=output_dir, out_dir=output_dir, rename_file=True)
-            mosaic_dir = makedirs([os.path.join(output_dir, 'merged_rasters')])
-            mosaic_name = 'Grace' + '_' + str(yearlist[0]) + '_' + str(yearlist[1]) + '.tif'
-            mosaic_rasters(input_dir=output_dir, output_dir=mosaic_dir, raster_name=mosaic_name,
-                           ref_raster=referenceraster, search_by='*.tif', resolution=0.02,
-                           no_data=No_Data_Value)
+    # dowloading the data
+    mosaic_dir = os.path.join(output_dir, 'merged_rasters')
+    mosaic_name = 'Grace' + '_' + str(yearlist[0]) + '_' + str(yearlist[1]) + '.tif'
+    download_mosaic_gee_tiles(grace_ensemble_avg, shapecsv, output_dir, name='Grace', mosaic_dir=mosaic_dir,
+                              mosaic_name=mosaic_name, file_suffix='Grace_' + str(yearlist[0]) + '_' + str(yearlist[1]),
+                              gee_scale=gee_scale)
 
 
 # #Stationary Single Image Download
@@ -444,26 +817,8 @@ def download_image_gee(output_dir, bandname, shapecsv=None, factor=1, gee_scale=
     if terrain_slope:
         data_download = ee.Terrain.slope(data_download)
 
-    makedirs([output_dir])
-    coords_df = pd.read_csv(shapecsv)
-    for index, row in coords_df.iterrows():
-        # Define Extent
-        minx = row['minx']
-        miny = row['miny']
-        maxx = row['maxx']
-        maxy = row['maxy']
-        gee_extent = ee.Geometry.Rectangle((minx, miny, maxx, maxy))
-
-        download_url = data_download.getDownloadURL({'name': dataname,
-                                                     'crs': "EPSG:4326",
-                                                     'scale': gee_scale,
-                                                     'region': gee_extent})
-        # dowloading the data
-        key_word = row['shape']
-        local_file_name = os.path.join(output_dir, key_word + '.zip')
-        print('Downloading', local_file_name, '.....')
-        r = requests.get(download_url, allow_redirects=True)
-        open(local_file_name, 'wb').write(r.content)
+    # dowloading the data
+    download_gee_tiles(data_download, shapecsv, output_dir, name=dataname, gee_scale=gee_scale)
 
 
 # # MODIS Cloudmask
@@ -540,34 +895,12 @@ def download_modis_derived_product(yearlist, start_month, end_month, output_dir,
         SWIR = cloudmasked.select('sur_refl_b06').mean().multiply(factor).toFloat()
         data_download = NIR.subtract(SWIR).divide(NIR.add(SWIR))
 
-    coords_df = pd.read_csv(shapecsv)
-    for index, row in coords_df.iterrows():
-        # Define Extent
-        minx = row['minx']
-        miny = row['miny']
-        maxx = row['maxx']
-        maxy = row['maxy']
-        gee_extent = ee.Geometry.Rectangle((minx, miny, maxx, maxy))
-
-        # Download URL
-        data_url = data_download.getDownloadURL({'name': name,
-                                                 'crs': "EPSG:4326",
-                                                 'scale': gee_scale,
-                                                 'region': gee_extent})
-        # dowloading the data
-        key_word = row['shape']
-        local_file_name = os.path.join(output_dir, key_word + str(yearlist[0]) + '_' + str(yearlist[1]) + '.zip')
-        print('Downloading', local_file_name, '.....')
-        r = requests.get(data_url, allow_redirects=True)
-        open(local_file_name, 'wb').write(r.content)
-
-        if index == coords_df.index[-1]:
-            extract_data(zip_dir=output_dir, out_dir=output_dir, rename_file=True)
-            mosaic_dir = makedirs([os.path.join(output_dir, 'merged_rasters')])
-            mosaic_name = dataname + '_' + index_name + '_' + str(yearlist[0]) + '_' + str(yearlist[1]) + '.tif'
-            mosaic_rasters(input_dir=output_dir, output_dir=mosaic_dir, raster_name=mosaic_name,
-                           ref_raster=referenceraster, search_by='*.tif', resolution=0.02,
-                           no_data=No_Data_Value)
+    # dowloading the data
+    mosaic_dir = os.path.join(output_dir, 'merged_rasters')
+    mosaic_name = dataname + '_' + index_name + '_' + str(yearlist[0]) + '_' + str(yearlist[1]) + '.tif'
+    download_mosaic_gee_tiles(data_download, shapecsv, output_dir, name=name, mosaic_dir=mosaic_dir,
+                              mosaic_name=mosaic_name, file_suffix=str(yearlist[0]) + '_' + str(yearlist[1]),
+                              gee_scale=gee_scale)
 
 
 # #Download data from URL
@@ -581,12 +914,13 @@ def download_from_url(out_dir, url_list):
     Returns: Data downloaded from url.
     """
     makedirs([out_dir])
+    session = make_download_session(pool_size=1)
     for url in url_list:
         fname = url.rsplit('/', 1)[1]
         out_fname = os.path.join(out_dir, fname)
         print("Downloading", fname, "......")
-        r = requests.get(url, allow_redirects=True)
-        open(out_fname, 'wb').write(r.content)
+        download_file(url, out_fname, session=session)
+    session.close()
 
 
 def download_data(data_list, yearlist, start_month, end_month, shape_csv=csv, gee_scale=2000, skip_download=True):
@@ -636,9 +970,8 @@ def download_data(data_list, yearlist, start_month, end_month, shape_csv=csv, ge
         for data in data_list:
             if data == 'MODIS_NDWI':
                 download_modis_derived_product(yearlist, start_month, end_month, downdir_NDWI, shapecsv=csv,
-                                               gee_scale=3500, imagecollection='MODIS/006/MOD09A1', factor=0.0001,
-                                               index_name='NDWI')
-                # Scale set to 3500 due to having download error at lower scale
+                                               gee_scale=gee_scale, imagecollection='MODIS/006/MOD09A1',
+                                               factor=0.0001, index_name='NDWI')
             elif data == 'MODIS_EVI':
                 download_gee_data(yearlist, start_month, end_month, downdir_EVI, 'MODIS_EVI', shape_csv,
                                   gee_scale=gee_scale)
@@ -732,6 +1065,7 @@ def prepare_lu_data(gfsad_lu='../Data/Raw_Data/Land_Use_Data/Raw/Global Food Sec
 
     if not skip_processing:
         makedirs([intermediate_dir, output_dir])
+        gfsad_raster, irrigated_meier_raster, giam_gw_raster = None, None, None
         if gfsad_lu:
             print('Processing GFSAD1KCM Dataset...')
             masked_raster = mask_by_ref_raster(input_raster=gfsad_lu, outdir=intermediate_dir,
@@ -894,37 +1228,9 @@ def prepare_river_proximity_data(input_shape='../Data/Raw_Data/Surface_Water/mrb
         makedirs([output_dir])
         river_raster = shapefile_to_raster(input_shape, output_dir, 'River_raster.tif', use_attr=False, burnvalue=1,
                                            resolution=0.02)
-        river_arr = read_raster_arr_object(river_raster, get_file=False).flatten()
-        ref_arr, ref_file = read_raster_arr_object(ref_raster)
-        ref_arr = ref_arr.flatten()
-        modified_river_arr = np.where(river_arr == 1, river_arr, ref_arr)
-        modified_river_arr = modified_river_arr.reshape(ref_file.shape)
-
-        final_river_raster = output_dir + '/River_raster_wgs4326.tif'
-        river_raster_wgs4326 = write_raster(modified_river_arr, ref_file, ref_file.transform, final_river_raster)
-
-        river_raster_projected = resample_reproject(river_raster_wgs4326, output_dir, 'River_raster_projected.tif',
-                                                    reference_raster=referenceraster, resample=False, reproject=True,
-                                                    change_crs_to="EPSG:4087", both=False, resample_algorithm='near',
-                                                    nodata=No_Data_Value)
-
-        river_distance_projected = compute_proximity(river_raster_projected, output_dir, 'River_distance_projected.tif',
-                                                     target_values=(1,))
-
-        river_distance_wgs4326 = resample_reproject(river_distance_projected, output_dir, 'River_distance_wgs4326.tif',
-                                                    reference_raster=referenceraster, resample=False, reproject=True,
-                                                    change_crs_to="EPSG:4326", both=False, resample_algorithm='near',
-                                                    nodata=No_Data_Value)
-        river_distance_prefinal = paste_val_on_ref_raster(river_distance_wgs4326, output_dir,
-                                                          'River_distance_prefinal.tif', value=0,
-                                                          ref_raster=referenceraster)
-
-        # converting distance values in pixel to km
-        river_distance_arr = read_raster_arr_object(river_distance_prefinal, get_file=False)
-        river_distance_arr = river_distance_arr / 1000
-
-        final_river_distance = '../Data/Resampled_Data/Surface_Water/River_distance.tif'
-        river_distance = write_raster(river_distance_arr, ref_file, ref_file.transform, final_river_distance)
+        # distance (km) computed directly on the reference grid
+        river_distance = compute_geodesic_proximity(river_raster, output_dir, 'River_distance.tif', target_values=(1,),
+                                                    ref_raster=ref_raster)
 
         print('Processed River Dataset')
     else:
@@ -993,12 +1299,54 @@ def prepare_modis_landuse_data(output_raster,
     return output_raster
 
 
+def process_gee_predictor_data(data, input_raster, resampled_gee_dir, perform_pca=False, pca_clay_list=None):
+    """
+    Process (resample/copy) a downloaded GEE predictor dataset into the resampled GEE data directory.
+
+    Parameters:
+    data : Predictor name (key of the downloaded data dictionary in download_process_predictor_datasets()).
+    input_raster : Downloaded (merged) raster filepath of the predictor.
+    resampled_gee_dir : Resampled directory for GEE data.
+    perform_pca : Set to True if to run PCA (only for 'Clay_content_PCA').
+    pca_clay_list : List of clay content rasters for PCA (only for 'Clay_content_PCA').
+
+    Returns : Processed predictor raster filepath.
+    """
+    print('Processing', data, '...')
+
+    if data == 'Alexi_ET':
+        name = input_raster[input_raster.rfind(os.sep) + 1:]
+        resampled_raster = resample_reproject(input_raster, output_dir=resampled_gee_dir, raster_name=name,
+                                              resample=True)
+
+    elif data == 'SRTM_Slope':
+        resampled_raster = create_slope_raster(input_raster, outdir=resampled_gee_dir,
+                                               raster_name='SRTM_Slope_2013_2019.tif')
+
+    elif data == 'Clay_content_PCA':
+        if perform_pca:
+            resampled_raster = perform_pca_clay(pca_clay_list, deconstruct_pca=False, global_basis=True)
+        else:
+            resampled_raster = '../Data/Resampled_Data/PCA_Clay/continent_raster/pca_clay_content.tif'
+            print('PCA of clay content exists')
+
+    elif data == 'MODIS_Land_Use':
+        resampled_raster = prepare_modis_landuse_data(
+            output_raster='../Data/Resampled_Data/GEE_data_2013_2019/MODIS_Land_Use.tif', input_raster=input_raster)
+
+    else:
+        resampled_raster = rename_copy_raster(input_raster=input_raster, output_dir=resampled_gee_dir, rename=False)
+
+    return resampled_raster
+
+
 def download_process_predictor_datasets(yearlist, start_month, end_month, resampled_gee_dir,
                                         gfsad_cropextent, giam_gw, irrigated_meier, intermediate_dir, outdir_lu,
                                         sediment_thickness, outdir_sed_thickness, outdir_pop, river_shape, outdir_sw,
                                         confining_layer, outdir_confining_layer,
                                         perform_pca=False, skip_download=True, skip_processing=True,
-                                        geedatalist=gee_data_list, downloadcsv=csv, gee_scale=2000):
+                                        geedatalist=gee_data_list, downloadcsv=csv, gee_scale=2000, max_workers=4,
+                                        memory_budget_gb=16):
     """
     Download and process (resample) GEE data and other datasets (Land Use, Population, Sediment thickness).
 
@@ -1029,6 +1377,8 @@ def download_process_predictor_datasets(yearlist, start_month, end_month, resamp
                   'clay_content_100cm', 'clay_content_200cm', 'MODIS_Land_Use', 'TRCLM_ET']
     downloadcsv : Csv (with coordinates) filepath used in downloading data from GEE.
     gee_scale : scale to use in downloading data from GEE in meter. Default set to 2000m.
+    max_workers : Number of worker processes to run the independent processing jobs. Defaults to 4.
+    memory_budget_gb : Total memory (GB) allowed for the concurrently running processing jobs. Defaults to 16.
 
     Returns : Filepath of processed gee datasets along with land use, population density rasters.
     """
@@ -1072,63 +1422,69 @@ def download_process_predictor_datasets(yearlist, start_month, end_month, resamp
                        'Alexi_ET': Alexi_ET, 'Clay_content_PCA': None, 'MODIS_Land_Use': MODIS_LU, 'TRCLM_ET': TRCLM_ET,
                        'Clay_200cm': Clay_200cm}
 
+    # Independent processing jobs run concurrently in a process pool (see System_operations.run_parallel_jobs()).
+    # memory_gb is a rough peak memory estimate of each job on the 0.02 degree global grid.
+    processing_jobs = {
+        'gfsad': {'func': prepare_lu_data, 'memory_gb': 4,
+                  'kwargs': dict(gfsad_lu=gfsad_cropextent, giam_gw=None, irrigated_meier=None,
+                                 intermediate_dir=intermediate_dir, output_dir=outdir_lu,
+                                 skip_processing=skip_processing)},
+        'irrigated_meier': {'func': prepare_lu_data, 'memory_gb': 4,
+                            'kwargs': dict(gfsad_lu=None, giam_gw=None, irrigated_meier=irrigated_meier,
+                                           intermediate_dir=intermediate_dir, output_dir=outdir_lu,
+                                           skip_processing=skip_processing)},
+        'giam_gw': {'func': prepare_lu_data, 'memory_gb': 4,
+                    'kwargs': dict(gfsad_lu=None, giam_gw=giam_gw, irrigated_meier=None,
+                                   intermediate_dir=intermediate_dir, output_dir=outdir_lu,
+                                   skip_processing=skip_processing)},
+        'sediment_thickness': {'func': prepare_sediment_thickness_data, 'memory_gb': 3,
+                               'kwargs': dict(input_raster=sediment_thickness, interim_dir=intermediate_dir,
+                                              output_dir=outdir_sed_thickness,
+                                              raster_name='Global_Sediment_Thickness.tif',
+                                              skip_processing=skip_processing)},
+        'clay_thickness': {'func': prepare_clay_thickness_data, 'memory_gb': 3,
+                           'depends_on': ['sediment_thickness'],
+                           'kwargs': dict(clay_raster=Clay_200cm,
+                                          sediment_thickness_raster=lambda results: results['sediment_thickness'],
+                                          output_dir=outdir_sed_thickness, skip_processing=skip_processing)},
+        'popdensity': {'func': prepare_popdensity_data, 'memory_gb': 3,
+                       'kwargs': dict(pop_dataset=PopDensity_GPW, output_dir=outdir_pop,
+                                      skip_processing=skip_processing)},
+        'river_distance': {'func': prepare_river_proximity_data, 'memory_gb': 4,
+                           'kwargs': dict(input_shape=river_shape, output_dir=outdir_sw,
+                                          skip_processing=skip_processing)},
+        'confining_layers': {'func': process_global_confining_layer_data, 'memory_gb': 2,
+                             'kwargs': dict(input_raster=confining_layer, output_dir=outdir_confining_layer)}
+    }
+
     if not skip_processing:
-        resampled_gee_rasters = {}
+        makedirs([resampled_gee_dir])
+        pca_clay_list = [Clay_0cm, Clay_10cm, Clay_30cm, Clay_60cm, Clay_100cm, Clay_200cm]
         for data, path in Downloaded_list.items():
-            print('Processing', data, '...')
-
-            if data == 'Alexi_ET':
-                name = path[path.rfind(os.sep) + 1:]
-                resampled_raster = resample_reproject(Downloaded_list[data], output_dir=resampled_gee_dir,
-                                                      raster_name=name, resample=True)
-                resampled_gee_rasters[data] = resampled_raster
-
-            elif data == 'SRTM_Slope':
-                slope_raster = create_slope_raster(Downloaded_list[data], outdir=resampled_gee_dir,
-                                                   raster_name='SRTM_Slope_2013_2019.tif')
-                resampled_gee_rasters[data] = slope_raster
-
-            elif data == 'Clay_content_PCA':
-                if perform_pca:
-                    pca_clay_list = [Clay_0cm, Clay_10cm, Clay_30cm, Clay_60cm, Clay_100cm, Clay_200cm]
-                    pca_raster = perform_pca_clay(pca_clay_list, deconstruct_pca=False)
-                    resampled_gee_rasters[data] = pca_raster
-                else:
-                    resampled_gee_rasters[data] = '../Data/Resampled_Data/PCA_Clay/continent_raster/' \
-                                                  'pca_clay_content.tif'
-                    print('PCA of clay content exists')
+            processing_jobs['gee_' + data] = {'func': process_gee_predictor_data,
+                                              'memory_gb': 6 if data == 'Clay_content_PCA' and perform_pca else 2,
+                                              'kwargs': dict(data=data, input_raster=path,
+                                                             resampled_gee_dir=resampled_gee_dir,
+                                                             perform_pca=perform_pca, pca_clay_list=pca_clay_list)}
 
-            elif data == 'MODIS_Land_Use':
-                resampled_raster = prepare_modis_landuse_data(
-                    output_raster='../Data/Resampled_Data/GEE_data_2013_2019/MODIS_Land_Use.tif',
-                    input_raster=Downloaded_list[data])
-                resampled_gee_rasters[data] = resampled_raster
-
-            else:
-                resampled_raster = rename_copy_raster(input_raster=Downloaded_list[data], output_dir=resampled_gee_dir,
-                                                      rename=False)
-                resampled_gee_rasters[data] = resampled_raster
+    # skip_processing only collects existing filepaths, so no worker processes are needed
+    job_results = run_parallel_jobs(processing_jobs, max_workers=1 if skip_processing else max_workers,
+                                    memory_budget_gb=memory_budget_gb)
 
+    if not skip_processing:
+        resampled_gee_rasters = {data: job_results['gee_' + data] for data in Downloaded_list.keys()}
         pickle.dump(resampled_gee_rasters, open(os.path.join(resampled_gee_dir, 'gee_path_dict.pkl'), mode='wb+'))
-
     else:
         resampled_gee_rasters = pickle.load(open(os.path.join(resampled_gee_dir, 'gee_path_dict.pkl'), mode='rb'))
 
-    gfsad_raster, irrigated_meier_raster, giam_gw_raster = prepare_lu_data(gfsad_cropextent, giam_gw, irrigated_meier,
-                                                                           intermediate_dir, outdir_lu, skip_processing)
-
-    sediment_thickness_raster = prepare_sediment_thickness_data(sediment_thickness, intermediate_dir,
-                                                                outdir_sed_thickness, 'Global_Sediment_Thickness.tif',
-                                                                skip_processing)
-
-    clay_thickness_raster = prepare_clay_thickness_data(Clay_200cm, sediment_thickness_raster, outdir_sed_thickness,
-                                                        skip_processing)
-
-    popdensity_raster = prepare_popdensity_data(PopDensity_GPW, outdir_pop, skip_processing)
-
-    river_distance = prepare_river_proximity_data(river_shape, outdir_sw, skip_processing=skip_processing)
-
-    confining_layers = process_global_confining_layer_data(confining_layer, outdir_confining_layer)
+    gfsad_raster = job_results['gfsad'][0]
+    irrigated_meier_raster = job_results['irrigated_meier'][1]
+    giam_gw_raster = job_results['giam_gw'][2]
+    sediment_thickness_raster = job_results['sediment_thickness']
+    clay_thickness_raster = job_results['clay_thickness']
+    popdensity_raster = job_results['popdensity']
+    river_distance = job_results['river_distance']
+    confining_layers = job_results['confining_layers']
 
     return resampled_gee_rasters, gfsad_raster, irrigated_meier_raster, giam_gw_raster, sediment_thickness_raster, \
            clay_thickness_raster, popdensity_raster, river_distance, confining_layers
@@ -1189,9 +1545,7 @@ def prepare_subsidence_raster(input_polygons_dir='../InSAR_Data/Georeferenced_su
                               output_dir='../InSAR_Data/Merged_subsidence_data/final_subsidence_raster',
                               skip_polygon_merge=False, subsidence_column='Class_name', resample_algorithm='near',
                               final_subsidence_raster='Subsidence_training.tif', exclude_georeferenced_areas=None,
-                              process_insar_areas=('California', 'Arizona', 'Pakistan_Quetta', 'Iran_Qazvin',
-                                                   'China_Hebei', 'China_Hefei', 'Colorado'),
-                              polygon_search_criteria='*Subsidence*.shp',
+                              process_insar_areas=None, polygon_search_criteria='*Subsidence*.shp',
                               insar_search_criteria='*reclass_resampled*.tif', already_prepared=False,
                               refraster=referenceraster, merge_coastal_subsidence_data=False):
     """
@@ -1212,8 +1566,8 @@ def prepare_subsidence_raster(input_polygons_dir='../InSAR_Data/Georeferenced_su
                                   tuple pattern ('Bangladesh_GBDelta',)
     polygon_search_criteria : Input subsidence polygon search criteria.
     process_insar_areas : Tuple of insar data regions to be included in the model.
-                          Default set to ('California', 'Arizona', 'Pakistan_Quetta', 'Iran_Qazvin', 'China_Hebei',
-                                          'China_Hefei', 'Colorado')
+                          Default set to None to include all areas in InSAR area registry ('California', 'Arizona',
+                          'Pakistan_Quetta', 'Iran_Qazvin', 'China_Hebei', 'China_Hefei', 'Colorado')
     insar_search_criteria : InSAR data search criteria.
     already_prepared : Set to True if subsidence raster is already prepared.
     refraster : Global Reference raster.
@@ -1252,23 +1606,13 @@ def prepare_subsidence_raster(input_polygons_dir='../InSAR_Data/Georeferenced_su
                                                                    final_subsidence_raster, resolution=0.02)
 
         if merge_coastal_subsidence_data:
-            coastal_raster = rasterize_coastal_subsidence(mean_output_points='../InSAR_Data/Coastal_Subsidence'
-                                                                             '/filtered_mean_point.shp',
-                                                          output_dir='../InSAR_Data/Coastal_Subsidence',
+            coastal_raster = rasterize_coastal_subsidence(output_dir='../InSAR_Data/Coastal_Subsidence',
                                                           input_csv='../InSAR_Data/Coastal_Subsidence/Fig3_data.csv')
             coastal_arr = read_raster_arr_object(coastal_raster, get_file=False)
             ref_arr, ref_file = read_raster_arr_object(refraster)
 
-            # New_classes
-            sub_less_1cm = 1
-            sub_1cm_to_5cm = 5
-            sub_greater_5cm = 10
-            other_values = np.nan
-
-            coastal_arr = np.where(coastal_arr >= 0, other_values, coastal_arr)
-            coastal_arr = np.where(coastal_arr >= -1, sub_less_1cm, coastal_arr)
-            coastal_arr = np.where((coastal_arr < -1) & (coastal_arr >= -5), sub_1cm_to_5cm, coastal_arr)
-            coastal_arr = np.where(coastal_arr < -5, sub_greater_5cm, coastal_arr)
+            coastal_arr = classify_subsidence_arr(coastal_arr).astype(np.float32)
+            coastal_arr[coastal_arr == subsidence_class_nodata] = np.nan
             coastal_arr = coastal_arr.flatten()
 
             final_subsidence_arr = final_subsidence_arr.flatten()
@@ -1296,7 +1640,8 @@ def prepare_subsidence_raster(input_polygons_dir='../InSAR_Data/Georeferenced_su
 def compile_predictors_subsidence_data(gee_data_dict, gfsad_irrigated_area, giam_gw_data, irrigated_meier_data,
                                        sediment_thickness_data, clay_thickness_data, popdensity_data,
                                        river_distance_data, confining_layer_data, subsidence_data,
-                                       output_dir, skip_compiling_predictor_subsidence_data=False):
+                                       output_dir, skip_compiling_predictor_subsidence_data=False,
+                                       ref_raster=referenceraster):
     """
     Compile predictor datasets and subsidence data in a single folder (to be used for creating predictor database)
 
@@ -1313,26 +1658,65 @@ def compile_predictors_subsidence_data(gee_data_dict, gfsad_irrigated_area, giam
     subsidence_data : Resampled subsidence filepath.
     output_dir : Output directory filepath.
     skip_predictor_subsidence_compilation : Set to True if want to skip compiling all the data again.
+    ref_raster : Reference raster filepath. All compiled rasters must be on its grid.
 
     Returns : Output directory filepath.
     """
     if not skip_compiling_predictor_subsidence_data:
-        shutil.rmtree(output_dir, ignore_errors=True)
+        compile_dict = {key + '.tif': path for key, path in gee_data_dict.items()}
+        compile_dict.update({os.path.basename(gfsad_irrigated_area): gfsad_irrigated_area,
+                             os.path.basename(giam_gw_data): giam_gw_data,
+                             'Irrigated_Area_Density2.tif': irrigated_meier_data,
+                             os.path.basename(sediment_thickness_data): sediment_thickness_data,
+                             os.path.basename(clay_thickness_data): clay_thickness_data,
+                             'Population_Density.tif': popdensity_data,
+                             os.path.basename(river_distance_data): river_distance_data,
+                             os.path.basename(confining_layer_data): confining_layer_data,
+                             'Subsidence.tif': subsidence_data})
+
+        # grid alignment is checked from raster headers before anything is written
+        ref_header = read_raster_header(ref_raster)
+        headers = {name: read_raster_header(path) for name, path in compile_dict.items()}
+        misaligned = [compile_dict[name] for name in compile_dict if not is_raster_aligned(headers[name], ref_header)]
+        if misaligned:
+            raise ValueError('Rasters not aligned with the reference raster grid: {}'.format(misaligned))
+
+        # incremental compilation. compile_manifest.json records the source (size, mtime) of each compiled raster so
+        # only new or changed predictors are touched
         makedirs([output_dir])
-
-        for key in gee_data_dict.keys():
-            rename_copy_raster(gee_data_dict[key], output_dir, rename=True, new_name=(key + '.tif'))
-
-        rename_copy_raster(gfsad_irrigated_area, output_dir, rename=False)
-        rename_copy_raster(gfsad_irrigated_area, output_dir, rename=False)
-        rename_copy_raster(giam_gw_data, output_dir, rename=False)
-        rename_copy_raster(irrigated_meier_data, output_dir, rename=True, new_name='Irrigated_Area_Density2.tif')
-        rename_copy_raster(sediment_thickness_data, output_dir, rename=False)
-        rename_copy_raster(clay_thickness_data, output_dir, rename=False)
-        rename_copy_raster(popdensity_data, output_dir, rename=True, new_name='Population_Density.tif')
-        rename_copy_raster(river_distance_data, output_dir, rename=False)
-        rename_copy_raster(confining_layer_data, output_dir, rename=False)
-        rename_copy_raster(subsidence_data, output_dir, rename=True, new_name='Subsidence.tif')
+        manifest_file = os.path.join(output_dir, 'compile_manifest.json')
+        manifest = json.load(open(manifest_file)) if os.path.exists(manifest_file) else {}
+
+        for name, path in compile_dict.items():
+            output_raster = os.path.join(output_dir, name)
+            stat = os.stat(path)
+            source = {'source': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+            entry = manifest.get(name)
+            if entry is not None and os.path.exists(output_raster) and \
+                    all(entry[key] == value for key, value in source.items()):
+                continue
+
+            # rasters already in the output format are linked, others are rewritten (removing old output first so
+            # a link to the source raster isn't written through)
+            if os.path.lexists(output_raster):
+                os.remove(output_raster)
+            if needs_raster_rewrite(headers[name]):
+                rename_copy_raster(path, output_dir, rename=True, new_name=name)
+                method = 'rewrite'
+            else:
+                method = link_file(path, output_raster)
+            manifest[name] = dict(source, method=method)
+            print('Compiled {} ({})'.format(name, method))
+
+        # removing predictors that are no longer compiled
+        for raster in glob(os.path.join(output_dir, '*.tif')):
+            name = os.path.basename(raster)
+            if name not in compile_dict:
+                os.remove(raster)
+                manifest.pop(name, None)
+
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=1)
 
     return output_dir
 
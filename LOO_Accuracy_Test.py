@@ -13,9 +13,11 @@ from shapely.geometry import mapping, MultiPolygon, shape
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import confusion_matrix, accuracy_score, classification_report, \
     precision_score, recall_score, f1_score
-from System_operations import makedirs
+from System_operations import makedirs, run_tasks
+from Training_InSAR_processing import load_insar_area_registry
 from Raster_operations import shapefile_to_raster, mosaic_rasters, read_raster_arr_object, \
-    write_raster, clip_resample_raster_cutline, resample_reproject, extract_raster_array_by_shapefile
+    write_raster, clip_resample_raster_cutline, resample_reproject, extract_raster_array_by_shapefile, \
+    validate_raster_grids
 
 import warnings
 
@@ -156,65 +158,22 @@ def combine_georef_insar_subsidence_raster(input_polygons_dir='../InSAR_Data/Geo
         georef_subsidence_gdf = gpd.read_file(joined_subsidence_polygon)
         num_of_georef_subsidence = len(georef_subsidence_gdf['Area_code'].unique())
 
-        california_area_code = num_of_georef_subsidence + 1
-        arizona_area_code = california_area_code + 1
-        quetta_area_code = arizona_area_code + 1
-        qazvin_area_code = quetta_area_code + 1
-        hebei_area_code = qazvin_area_code + 1
-        hefei_area_code = hebei_area_code + 1
-        colorado_area_code = hefei_area_code + 1
-        coastal_area_code = colorado_area_code + 1
-
-        subsidence_areaname_dict['California'] = california_area_code
-        subsidence_areaname_dict['Arizona'] = arizona_area_code
-        subsidence_areaname_dict['Pakistan_Quetta'] = quetta_area_code
-        subsidence_areaname_dict['Iran_Qazvin'] = qazvin_area_code
-        subsidence_areaname_dict['China_Hebei'] = hebei_area_code
-        subsidence_areaname_dict['China_Hefei'] = hefei_area_code
-        subsidence_areaname_dict['Colorado'] = colorado_area_code
+        # area codes of InSAR areas follow the georeferenced area codes (offsets from InSAR area registry), coastal
+        # subsidence data gets the last code
+        resampled_insar_dir = '../InSAR_Data/Merged_subsidence_data/resampled_insar_data'
+        insar_areas = load_insar_area_registry()
+        for area in insar_areas:
+            area_code = num_of_georef_subsidence + area['area_code_offset']
+            subsidence_areaname_dict[area['name']] = area_code
+            substitute_area_code_on_raster(os.path.join(resampled_insar_dir, area['name'] + '_reclass_resampled.tif'),
+                                           area_code, os.path.join(insar_data_dir, area['name'] + '_area_raster.tif'))
+
+        coastal_area_code = num_of_georef_subsidence + max(area['area_code_offset'] for area in insar_areas) + 1
         subsidence_areaname_dict['Coastal'] = coastal_area_code
-
-        california_subsidence = '../InSAR_Data/Merged_subsidence_data/resampled_insar_data' \
-                                '/California_reclass_resampled.tif'
-        arizona_subsidence = '../InSAR_Data/Merged_subsidence_data/resampled_insar_data/' \
-                             'Arizona_reclass_resampled.tif'
-        quetta_subsidence = '../InSAR_Data/Merged_subsidence_data/resampled_insar_data' \
-                            '/Pakistan_Quetta_reclass_resampled.tif'
-        qazvin_subsidence = '../InSAR_Data/Merged_subsidence_data/resampled_insar_data/' \
-                            'Iran_Qazvin_reclass_resampled.tif'
-        hebei_subsidence = '../InSAR_Data/Merged_subsidence_data/resampled_insar_data/' \
-                           'China_Hebei_reclass_resampled.tif'
-        hefei_subsidence = '../InSAR_Data/Merged_subsidence_data/resampled_insar_data/' \
-                           'China_Hefei_reclass_resampled.tif'
-        colorado_subsidence = '../InSAR_Data/Merged_subsidence_data/resampled_insar_data/' \
-                              'Colorado_reclass_resampled.tif'
-        coastal_subsidence = '../InSAR_Data/Merged_subsidence_data/resampled_insar_data' \
-                             '/Coastal_subsidence.tif'
-
-        substitute_area_code_on_raster(california_subsidence, california_area_code,
-                                       '../Model Run/LOO_Test/InSAR_Data/'
-                                       'interim_working_dir/California_area_raster.tif')
-        substitute_area_code_on_raster(arizona_subsidence, arizona_area_code,
-                                       '../Model Run/LOO_Test/InSAR_Data/'
-                                       'interim_working_dir/Arizona_area_raster.tif')
-        substitute_area_code_on_raster(quetta_subsidence, quetta_area_code,
-                                       '../Model Run/LOO_Test/InSAR_Data/'
-                                       'interim_working_dir/Pakistan_Quetta_area_raster.tif')
-        substitute_area_code_on_raster(qazvin_subsidence, qazvin_area_code,
-                                       '../Model Run/LOO_Test/InSAR_Data/'
-                                       'interim_working_dir/Iran_Qazvin_area_raster.tif')
-        substitute_area_code_on_raster(hebei_subsidence, hebei_area_code,
-                                       '../Model Run/LOO_Test/InSAR_Data/'
-                                       'interim_working_dir/China_Hebei_area_raster.tif')
-        substitute_area_code_on_raster(hefei_subsidence, hefei_area_code,
-                                       '../Model Run/LOO_Test/InSAR_Data/'
-                                       'interim_working_dir/China_Hefei_area_raster.tif')
-        substitute_area_code_on_raster(colorado_subsidence, colorado_area_code,
-                                       '../Model Run/LOO_Test/InSAR_Data/'
-                                       'interim_working_dir/Colorado_area_raster.tif')
-        coastal_raster_area_coded = substitute_area_code_on_raster(coastal_subsidence, coastal_area_code,
-                                                                   '../Model Run/LOO_Test/InSAR_Data/'
-                                                                   'interim_working_dir/Coastal_raster.tif')
+        coastal_raster_area_coded = substitute_area_code_on_raster(os.path.join(resampled_insar_dir,
+                                                                                'Coastal_subsidence.tif'),
+                                                                   coastal_area_code,
+                                                                   os.path.join(insar_data_dir, 'Coastal_raster.tif'))
 
         mosaic_rasters(insar_data_dir, output_dir=insar_data_dir, raster_name='interim_insar_Area_data.tif',
                        ref_raster=refraster, search_by='*area_raster.tif', resolution=0.02)
@@ -251,7 +210,7 @@ def combine_georef_insar_subsidence_raster(input_polygons_dir='../InSAR_Data/Geo
 
 def create_traintest_df_loo_accuracy(input_raster_dir, subsidence_areacode_dict, exclude_columns,
                                      output_dir='../Model Run/LOO_Test/Predictors_csv',
-                                     search_by='*.tif', skip_dataframe_creation=False):
+                                     search_by='*.tif', skip_dataframe_creation=False, fix_grid_mismatch=False):
     """
     create dataframe from predictor rasters along with area code.
 
@@ -263,12 +222,15 @@ def create_traintest_df_loo_accuracy(input_raster_dir, subsidence_areacode_dict,
     output_dir : Output directory path.
     search_by : Input raster search criteria. Defaults to '*.tif'.
     skip_predictor_subsidence_compilation : Set to True if want to skip processing.
+    fix_grid_mismatch : Set to True to warp predictors that aren't on the reference grid (see
+                        validate_raster_grids()). Default set to False to only fail on mismatch.
 
     Returns: predictor_df dataframe created from predictor rasters.
     """
     print('Creating area coded predictors csv...')
     if not skip_dataframe_creation:
-        predictors = glob(os.path.join(input_raster_dir, search_by))
+        # header-only grid check fails fast before any predictor array is read
+        predictors = validate_raster_grids(input_raster_dir, search_by, fix_mismatch=fix_grid_mismatch)
 
         predictor_dict = {}
         for predictor in predictors:
@@ -519,7 +481,10 @@ def create_prediction_raster(predictors_dir, fitted_model, yearlist=(2013, 2019)
              Subsidence prediction probability raster (if prediction_probability=True).
     """
     global raster_file
-    predictor_rasters = glob(os.path.join(predictors_dir, search_by))
+    if not predictor_csv_exists:
+        predictor_rasters = validate_raster_grids(predictors_dir, search_by)  # fail fast before clipping
+    else:
+        predictor_rasters = glob(os.path.join(predictors_dir, search_by))
     continent_shapes = glob(os.path.join(continent_shapes_dir, continent_search_by))
     drop_columns = list(exclude_columns) + [pred_attr]
 
@@ -827,44 +792,66 @@ def categorize_based_on_probability(run=False):
     loo_accuracy_df.to_excel('../Model Run/Stats/LOO_accuracy_stat.xlsx')
 
 
-def run_loao_test_models(run_loao_test=True, subsidence_data_already_prepared=False, skip_polygon_processing=False,
-                         skip_dataframe_creation=False, exclude_predictors=(), predictor_csv_exists=False):
+def run_loao_test_models(run_loao_test=True, exclude_predictors=(), force_tasks=()):
     """
-    Runs LOAO test models.
+    Runs LOAO test models. Each stage is a cached task (see System_operations.run_tasks()), so a stage re-runs only
+    if its input files or parameters changed since the last run.
 
     Parameters:
     run_loao_test : Default set to True to run Leave-One-Area-Out (LOAO) test models.
-    subsidence_data_already_prepared : Default set to False to prepare subsidence dataset.
-    skip_polygon_processing :Set to True to georeferenced polygon merging during preparing subsidence dataset.
-                             Default set to False.
-    skip_dataframe_creation : Set to True if want to skip train-test dataset creation. Default set to False.
     exclude_predictors : Tuple of predictor names to exclude.
-    predictor_csv_exists : Set to False if any change is made in predictor combination. At least need to be False
-                           during running one for first regions. Then the code can be stopped and run again setting this
-                           parameter as True to save model running time significantly.
+    force_tasks : Tuple of task names to re-run irrespective of the cache ('loao_subsidence_raster',
+                  'loao_predictor_csv', 'loao_test', 'loao_reports').
 
     Returns: Prediction rasters and accuracy results for all model runs.
     """
     if run_loao_test:
-        subsidence_raster, areaname_dict = \
-            combine_georef_insar_subsidence_raster(already_prepared=subsidence_data_already_prepared,  # #
-                                                   skip_polygon_processing=skip_polygon_processing)  # #
-
         predictor_raster_dir = '../Model Run/Predictors_2013_2019'
+        predictor_rasters = glob(os.path.join(predictor_raster_dir, '*.tif'))
+        insar_rasters = ['../InSAR_Data/Merged_subsidence_data/resampled_insar_data/{}_reclass_resampled.tif'.format(
+            area['name']) for area in load_insar_area_registry()] + \
+            ['../InSAR_Data/Merged_subsidence_data/resampled_insar_data/Coastal_subsidence.tif']
+        subsidence_raster_dir = '../Model Run/LOO_Test/InSAR_Data/final_subsidence_raster'
+        accuracy_dir = '../Model Run/LOO_Test/Accuracy_score'
         exclude_predictors = list(exclude_predictors)
 
-        df, predictor_csv = create_traintest_df_loo_accuracy(predictor_raster_dir, areaname_dict, exclude_predictors,
-                                                             skip_dataframe_creation=skip_dataframe_creation)  # #
-
-        run_loo_accuracy_test(predictor_dataframe_csv=predictor_csv, exclude_predictors_list=exclude_predictors,
-                              n_estimators=300, max_depth=14, max_features=7, min_samples_leaf=1e-05,
-                              min_samples_split=7, class_weight='balanced',
-                              predictor_raster_directory='../Model Run/Predictors_2013_2019',
-                              skip_create_prediction_raster=False,  # #
-                              predictor_csv_exists=predictor_csv_exists,  # #
-                              predict_probability_greater_1cm=True)  # #
-
-        concat_classification_reports(classification_csv_dir='../Model Run/LOO_Test/Accuracy_score')
+        loao_tasks = {
+            'loao_subsidence_raster': {
+                'func': combine_georef_insar_subsidence_raster,
+                'inputs': ['../InSAR_Data/Georeferenced_subsidence_data'] + insar_rasters,
+                'outputs': [os.path.join(subsidence_raster_dir, 'Subsidence_area_coded.tif'),
+                            os.path.join(subsidence_raster_dir, 'subsidence_areaname_dict.pkl')],
+                'params': dict(output_dir=subsidence_raster_dir, already_prepared=False,
+                               skip_polygon_processing=False)},
+            'loao_predictor_csv': {
+                'func': create_traintest_df_loo_accuracy,
+                'depends_on': ['loao_subsidence_raster'],
+                'inputs': lambda results: predictor_rasters + [results['loao_subsidence_raster'][0]],
+                'outputs': ['../Model Run/LOO_Test/Predictors_csv/train_test_area_coded_2013_2019.csv'],
+                'params': dict(input_raster_dir=predictor_raster_dir,
+                               subsidence_areacode_dict=lambda results: results['loao_subsidence_raster'][1],
+                               exclude_columns=exclude_predictors, skip_dataframe_creation=False)},
+            'loao_test': {
+                'func': run_loo_accuracy_test,
+                'depends_on': ['loao_predictor_csv'],
+                'inputs': lambda results: predictor_rasters + [results['loao_predictor_csv'][1]],
+                'outputs': [accuracy_dir, '../Model Run/LOO_Test/Prediction_rasters'],
+                'params': dict(predictor_dataframe_csv=lambda results: results['loao_predictor_csv'][1],
+                               exclude_predictors_list=exclude_predictors,
+                               n_estimators=300, max_depth=14, max_features=7, min_samples_leaf=1e-05,
+                               min_samples_split=7, class_weight='balanced',
+                               predictor_raster_directory=predictor_raster_dir,
+                               skip_create_prediction_raster=False,  # #
+                               predictor_csv_exists=False,
+                               predict_probability_greater_1cm=True)},  # #
+            'loao_reports': {
+                'func': concat_classification_reports,
+                'depends_on': ['loao_test'],
+                'inputs': lambda results: glob(accuracy_dir + '/' + '*classification_report*.csv'),
+                'outputs': [accuracy_dir + '/Accuracy_Reports_Joined/Classification_reports_joined.csv'],
+                'params': dict(classification_csv_dir=accuracy_dir)}
+        }
+        run_tasks(loao_tasks, max_workers=1, force=force_tasks)
 
 
 # LOAO Accuracy Test Run
@@ -875,10 +862,10 @@ exclude_predictor = ('Alexi ET', 'Grace', 'MODIS ET (kg/m2)', 'Irrigated Area De
 
 # Set random forest parameters manually in the function from main model hyperparameter tuning. Not added in the function
 # variables for maintaining simplicity.
-run_loao_test_models(run_loao_test=True,  # Set to False to skip loao test run
-                                           # and only to run categorize_based_on_probability()
-                     subsidence_data_already_prepared=True, skip_polygon_processing=True,
-                     skip_dataframe_creation=True, exclude_predictors=exclude_predictor, predictor_csv_exists=True)
+if __name__ == '__main__':
+    run_loao_test_models(run_loao_test=True,  # Set to False to skip loao test run
+                                               # and only to run categorize_based_on_probability()
+                         exclude_predictors=exclude_predictor)
 
-# Categorizing LOAO Test Results
-categorize_based_on_probability(run=True)
+    # Categorizing LOAO Test Results
+    categorize_based_on_probability(run=True)
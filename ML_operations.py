@@ -34,7 +34,8 @@ def reindex_df(df):
     return df
 
 
-def create_dataframe(input_raster_dir, output_csv, search_by='*.tif', skip_dataframe_creation=False):
+def create_dataframe(input_raster_dir, output_csv, search_by='*.tif', skip_dataframe_creation=False,
+                     fix_grid_mismatch=False):
     """
     create dataframe from predictor rasters.
 
@@ -43,6 +44,8 @@ def create_dataframe(input_raster_dir, output_csv, search_by='*.tif', skip_dataf
     output_csv : Output csv file with filepath.
     search_by : Input raster search criteria. Defaults to '*.tif'.
     skip_predictor_subsidence_compilation : Set to True if want to skip processing.
+    fix_grid_mismatch : Set to True to warp predictors that aren't on the reference grid (see
+                        validate_raster_grids()). Default set to False to only fail on mismatch.
 
     Returns: predictor_df dataframe created from predictor rasters.
     """
@@ -64,7 +67,8 @@ def create_dataframe(input_raster_dir, output_csv, search_by='*.tif', skip_dataf
                              'River_distance': 'River Distance (km)', 'Confining_layers': 'Confining Layers'}
 
     if not skip_dataframe_creation:
-        predictors = glob(os.path.join(input_raster_dir, search_by))
+        # header-only grid check fails fast before any predictor array is read
+        predictors = validate_raster_grids(input_raster_dir, search_by, fix_mismatch=fix_grid_mismatch)
 
         predictor_dict = {}
         for predictor in predictors:
@@ -711,7 +715,10 @@ def create_prediction_raster(predictors_dir, model, predictor_name_dict, yearlis
              Subsidence prediction probability raster (if prediction_probability=True).
     """
     global raster_file
-    predictor_rasters = glob(os.path.join(predictors_dir, search_by))
+    if not predictor_csv_exists:
+        predictor_rasters = validate_raster_grids(predictors_dir, search_by)  # fail fast before clipping
+    else:
+        predictor_rasters = glob(os.path.join(predictors_dir, search_by))
     continent_shapes = glob(os.path.join(continent_shapes_dir, continent_search_by))
     drop_columns = list(exclude_columns) + [pred_attr]
 
@@ -5,6 +5,7 @@ import timeit
 import warnings
 from Data_operations import *
 from ML_operations import *
+from Training_InSAR_processing import load_insar_area_registry
 
 
 warnings.simplefilter(action='ignore', category=FutureWarning)  # to ignore future warning coming from pandas
@@ -32,58 +33,25 @@ outdir_sw = '../Data/Resampled_Data/Surface_Water'
 confining_layer = '../Data/Raw_Data/Global_confining_layer/global_confining_layer.tif'
 outdir_confining_layers = '../Data/Resampled_Data/Global_confining_layers'
 
-# skip_download = False if new data needs to be downloaded from google earth engine
-# skip_processing = False if processing of already downloaded data (secondary processing) is required
-gee_raster_dict, gfsad_raster, irrigated_meier_raster, giam_gw_raster, \
-    sediment_thickness_raster, clay_thickness_raster, popdensity_raster, river_distance, confining_layers = \
-    download_process_predictor_datasets(yearlist, start_month, end_month, resampled_dir,
-                                        gfsad_lu, giam_lu, irrigated_meier, intermediate_dir,
-                                        outdir_lu, sediment_thickness, outdir_sed_thickness,
-                                        outdir_pop, river_shape, outdir_sw, confining_layer, outdir_confining_layers,
-                                        perform_pca=False,  # #
-                                        skip_download=True, skip_processing=True,  # #
-                                        geedatalist=gee_data_list, downloadcsv=csv, gee_scale=2000)
-
 input_polygons_dir = '../InSAR_Data/Georeferenced_subsidence_data'
 joined_subsidence_polygon = '../InSAR_Data/Merged_subsidence_data/interim_working_dir/georef_subsidence_polygons.shp'
 insar_data_dir = '../InSAR_Data/Merged_subsidence_data/resampled_insar_data'
 interim_dir = '../InSAR_Data/Merged_subsidence_data/interim_working_dir'
 training_insar_dir = '../InSAR_Data/Merged_subsidence_data/final_subsidence_raster'
+insar_areas = load_insar_area_registry()  # InSAR areas and their raw rasters from InSAR_area_registry.json
+insar_inputs = [area['raster'] for area in insar_areas] + ['../InSAR_Data/Coastal_Subsidence/Fig3_data.csv']
 
-# skip_polygon_merge = False if new georeferenced subsidence polygons needs to be added
-# already prepared = False if new georeferenced subsidence polygons needs to be added or new InSAR processed subsidence
-# data has o be integrated
 exclude_areas = None  # if all areas are to be included, set None.
-include_insar_areas = ('California', 'Arizona', 'Pakistan_Quetta', 'Iran_Qazvin', 'China_Hebei', 'China_Hefei',
-                       'Colorado')
-subsidence_raster = prepare_subsidence_raster(input_polygons_dir, joined_subsidence_polygon,
-                                              insar_data_dir, interim_dir, training_insar_dir,
-                                              subsidence_column='Class_name', resample_algorithm='near',
-                                              polygon_search_criteria='*Subsidence*.shp',
-                                              insar_search_criteria='*reclass_resampled*.tif',
-                                              exclude_georeferenced_areas=exclude_areas,
-                                              process_insar_areas=include_insar_areas,
-                                              skip_polygon_merge=True,  # #
-                                              already_prepared=True,  # #
-                                              merge_coastal_subsidence_data=True)
-
-predictor_dir = '../Model Run/Predictors_2013_2019'
+include_insar_areas = tuple(area['name'] for area in insar_areas)
 
-# skip_compiling_predictor_subsidence_data = False if any change in predictors or subsidence data are made
-predictor_dir = compile_predictors_subsidence_data(gee_raster_dict, gfsad_raster, giam_gw_raster,
-                                                   irrigated_meier_raster, sediment_thickness_raster,
-                                                   clay_thickness_raster, popdensity_raster,
-                                                   river_distance, confining_layers, subsidence_raster, predictor_dir,
-                                                   skip_compiling_predictor_subsidence_data=True)  # #
+gee_download_dir = '../Data/Raw_Data/GEE_data'  # read by download_data() with skip_download=True
+alexi_et_dir = '../Data/Raw_Data/Alexi_ET/mean_rasters'
 
+predictor_dir = '../Model Run/Predictors_2013_2019'
 csv_dir = '../Model Run/Predictors_csv'
 makedirs([csv_dir])
 train_test_csv = '../Model Run/Predictors_csv/train_test_2013_2019.csv'
 
-# skip_dataframe_creation = False if any change occur in predictors or subsidence data
-predictor_df = create_dataframe(predictor_dir, train_test_csv, search_by='*.tif',
-                                skip_dataframe_creation=True)  # #
-
 modeldir = '../Model Run/Model'
 model = 'rf'
 
@@ -99,39 +67,115 @@ variables_in_pdp = ('Clay Thickness (m)', 'Irrigated Area Density', 'Population
                     'Soil moisture (mm)', 'TRCLM ET (mm)',  'River Distance (km)', 'Confining Layers')
 
 prediction_raster_keyword = 'RF127'
-
-# predictor_importance = False if predictor importance plot is not required
-# plot_pdp = False if partial dependence plots are not required
-# plot_confusion_matrix = False if confusion matrix plot (as image) is not required
-ML_model, predictor_name_dict = \
-    build_ml_classifier(train_test_csv, modeldir, exclude_columns, model, load_model=False,
-                        pred_attr='Subsidence', test_size=0.3, random_state=0, output_dir=csv_dir,
-                        n_estimators=300, min_samples_leaf=1e-05, min_samples_split=7, max_depth=14,
-                        max_features=7, class_weight='balanced',
-                        max_samples=None, max_leaf_nodes=None,
-                        predictor_imp_keyword=prediction_raster_keyword,
-                        predictor_importance=True,  # #
-                        variables_pdp=variables_in_pdp, plot_pdp=True,  # #
-                        plot_confusion_matrix=True,  # #
-                        tune_hyperparameter=False,  # #
-                        k_fold=5, n_iter=80,
-                        random_searchCV=True)  # #
-
 predictors_dir = '../Model Run/Predictors_2013_2019'
-
-# predictor_csv_exists =  False if new predictor has been added so new data has to be added or predictor
-# combination changes
-# filter_by_crop_builtup = False if don't want to filter by irrigation and population density threshold
-# predictor_probability_greater_1cm = False if probability plot is not required
-create_prediction_raster(predictors_dir, ML_model, predictor_name_dict, yearlist=[2013, 2019], search_by='*.tif',
-                         continent_search_by='*continent.shp',
-                         continent_shapes_dir='../Data/Reference_rasters_shapes/continent_extents',
-                         prediction_raster_dir='../Model Run/Prediction_rasters', exclude_columns=exclude_columns,
-                         pred_attr='Subsidence', prediction_raster_keyword=prediction_raster_keyword,
-                         predictor_csv_exists=False,  # #
-                         predict_probability_greater_1cm=True)  # #
-
-model_runtime = True
-if model_runtime:
-    stop = timeit.default_timer()
-    print('Model Run Time :', round((stop - start) / 60, 2), 'min')
+prediction_raster_dir = '../Model Run/Prediction_rasters'
+
+# Each stage is a cached task (see System_operations.run_tasks()). A task re-runs only if its parameters, input files
+# or the code modules it reaches (the task function's module and the code modules that one imports, so helper
+# functions are tracked) changed since the last run. Add a task name to force_tasks to re-run it anyway. Predictor
+# inputs are the top level rasters only, as create_prediction_raster() writes clipped continent rasters in sub-folders.
+# GEE downloads stay off (skip_download=True) as the cache can't tell whether GEE data changed on the server. The
+# downloaded GEE and Alexi ET rasters are task inputs, so the predictors are re-processed when they change on disk.
+# To download new GEE data, set skip_download=False in 'predictor_datasets' (this changes the task key, so it
+# re-runs), and set it back to True afterwards. The resampled InSAR rasters are rebuilt from the raw InSAR rasters
+# (inputs) on every run of 'subsidence_raster', so insar_data_dir is one of its outputs.
+force_tasks = ()
+
+
+def predictor_dataset(index):
+    # download_process_predictor_datasets() returns (gee_raster_dict, gfsad_raster, irrigated_meier_raster,
+    # giam_gw_raster, sediment_thickness_raster, clay_thickness_raster, popdensity_raster, river_distance,
+    # confining_layers)
+    return lambda results: results['predictor_datasets'][index]
+
+
+model_tasks = {
+    'predictor_datasets': {
+        'func': download_process_predictor_datasets,
+        'inputs': [gfsad_lu, giam_lu, irrigated_meier, sediment_thickness, river_shape, confining_layer, csv,
+                   gee_download_dir, alexi_et_dir, referenceraster],
+        'outputs': [resampled_dir, outdir_lu, outdir_sed_thickness, outdir_pop, outdir_sw, outdir_confining_layers],
+        'params': dict(yearlist=yearlist, start_month=start_month, end_month=end_month,
+                       resampled_gee_dir=resampled_dir, gfsad_cropextent=gfsad_lu, giam_gw=giam_lu,
+                       irrigated_meier=irrigated_meier, intermediate_dir=intermediate_dir, outdir_lu=outdir_lu,
+                       sediment_thickness=sediment_thickness, outdir_sed_thickness=outdir_sed_thickness,
+                       outdir_pop=outdir_pop, river_shape=river_shape, outdir_sw=outdir_sw,
+                       confining_layer=confining_layer, outdir_confining_layer=outdir_confining_layers,
+                       perform_pca=False, skip_download=True, skip_processing=False,
+                       geedatalist=gee_data_list, downloadcsv=csv, gee_scale=2000, max_workers=4,
+                       memory_budget_gb=16)},
+    'subsidence_raster': {
+        'func': prepare_subsidence_raster,
+        'inputs': [input_polygons_dir, referenceraster] + insar_inputs,
+        'outputs': [os.path.join(training_insar_dir, 'Subsidence_training.tif'), insar_data_dir],
+        'params': dict(input_polygons_dir=input_polygons_dir, joined_subsidence_polygon=joined_subsidence_polygon,
+                       insar_data_dir=insar_data_dir, interim_dir=interim_dir, output_dir=training_insar_dir,
+                       subsidence_column='Class_name', resample_algorithm='near',
+                       polygon_search_criteria='*Subsidence*.shp', insar_search_criteria='*reclass_resampled*.tif',
+                       exclude_georeferenced_areas=exclude_areas, process_insar_areas=include_insar_areas,
+                       skip_polygon_merge=False, already_prepared=False, merge_coastal_subsidence_data=True)},
+    'predictor_stack': {
+        'func': compile_predictors_subsidence_data,
+        'depends_on': ['predictor_datasets', 'subsidence_raster'],
+        'inputs': lambda results: list(results['predictor_datasets'][0].values()) +
+                                  list(results['predictor_datasets'][1:]) + [results['subsidence_raster']],
+        'outputs': [predictor_dir],
+        'params': dict(gee_data_dict=predictor_dataset(0), gfsad_irrigated_area=predictor_dataset(1),
+                       irrigated_meier_data=predictor_dataset(2), giam_gw_data=predictor_dataset(3),
+                       sediment_thickness_data=predictor_dataset(4), clay_thickness_data=predictor_dataset(5),
+                       popdensity_data=predictor_dataset(6), river_distance_data=predictor_dataset(7),
+                       confining_layer_data=predictor_dataset(8),
+                       subsidence_data=lambda results: results['subsidence_raster'], output_dir=predictor_dir,
+                       skip_compiling_predictor_subsidence_data=False)},
+    'predictor_csv': {
+        'func': create_dataframe,
+        'depends_on': ['predictor_stack'],
+        'inputs': lambda results: glob(os.path.join(predictor_dir, '*.tif')),
+        'outputs': [train_test_csv],
+        'params': dict(input_raster_dir=predictor_dir, output_csv=train_test_csv, search_by='*.tif',
+                       skip_dataframe_creation=False)},
+    # predictor_importance = False if predictor importance plot is not required
+    # plot_pdp = False if partial dependence plots are not required
+    # plot_confusion_matrix = False if confusion matrix plot (as image) is not required
+    'ml_model': {
+        'func': build_ml_classifier,
+        'depends_on': ['predictor_csv'],
+        'inputs': [train_test_csv],
+        'outputs': [modeldir],
+        'params': dict(predictor_csv=train_test_csv, modeldir=modeldir, exclude_columns=exclude_columns, model=model,
+                       load_model=False, pred_attr='Subsidence', test_size=0.3, random_state=0, output_dir=csv_dir,
+                       n_estimators=300, min_samples_leaf=1e-05, min_samples_split=7, max_depth=14,
+                       max_features=7, class_weight='balanced',
+                       max_samples=None, max_leaf_nodes=None,
+                       predictor_imp_keyword=prediction_raster_keyword,
+                       predictor_importance=True,  # #
+                       variables_pdp=variables_in_pdp, plot_pdp=True,  # #
+                       plot_confusion_matrix=True,  # #
+                       tune_hyperparameter=False,  # #
+                       k_fold=5, n_iter=80,
+                       random_searchCV=True)},  # #
+    # filter_by_crop_builtup = False if don't want to filter by irrigation and population density threshold
+    # predictor_probability_greater_1cm = False if probability plot is not required
+    'prediction_raster': {
+        'func': create_prediction_raster,
+        'depends_on': ['ml_model'],
+        'inputs': lambda results: glob(os.path.join(predictors_dir, '*.tif')) + [modeldir],
+        'outputs': [prediction_raster_dir],
+        'params': dict(predictors_dir=predictors_dir, model=lambda results: results['ml_model'][0],
+                       predictor_name_dict=lambda results: results['ml_model'][1], yearlist=[2013, 2019],
+                       search_by='*.tif', continent_search_by='*continent.shp',
+                       continent_shapes_dir='../Data/Reference_rasters_shapes/continent_extents',
+                       prediction_raster_dir=prediction_raster_dir, exclude_columns=exclude_columns,
+                       pred_attr='Subsidence', prediction_raster_keyword=prediction_raster_keyword,
+                       predictor_csv_exists=False,
+                       predict_probability_greater_1cm=True)},  # #
+}
+
+# the guard keeps worker processes of the predictor processing jobs (spawned on Windows) from re-running the model
+if __name__ == '__main__':
+    task_results = run_tasks(model_tasks, max_workers=2, force=force_tasks)
+
+    model_runtime = True
+    if model_runtime:
+        stop = timeit.default_timer()
+        print('Model Run Time :', round((stop - start) / 60, 2), 'min')
@@ -3,18 +3,179 @@
 
 import os
 import numpy as np
-import pandas as pd
+import rasterio as rio
 from glob import glob
-from Raster_operations import write_raster, clip_resample_raster_cutline, mosaic_rasters
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
+from rasterio.windows import Window
+from Raster_operations import write_raster, clip_resample_raster_cutline, mosaic_rasters, read_raster_block, \
+    read_raster_header, is_raster_aligned
 from System_operations import makedirs
 
 No_Data_Value = -9999
 
 
+def iterate_raster_stack_blocks(raster_files, block_rows=256):
+    """
+    Iterate over row blocks of a stack of aligned rasters, yielding the pixels valid (not nan) in all rasters.
+
+    Parameters:
+    raster_files : List of opened (rasterio) aligned raster objects.
+    block_rows : Number of raster rows read in each block. Defaults to 256.
+
+    Returns : Generator of (row_start, num_rows, valid_mask, stack) where valid_mask is the (num_rows, width) combined
+              valid pixel mask and stack is the (n_valid_pixels, n_rasters) float32 array of valid pixels.
+    """
+    height = raster_files[0].height
+    for row_start in range(0, height, block_rows):
+        num_rows = min(block_rows, height - row_start)
+        blocks = [read_raster_block(raster_file, row_start, num_rows) for raster_file in raster_files]
+        valid_mask = np.logical_and.reduce([~np.isnan(block) for block in blocks])
+        stack = np.stack([block[valid_mask] for block in blocks], axis=1)
+        yield row_start, num_rows, valid_mask, stack
+
+
+def accumulate_pca_moments(stack_blocks):
+    """
+    Accumulate first and second moments of a multi-band pixel stack in one pass. Moments are accumulated in float64
+    around a pivot (mean of the first non-empty block) to avoid cancellation in the covariance.
+
+    Parameters:
+    stack_blocks : Iterable of (n_pixels, n_bands) arrays of valid pixels.
+
+    Returns : Pixel count, band mean (n_bands,) and band covariance matrix (n_bands, n_bands).
+    """
+    count, pivot, sum_x, sum_xx = 0, None, None, None
+    for stack in stack_blocks:
+        if stack.shape[0] == 0:
+            continue
+        if pivot is None:
+            pivot = stack.mean(axis=0, dtype=np.float64)
+            sum_x = np.zeros(stack.shape[1])
+            sum_xx = np.zeros((stack.shape[1], stack.shape[1]))
+        centered = stack.astype(np.float64) - pivot
+        count += stack.shape[0]
+        sum_x += centered.sum(axis=0)
+        sum_xx += centered.T @ centered
+
+    if count == 0:
+        raise ValueError('No pixel is valid in all PCA rasters')
+
+    shifted_mean = sum_x / count
+    covariance = sum_xx / count - np.outer(shifted_mean, shifted_mean)
+    return count, pivot + shifted_mean, covariance
+
+
+def pca_from_moments(mean, covariance):
+    """
+    Standardized PCA (same as StandardScaler followed by PCA) from band mean and covariance, by eigen-decomposing the
+    correlation matrix.
+
+    Parameters:
+    mean : Band mean (n_bands,).
+    covariance : Band covariance matrix (n_bands, n_bands).
+
+    Returns : Projection weights (n_bands, n_bands) and offsets (n_bands,) so that
+              component = stack @ weights + offsets, and explained variance ratio of each component.
+    """
+    std = np.sqrt(np.diag(covariance))
+    std[std == 0] = 1  # constant bands (as StandardScaler)
+    correlation = covariance / np.outer(std, std)
+
+    eigen_values, eigen_vectors = np.linalg.eigh(correlation)
+    order = np.argsort(eigen_values)[::-1]
+    eigen_values, eigen_vectors = np.clip(eigen_values[order], 0, None), eigen_vectors[:, order]
+
+    # deterministic sign: largest absolute loading of each component is positive
+    signs = np.sign(eigen_vectors[np.abs(eigen_vectors).argmax(axis=0), np.arange(eigen_vectors.shape[1])])
+    eigen_vectors = eigen_vectors * signs
+
+    weights = eigen_vectors / std[:, np.newaxis]
+    offsets = -mean @ weights
+    explained_variance_ratio = eigen_values / eigen_values.sum()
+    return weights, offsets, explained_variance_ratio
+
+
+def project_pca_component(stack, weights, offsets, component=0):
+    """
+    Project a pixel stack on a principal component as a single fused (standardize + rotate) operation.
+
+    Parameters:
+    stack : (n_pixels, n_bands) float32 array of valid pixels.
+    weights : Projection weights from pca_from_moments().
+    offsets : Projection offsets from pca_from_moments().
+    component : Index of the principal component. Defaults to 0 (first component).
+
+    Returns : float32 array of component values.
+    """
+    return stack @ weights[:, component].astype(np.float32) + np.float32(offsets[component])
+
+
+def perform_pca_clay_global(pca_raster_list, output_raster, block_rows=256, nodata=No_Data_Value):
+    """
+    Perform PCA of clay content rasters with a single global basis, streaming over row blocks so memory stays bounded.
+    Band mean and covariance of the pixels valid in all rasters are accumulated in one pass, the PCA basis comes from
+    the 6x6 correlation matrix, then the first principal component is projected block by block into one global raster
+    (no continental seams).
+
+    Parameters:
+    pca_raster_list : List of aligned clay content raster filepaths.
+    output_raster : Output first principal component raster filepath.
+    block_rows : Number of raster rows processed in each block. Defaults to 256.
+    nodata : No data value of the output raster. Default set to -9999.
+
+    Returns : First principal component raster filepath.
+    """
+    ref_header = read_raster_header(pca_raster_list[0])
+    misaligned = [raster for raster in pca_raster_list if not is_raster_aligned(read_raster_header(raster), ref_header)]
+    if misaligned:
+        raise ValueError('Clay content rasters not aligned with {}: {}'.format(pca_raster_list[0], misaligned))
+
+    raster_files = [rio.open(raster) for raster in pca_raster_list]
+
+    count, mean, covariance = accumulate_pca_moments(
+        stack for _, _, _, stack in iterate_raster_stack_blocks(raster_files, block_rows))
+    weights, offsets, explained_variance_ratio = pca_from_moments(mean, covariance)
+    print('PCA fitted on {} pixels. Explained variance ratio: {}'.format(count, np.round(explained_variance_ratio, 4)))
+
+    if os.path.dirname(output_raster):
+        makedirs([os.path.dirname(output_raster)])
+    profile = dict(driver='GTiff', height=ref_header['shape'][0], width=ref_header['shape'][1], count=1,
+                   dtype='float32', crs=ref_header['crs'], transform=ref_header['transform'], nodata=nodata)
+    with rio.open(output_raster, 'w', **profile) as dst:
+        for row_start, num_rows, valid_mask, stack in iterate_raster_stack_blocks(raster_files, block_rows):
+            component_block = np.full(valid_mask.shape, nodata, dtype=np.float32)
+            if stack.shape[0] > 0:
+                component_block[valid_mask] = project_pca_component(stack, weights, offsets)
+            dst.write(component_block, 1, window=Window(0, row_start, profile['width'], num_rows))
+
+    for raster_file in raster_files:
+        raster_file.close()
+
+    return output_raster
+
+
 def perform_pca_clay(pca_raster_list, dict_keyword_list=None, output_raster_dir='../Data/Resampled_Data/PCA_Clay',
-                     deconstruct_pca=False):
+                     deconstruct_pca=False, global_basis=False, block_rows=256):
+    """
+    Perform PCA of clay content rasters (0, 10, 30, 60, 100, 200cm) and save the first principal component as raster.
+
+    Parameters:
+    pca_raster_list : List of clay content raster filepaths.
+    dict_keyword_list : List of clay content names for the rasters in pca_raster_list.
+    output_raster_dir : Output raster directory. Default set to '../Data/Resampled_Data/PCA_Clay'.
+    deconstruct_pca : Set to True to skip mosaicking the continent PCA rasters (continent-wise PCA only).
+    global_basis : Set to True to fit a single global PCA basis by streaming over row blocks (see
+                   perform_pca_clay_global()). Default set to False to fit PCA separately for each continent.
+    block_rows : Number of raster rows processed in each block when global_basis=True. Defaults to 256.
+
+    Returns : First principal component raster filepath.
+    """
+    if global_basis:
+        # saved at the same filepath as the mosaicked continent-wise result so downstream paths don't change
+        pca_raster = os.path.join(output_raster_dir, 'continent_raster', 'pca_clay_content.tif')
+        pca_raster = perform_pca_clay_global(pca_raster_list, pca_raster, block_rows=block_rows)
+        print('PCA Clay results saved as raster')
+        return pca_raster
+
     if dict_keyword_list is None:
         dict_keyword_list = ['clay_0cm', 'clay_10cm', 'clay_30cm', 'clay_60cm', 'clay_100cm', 'clay_200cm']
 
@@ -41,41 +202,17 @@ def perform_pca_clay(pca_raster_list, dict_keyword_list=None, output_raster_dir=
         clay_200cm_arr, clay_200cm_file = clip_resample_raster_cutline(pca_rasters_dict['clay_200cm'],
                                                                        output_raster_dir, shape)
 
-        raster_shape = clay_0cm_arr.shape
-
-        data_dict = {'clay_0cm': clay_0cm_arr.flatten(), 'clay_10cm': clay_10cm_arr.flatten(),
-                     'clay_30cm': clay_30cm_arr.flatten(), 'clay_60cm': clay_60cm_arr.flatten(),
-                     'clay_100cm': clay_100cm_arr.flatten(), 'clay_200cm': clay_200cm_arr.flatten()}
-
-        nan_pos_dict = {}
-        modified_data_dict = {}
-        for key, array in data_dict.items():
-            nan_pos_dict[key] = np.isnan(array)
-            array[nan_pos_dict[key]] = 0
-            modified_data_dict[key] = array
-
-        clay_0cm = pd.Series(modified_data_dict['clay_0cm'])
-        clay_10cm = pd.Series(modified_data_dict['clay_10cm'])
-        clay_30cm = pd.Series(modified_data_dict['clay_30cm'])
-        clay_60cm = pd.Series(modified_data_dict['clay_60cm'])
-        clay_100cm = pd.Series(modified_data_dict['clay_100cm'])
-        clay_200cm = pd.Series(modified_data_dict['clay_200cm'])
-
-        final_data_dict = {'clay_0cm': clay_0cm, 'clay_10cm': clay_10cm, 'clay_30cm': clay_30cm, 'clay_60cm': clay_60cm,
-                           'clay_100cm': clay_100cm, 'clay_200cm': clay_200cm}
-
-        df = pd.DataFrame(final_data_dict)
-        x_df = df.values
-        x = StandardScaler().fit_transform(x_df)
-        pca = PCA()
-        pca_result = pca.fit_transform(x)
-        print(pca.explained_variance_ratio_[0])
-
-        pca_component1 = pca_result[:, [0]].flatten()
-        for key in nan_pos_dict.keys():
-            pca_component1[nan_pos_dict[key]] = clay_0cm_file.nodata
-
-        pca_component1 = pca_component1.reshape(raster_shape[0], raster_shape[1])
+        # PCA from 6x6 moments of the pixels valid in all clay layers (nan pixels aren't set to 0 and fitted)
+        clay_arrs = [clay_0cm_arr, clay_10cm_arr, clay_30cm_arr, clay_60cm_arr, clay_100cm_arr, clay_200cm_arr]
+        valid_mask = np.logical_and.reduce([~np.isnan(arr) for arr in clay_arrs])
+        stack = np.stack([arr[valid_mask] for arr in clay_arrs], axis=1)
+
+        count, mean, covariance = accumulate_pca_moments([stack])
+        weights, offsets, explained_variance_ratio = pca_from_moments(mean, covariance)
+        print('Explained variance ratio:', np.round(explained_variance_ratio, 4))
+
+        pca_component1 = np.full(clay_0cm_arr.shape, clay_0cm_file.nodata, dtype=np.float32)
+        pca_component1[valid_mask] = project_pca_component(stack, weights, offsets)
 
         pca_raster1 = os.path.join(output_raster_dir, continent_name + '_pca1.tif')
 
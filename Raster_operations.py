@@ -2,23 +2,34 @@
 # Email: Fahim.Hasan@colostate.edu
 
 import rasterio as rio
+from rasterio.windows import Window, from_bounds, bounds as window_bounds
+from rasterio.transform import from_origin
 from rasterio.merge import merge
 from rasterio.mask import mask
 from glob import glob
 import numpy as np
 from osgeo import gdal
 import json
+import zipfile
+from contextlib import nullcontext
 from fiona import transform
 from shapely.geometry import box, mapping
 import geopandas as gpd
 import astropy.convolution as apc
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter, convolve
+from scipy.signal import oaconvolve
 from System_operations import *
 import subprocess
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 
 No_Data_Value = -9999
 
+# WGS84 ellipsoid parameters (used for geodesic pixel area)
+WGS84_semi_major = 6378.137  # unit km
+WGS84_flattening = 1 / 298.257223563
+
 referenceraster = r'../Data/Reference_rasters_shapes/Global_continents_ref_raster.tif'
 
 
@@ -254,6 +265,130 @@ def rename_copy_raster(input_raster, output_dir, rename=False, new_name=None, ch
     return output_raster
 
 
+def read_raster_header(input_raster):
+    """
+    Read raster metadata (header) only, without reading the raster array.
+
+    Parameters:
+    input_raster : Input raster filepath.
+
+    Returns : A dictionary of raster driver, shape, band count, transform, crs, dtype and nodata.
+    """
+    with rio.open(input_raster) as src:
+        header = {'driver': src.driver, 'shape': src.shape, 'count': src.count, 'transform': src.transform,
+                  'crs': src.crs, 'dtype': src.dtypes[0], 'nodata': src.nodata}
+    return header
+
+
+def is_raster_aligned(raster_header, ref_header):
+    """
+    Check (from raster headers) whether a raster is on the same grid (shape, transform, crs) as a reference raster.
+
+    Parameters:
+    raster_header : Raster header dictionary (from read_raster_header()).
+    ref_header : Reference raster header dictionary (from read_raster_header()).
+
+    Returns : True if the raster is aligned with the reference raster grid.
+    """
+    return raster_header['shape'] == ref_header['shape'] and raster_header['crs'] == ref_header['crs'] and \
+        raster_header['transform'].almost_equals(ref_header['transform'])
+
+
+def needs_raster_rewrite(raster_header, no_data_value=No_Data_Value):
+    """
+    Check (from raster header) whether rename_copy_raster() would change anything in a raster other than its
+    filepath, i.e. whether the raster isn't already a single band GeoTIFF with no_data_value as nodata.
+
+    Parameters:
+    raster_header : Raster header dictionary (from read_raster_header()).
+    no_data_value : Nodata value rename_copy_raster() writes. Default set to -9999.
+
+    Returns : True if the raster has to be rewritten, False if it can be linked as it is.
+    """
+    return raster_header['driver'] != 'GTiff' or raster_header['count'] != 1 or \
+        raster_header['nodata'] != no_data_value
+
+
+def validate_raster_grids(input_raster_dir, search_by='*.tif', ref_raster=referenceraster, nodata=None, dtype=None,
+                          fix_mismatch=False, resample_algorithm='near', max_workers=4):
+    """
+    Validate (from raster headers only) that all rasters in a directory are on the reference raster grid (shape,
+    transform, crs), and optionally that they have the expected nodata and dtype. Fails fast before any array is read.
+    Predictor rasters carry their own nodata (read and masked by read_raster_arr_object()), so nodata isn't checked
+    by default.
+
+    Parameters:
+    input_raster_dir : Input rasters' directory.
+    search_by : Input raster search criteria. Defaults to '*.tif'.
+    ref_raster : Reference raster filepath. Default set to global reference raster.
+    nodata : Expected nodata value. Default set to None to not check nodata.
+    dtype : Expected data type (e.g. 'float32'). Default set to None to not check data type.
+    fix_mismatch : Set to True to fix mismatched rasters (in place) by warping them onto the reference grid in a
+                   single batch. Fixed rasters are written as Float32 with the expected nodata (-9999 if nodata is
+                   None).
+    resample_algorithm : Resampling algorithm used when fixing mismatched rasters. Defaults set to 'near'.
+    max_workers : Number of warps to run in parallel when fixing mismatched rasters. Defaults to 4.
+
+    Returns : List of validated rasters. Raises ValueError listing the mismatches if any raster is (still) invalid.
+    """
+    ref_header = read_raster_header(ref_raster)
+    rasters = glob(os.path.join(input_raster_dir, search_by))
+
+    def grid_mismatch(raster):
+        header = read_raster_header(raster)
+        issues = []
+        if header['shape'] != ref_header['shape']:
+            issues.append('shape {} != {}'.format(header['shape'], ref_header['shape']))
+        if header['crs'] != ref_header['crs']:
+            issues.append('crs {} != {}'.format(header['crs'], ref_header['crs']))
+        if not header['transform'].almost_equals(ref_header['transform']):
+            issues.append('transform {} != {}'.format(tuple(header['transform'])[:6],
+                                                      tuple(ref_header['transform'])[:6]))
+        if dtype is not None and header['dtype'] != dtype:
+            issues.append('dtype {} != {}'.format(header['dtype'], dtype))
+        if nodata is not None and (header['nodata'] is None or
+                                   not (header['nodata'] == nodata or
+                                        (np.isnan(header['nodata']) and np.isnan(nodata)))):
+            issues.append('nodata {} != {}'.format(header['nodata'], nodata))
+        return issues
+
+    mismatches = {raster: grid_mismatch(raster) for raster in rasters}
+    mismatches = {raster: issues for raster, issues in mismatches.items() if issues}
+
+    if mismatches and fix_mismatch:
+        ref_transform = ref_header['transform']
+        height, width = ref_header['shape']
+        output_bounds = (ref_transform.c, ref_transform.f + ref_transform.e * height,
+                         ref_transform.c + ref_transform.a * width, ref_transform.f)
+
+        def warp_on_ref_grid(raster):
+            # warping to a temporary file first as source and destination can't be the same file
+            temp_raster = raster + '.warp_tmp'
+            src_nodata = read_raster_header(raster)['nodata']
+            warped = gdal.Warp(destNameOrDestDS=temp_raster, srcDSOrSrcDSTab=raster, format='GTiff',
+                               outputBounds=output_bounds, width=width, height=height,
+                               dstSRS=ref_header['crs'].to_wkt(), outputType=gdal.GDT_Float32,
+                               resampleAlg=resample_algorithm, srcNodata=src_nodata,
+                               dstNodata=No_Data_Value if nodata is None else nodata)
+            if warped is None:
+                raise ValueError('Failed to warp {} on the reference grid'.format(raster))
+            del warped
+            os.replace(temp_raster, raster)  # a new file, so hard linked sources are left untouched
+
+        print('Warping {} mismatched rasters on the reference grid...'.format(len(mismatches)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(warp_on_ref_grid, mismatches.keys()))
+
+        mismatches = {raster: grid_mismatch(raster) for raster in mismatches}
+        mismatches = {raster: issues for raster, issues in mismatches.items() if issues}
+
+    if mismatches:
+        message = '\n'.join('{} : {}'.format(raster, ', '.join(issues)) for raster, issues in mismatches.items())
+        raise ValueError('Rasters not aligned with the reference raster grid:\n' + message)
+
+    return rasters
+
+
 def change_nodata_value(input_raster, new_nodata=No_Data_Value):
     """
     change no data value for single banded raster
@@ -480,7 +615,8 @@ def mosaic_rasters(input_dir, output_dir, raster_name, ref_raster=referenceraste
     output_dir : Output raster directory.
     output_raster_name : Output raster name.
     ref_raster : Reference raster with filepath.
-    search_by : Input raster search criteria.
+    search_by : Input raster search criteria. Set to '*.zip' to read zipped rasters directly (through /vsizip/)
+                without extracting.
     no_data : No data value. Default -9999.
     resolution: Resolution of the output raster.
 
@@ -489,6 +625,8 @@ def mosaic_rasters(input_dir, output_dir, raster_name, ref_raster=referenceraste
     input_rasters = glob(os.path.join(input_dir, search_by))
     raster_list = []
     for raster in input_rasters:
+        if raster.endswith('.zip'):
+            raster = vsizip_path(raster)
         arr, file = read_raster_arr_object(raster)
         raster_list.append(file)
 
@@ -543,6 +681,105 @@ def mosaic_two_rasters(input_raster1, input_raster2, output_dir, raster_name, re
     return merged_arr, out_raster
 
 
+def vsizip_path(zip_file, searchby='.tif'):
+    """
+    GDAL virtual filesystem (/vsizip/) path of a raster inside a zip file. The path can be opened by rasterio/gdal
+    (read, mosaic, resample) without extracting the zip file.
+
+    Parameters:
+    zip_file : Zip filepath.
+    searchby : Extension of the raster inside the zip file. The first match is used. Defaults to '.tif'.
+
+    Returns : /vsizip/ raster path.
+    """
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        raster_name = [name for name in zip_ref.namelist() if name.endswith(searchby)][0]
+
+    return '/vsizip/' + os.path.abspath(zip_file).replace(os.sep, '/') + '/' + raster_name
+
+
+def create_empty_mosaic(ref_raster=referenceraster, resolution=0.02, no_data=No_Data_Value):
+    """
+    Create an empty (filled with no_data) mosaic array covering the reference raster extent. Tiles are added to it
+    one by one with paste_tile_on_mosaic, so mosaicking can start before all tiles are available.
+
+    Parameters:
+    ref_raster : Reference raster with filepath.
+    resolution : Resolution of the mosaic.
+    no_data : No data value. Default -9999.
+
+    Returns : Mosaic array (float32) and its affine transformation.
+    """
+    with rio.open(ref_raster) as ref_file:
+        left, bottom, right, top = ref_file.bounds
+    nrows, ncols = int(round((top - bottom) / resolution)), int(round((right - left) / resolution))
+    mosaic_transform = from_origin(left, top, resolution, resolution)
+
+    return np.full((nrows, ncols), no_data, dtype=np.float32), mosaic_transform
+
+
+def paste_tile_on_mosaic(tile_raster, mosaic_arr, mosaic_transform, resolution=0.02, no_data=No_Data_Value,
+                         lock=None):
+    """
+    Paste a raster tile on a mosaic array (in place). The tile is merged (rasterio merge) on the part of the mosaic grid
+    it covers, and only pasted where the mosaic has no data yet, so the first tile covering a pixel is kept as in
+    mosaic_rasters.
+
+    Parameters:
+    tile_raster : Tile raster filepath (can be a /vsizip/ path).
+    mosaic_arr : Mosaic array created with create_empty_mosaic.
+    mosaic_transform : Affine transformation of the mosaic array.
+    resolution : Resolution of the mosaic.
+    no_data : No data value. Default -9999.
+    lock : threading.Lock to hold while writing on the mosaic array (when tiles are pasted from multiple threads).
+           Reading the tile doesn't need the lock. Defaults to None.
+
+    Returns : None.
+    """
+    with rio.open(tile_raster) as tile_file:
+        window = from_bounds(*tile_file.bounds, transform=mosaic_transform)
+        row_start, col_start = max(int(np.floor(window.row_off)), 0), max(int(np.floor(window.col_off)), 0)
+        row_end = min(int(np.ceil(window.row_off + window.height)), mosaic_arr.shape[0])
+        col_end = min(int(np.ceil(window.col_off + window.width)), mosaic_arr.shape[1])
+        if row_end <= row_start or col_end <= col_start:
+            return
+
+        # merge the tile on the mosaic grid cells it covers
+        tile_window = Window(col_start, row_start, col_end - col_start, row_end - row_start)
+        tile_arr, _ = merge([tile_file], bounds=window_bounds(tile_window, mosaic_transform),
+                            res=(resolution, resolution), nodata=no_data)
+
+    tile_arr = tile_arr[0, :row_end - row_start, :col_end - col_start]
+    with lock if lock is not None else nullcontext():
+        mosaic_block = mosaic_arr[row_start:row_start + tile_arr.shape[0], col_start:col_start + tile_arr.shape[1]]
+        paste = (mosaic_block == no_data) & (tile_arr != no_data)
+        mosaic_block[paste] = tile_arr[paste]
+
+
+def write_mosaic(mosaic_arr, output_dir, raster_name, ref_raster=referenceraster, no_data=No_Data_Value):
+    """
+    Mask a mosaic array by the reference raster (nan pixels of the reference raster stay nan) and write it.
+
+    Parameters:
+    mosaic_arr : Mosaic array on the reference raster grid.
+    output_dir : Output raster directory.
+    raster_name : Output raster name.
+    ref_raster : Reference raster with filepath.
+    no_data : No data value. Default -9999.
+
+    Returns: Mosaiced array and Mosaiced Raster.
+    """
+    ref_arr, ref_file = read_raster_arr_object(ref_raster)
+    merged_arr = np.where(ref_arr == 0, mosaic_arr, ref_arr)
+
+    makedirs([output_dir])
+    out_raster = os.path.join(output_dir, raster_name)
+    write_raster(raster_arr=merged_arr, raster_file=ref_file, transform=ref_file.transform, outfile_path=out_raster,
+                 no_data_value=no_data, ref_file=ref_raster)
+
+    return merged_arr, out_raster
+
+
 def mean_rasters(input_dir, outdir, raster_name, reference_raster=None, searchby="*.tif", no_data_value=No_Data_Value):
     """
     mean multiple rasters from a directory. 
@@ -772,8 +1009,87 @@ def paste_val_on_ref_raster(input_raster, outdir, raster_name, value=0, ref_rast
     return output_raster
 
 
+def normalized_convolution(raster_arr, kernel, block_rows=256, max_workers=4, method='auto', fft_min_kernel_size=11):
+    """
+    NaN-aware (normalized) convolution of a raster array. Nan pixels are left out of both the weighted sum and the
+    kernel weight, pixels outside the raster are taken as 0 and nan pixels stay nan in the output. Gives the same result
+    as astropy.convolution.convolve(raster_arr, kernel, preserve_nan=True) but runs on row blocks (with halo = kernel
+    radius) in parallel, so only a few block-sized float64 buffers are needed.
+
+    Parameters:
+    raster_arr : Raster array (nan as no data).
+    kernel : 2D kernel array with odd size in both axes. Normalized to sum 1 before convolution.
+    block_rows : Number of output rows convolved in each block. Defaults to 256.
+    max_workers : Number of threads to convolve blocks. Defaults to 4.
+    method : Can be 'direct', 'fft' or 'auto'. 'direct' convolves in space (cost grows with kernel area), 'fft' uses
+             overlap-add FFT convolution (cost almost independent of kernel size). 'auto' picks 'fft' if the kernel
+             is at least fft_min_kernel_size wide, otherwise 'direct'. Defaults to 'auto'.
+    fft_min_kernel_size : Kernel width from which 'auto' switches to FFT convolution. Defaults to 11.
+
+    Returns : Convolved raster array (float64).
+    """
+    kernel = np.asarray(kernel, dtype=np.float64)
+    if any(size % 2 == 0 for size in kernel.shape):
+        raise ValueError('Kernel size must be odd in all axes.')
+    kernel = kernel / kernel.sum()
+
+    if method == 'auto':
+        method = 'fft' if max(kernel.shape) >= fft_min_kernel_size else 'direct'
+    if method not in ('direct', 'fft'):
+        raise ValueError("method must be 'direct', 'fft' or 'auto'")
+
+    # kernel weight below the smallest kernel value means no valid pixel under the kernel (FFT leaves round-off there)
+    min_weight = kernel[kernel > 0].min() / 2
+    halo_y, halo_x = kernel.shape[0] // 2, kernel.shape[1] // 2
+    nrows = raster_arr.shape[0]
+    convolved_arr = np.empty(raster_arr.shape, dtype=np.float64)
+
+    def convolve_block(row_start):
+        row_end = min(row_start + block_rows, nrows)
+        top, bottom = max(row_start - halo_y, 0), min(row_end + halo_y, nrows)
+        block_arr = raster_arr[top:bottom].astype(np.float64)
+        valid = ~np.isnan(block_arr)
+        block_arr[~valid] = 0
+        inner = slice(row_start - top, row_end - top)
+
+        # pixels outside raster are filled with 0 and count as valid in the kernel weight
+        if method == 'direct':
+            weighted_sum = convolve(block_arr, kernel, mode='constant', cval=0)[inner]
+            kernel_weight = convolve(valid.astype(np.float64), kernel, mode='constant', cval=1)[inner]
+        else:
+            pad = ((halo_y - (row_start - top), halo_y - (bottom - row_end)), (halo_x, halo_x))
+            weighted_sum = oaconvolve(np.pad(block_arr, pad, constant_values=0), kernel, mode='valid')
+            kernel_weight = oaconvolve(np.pad(valid.astype(np.float64), pad, constant_values=1), kernel, mode='valid')
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            block_flt = weighted_sum / kernel_weight
+        block_flt[kernel_weight < min_weight] = np.nan
+        block_flt[~valid[inner]] = np.nan
+        convolved_arr[row_start:row_end] = block_flt
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(convolve_block, range(0, nrows, block_rows)))
+
+    return convolved_arr
+
+
+def gaussian_kernel(sigma):
+    """
+    Gaussian kernel array for apply_gaussian_filter(). The kernel is 3 * sigma wide, rounded up to the next odd size
+    as normalized_convolution() needs a kernel with a center pixel.
+
+    Parameters:
+    sigma : Standard Deviation for gaussian kernel.
+
+    Returns : 2D kernel array (normalized to sum 1).
+    """
+    kernel_size = int(3 * sigma) | 1
+    return apc.Gaussian2DKernel(x_stddev=sigma, x_size=kernel_size, y_size=kernel_size).array
+
+
 def apply_gaussian_filter(input_raster, outdir, raster_name, sigma=3, ignore_nan=True, normalize=True,
-                          nodata=No_Data_Value, ref_raster=referenceraster):
+                          nodata=No_Data_Value, ref_raster=referenceraster, block_rows=256, max_workers=4,
+                          method='auto'):
     """
     Applies Gaussian filter to raster.
 
@@ -786,14 +1102,17 @@ def apply_gaussian_filter(input_raster, outdir, raster_name, sigma=3, ignore_nan
     normalize : Set true to normalize the filtered raster at the end.
     nodata : No_Data_Value.
     ref_raster : Reference Raster. Defaults to referenceraster.
+    block_rows : Number of rows convolved at a time when ignore_nan is True. Defaults to 256.
+    max_workers : Number of threads to convolve blocks when ignore_nan is True. Defaults to 4.
+    method : Convolution method when ignore_nan is True. Can be 'direct', 'fft' or 'auto' (FFT for large sigma).
+             Defaults to 'auto'.
 
     Returns: Gaussian filtered raster.
     """
     raster_arr, raster_file = read_raster_arr_object(input_raster)
     if ignore_nan:
-        Gauss_kernel = apc.Gaussian2DKernel(x_stddev=sigma, x_size=3 * sigma, y_size=3 * sigma)
-        raster_arr_flt = apc.convolve(raster_arr, kernel=Gauss_kernel, preserve_nan=True)
-
+        raster_arr_flt = normalized_convolution(raster_arr, kernel=gaussian_kernel(sigma), block_rows=block_rows,
+                                                max_workers=max_workers, method=method)
     else:
         raster_arr[np.isnan(raster_arr)] = 0
         raster_arr_flt = gaussian_filter(input=raster_arr, sigma=sigma,
@@ -843,3 +1162,420 @@ def compute_proximity(input_raster, output_dir, raster_name, target_values=(1,),
 
     return output_raster
 
+
+def _lower_envelope_distance_sq(col_dist_sq, width_sq):
+    """
+    Squared distance to the nearest target of each pixel of a block of rows, from the squared north-south distance to
+    the nearest target in each column (col_dist_sq). The east-west distance of a row is its pixel width times the
+    column offset, so each row is a 1-D squared distance transform of sampled values (Felzenszwalb & Huttenlocher
+    lower envelope of parabolas), computed in linear time for all rows of the block at once.
+
+    Parameters:
+    col_dist_sq : Array (rows, cols) of squared north-south distance (km2) to the nearest target in the column (inf if
+                  the column has no target).
+    width_sq : Array (rows,) of squared pixel width (km2) of each row.
+
+    Returns : Array (rows, cols) of squared distance (km2) to the nearest target (inf if the rows have no target).
+    """
+    nrows, ncols = col_dist_sq.shape
+    width_sq = np.maximum(np.asarray(width_sq, dtype=np.float64), 1e-12)
+    values = col_dist_sq / width_sq[:, np.newaxis]  # in units of squared column offset
+
+    # envelope of each row: parabola vertices (columns) and the left boundaries of the parabolas
+    vertex = np.zeros((nrows, ncols), dtype=np.int64)
+    boundary = np.empty((nrows, ncols), dtype=np.float64)
+    num_parabolas = np.zeros(nrows, dtype=np.int64)
+
+    for col in range(ncols):
+        rows = np.nonzero(np.isfinite(values[:, col]))[0]
+        if rows.size == 0:
+            continue
+        value = values[rows, col] + col * col
+        last = num_parabolas[rows] - 1
+
+        # pop the parabolas hidden by the new one
+        while True:
+            has_parabola = last >= 0
+            last_vertex = vertex[rows, np.maximum(last, 0)]
+            with np.errstate(invalid='ignore'):
+                intersect = np.where(has_parabola, (value - values[rows, last_vertex] - last_vertex * last_vertex) /
+                                     (2 * (col - last_vertex)), -np.inf)
+            hidden = has_parabola & (intersect <= boundary[rows, np.maximum(last, 0)])
+            if not hidden.any():
+                break
+            last -= hidden
+
+        vertex[rows, last + 1] = col
+        boundary[rows, last + 1] = intersect
+        num_parabolas[rows] = last + 2
+
+    dist_sq = np.full((nrows, ncols), np.inf)
+    columns = np.arange(ncols)
+    for row in np.nonzero(num_parabolas)[0]:
+        num = num_parabolas[row]
+        # parabola of each column: the last one whose left boundary is < column
+        nearest = vertex[row, np.searchsorted(boundary[row, 1:num], columns, side='left')]
+        dist_sq[row] = (values[row, nearest] + (columns - nearest) ** 2) * width_sq[row]
+
+    return dist_sq
+
+
+def compute_geodesic_proximity(input_raster, output_dir, raster_name, target_values=(1,), ref_raster=None,
+                               block_size=512, max_workers=4, wrap_longitude=None, nodatavalue=No_Data_Value):
+    """
+    Distance (km) from each pixel to the nearest target pixel, computed directly on a raster in geographic coordinates
+    (EPSG:4326). Uses a separable (two pass) Euclidean distance transform with latitude scaling: the first pass finds
+    the meridional (north-south) distance to the nearest target pixel in each column, the second pass combines it with
+    the east-west distance using the pixel width (km) of each row's latitude on the WGS84 ellipsoid, as a linear time
+    lower envelope distance transform of each row (see _lower_envelope_distance_sq()). Column blocks (first pass) and
+    row blocks (second pass) run in parallel. For a raster covering 360 degree longitude, east-west distances wrap
+    around the dateline.
+
+    Parameters:
+    input_raster : Input raster filepath with target pixels.
+    output_dir : Output raster directory.
+    raster_name : Output raster name.
+    target_values : Tuple of pixel values to compute distance from. Defaults to (1,).
+    ref_raster : Reference raster. If given, pixels that are nan in ref_raster are set to nodata. Defaults to None.
+    block_size : Number of columns/rows processed in each block. Defaults to 512.
+    max_workers : Number of threads. Defaults to 4.
+    wrap_longitude : Set True to wrap east-west distances around the dateline. Defaults to None to wrap only if the
+                     raster covers 360 degree longitude.
+    nodatavalue : No_Data_Value.
+
+    Returns : Distance raster (km) filepath.
+    """
+    raster_arr, raster_file = read_raster_arr_object(input_raster)
+    target = np.isin(raster_arr, target_values)
+    nrows, ncols = target.shape
+    transform = raster_file.transform
+
+    # north-south distance (km) of each row center from the first row, and east-west pixel width (km) of each row
+    e2 = WGS84_flattening * (2 - WGS84_flattening)
+    lat = np.deg2rad(transform.f + (np.arange(nrows) + 0.5) * transform.e)
+    sin_sq = np.sin(lat) ** 2
+    meridian_radius = WGS84_semi_major * (1 - e2) / (1 - e2 * sin_sq) ** 1.5
+    row_height = meridian_radius * np.deg2rad(abs(transform.e))
+    row_position = np.concatenate(([0], np.cumsum((row_height[:-1] + row_height[1:]) / 2)))
+    row_width = WGS84_semi_major / np.sqrt(1 - e2 * sin_sq) * np.cos(lat) * np.deg2rad(abs(transform.a))
+    row_width_sq = (row_width ** 2)[:, np.newaxis].astype(np.float32)
+
+    col_dist_sq = np.empty((nrows, ncols), dtype=np.float32)
+    row_index = np.arange(nrows)[:, np.newaxis]
+
+    def column_pass(col_start):
+        block = target[:, col_start:col_start + block_size]
+        above = np.maximum.accumulate(np.where(block, row_index, -1), axis=0)
+        below = np.minimum.accumulate(np.where(block, row_index, nrows)[::-1], axis=0)[::-1]
+
+        dist_above = np.where(above >= 0, row_position[:, np.newaxis] - row_position[np.maximum(above, 0)], np.inf)
+        dist_below = np.where(below < nrows, row_position[np.minimum(below, nrows - 1)] - row_position[:, np.newaxis],
+                              np.inf)
+        col_dist_sq[:, col_start:col_start + block_size] = np.minimum(dist_above, dist_below) ** 2
+
+    if wrap_longitude is None:
+        wrap_longitude = np.isclose(ncols * abs(transform.a), 360)
+    # with wrapping, each row is padded with half a row from the other side, which covers the shorter way around
+    pad = ncols // 2 if wrap_longitude else 0
+
+    def row_pass(row_start):
+        rows = slice(row_start, min(row_start + block_size, nrows))
+        col_sq = col_dist_sq[rows].astype(np.float64)
+        if pad:
+            col_sq = np.concatenate([col_sq[:, ncols - pad:], col_sq, col_sq[:, :pad]], axis=1)
+        dist_sq = _lower_envelope_distance_sq(col_sq, row_width_sq[rows, 0])[:, pad:pad + ncols]
+
+        return row_start, np.sqrt(dist_sq).astype(np.float32)
+
+    distance_arr = np.full((nrows, ncols), nodatavalue, dtype=np.float32)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(column_pass, range(0, ncols, block_size)))
+        for row_start, block_dist in executor.map(row_pass, range(0, nrows, block_size)):
+            distance_arr[row_start:row_start + block_dist.shape[0]] = block_dist
+
+    distance_arr[~np.isfinite(distance_arr)] = nodatavalue
+    if ref_raster is not None:
+        ref_arr = read_raster_arr_object(ref_raster, get_file=False)
+        distance_arr[np.isnan(ref_arr)] = nodatavalue
+
+    makedirs([output_dir])
+    output_raster = os.path.join(output_dir, raster_name)
+    write_raster(raster_arr=distance_arr, raster_file=raster_file, transform=transform, outfile_path=output_raster)
+
+    return output_raster
+
+
+@lru_cache(maxsize=None)
+def _cell_area_by_row(top_lat, cellsize_y, cellsize_x, nrows):
+    """
+    Cached geodesic cell area (km2) of each row of a regular lat/lon grid on the WGS84 ellipsoid.
+
+    Parameters:
+    top_lat : Latitude of the top edge of the first row (degree).
+    cellsize_y : Pixel height in degree (positive).
+    cellsize_x : Pixel width in degree (positive).
+    nrows : Number of rows.
+
+    Returns : Read-only numpy array (float64) of cell area (km2) for each row.
+    """
+    e2 = WGS84_flattening * (2 - WGS84_flattening)
+    e = np.sqrt(e2)
+    semi_minor_sq = (WGS84_semi_major ** 2) * (1 - e2)
+
+    # latitude of the row edges, clipped to the poles
+    edges = np.clip(top_lat - np.arange(nrows + 1) * cellsize_y, -90, 90)
+    sin_lat = np.sin(np.deg2rad(edges))
+
+    # authalic function; area between two latitudes = b2 * dlon * (q(lat_top) - q(lat_bottom)) / 2
+    q = sin_lat / (1 - e2 * sin_lat ** 2) + np.log((1 + e * sin_lat) / (1 - e * sin_lat)) / (2 * e)
+    cell_area = semi_minor_sq * np.deg2rad(cellsize_x) * np.abs(q[:-1] - q[1:]) / 2
+
+    cell_area.setflags(write=False)
+    return cell_area
+
+
+def pixel_area_by_row(input_raster=None, transform=None, nrows=None):
+    """
+    Geodesic pixel area (km2) for each row of a raster in geographic coordinates (EPSG:4326). Pixel area only varies
+    with latitude, so a single value per row is enough. The vector is cached for each grid.
+
+    Parameters:
+    input_raster : Input raster filepath. Only the header is read. Set to None if transform and nrows are given.
+    transform : Affine transformation of the raster. Used if input_raster is None.
+    nrows : Number of rows of the raster. Used if input_raster is None.
+
+    Returns : Numpy array of pixel area (km2) for each row.
+    """
+    if input_raster is not None:
+        with rio.open(input_raster) as raster_file:
+            transform, nrows = raster_file.transform, raster_file.height
+
+    return _cell_area_by_row(float(transform.f), float(abs(transform.e)), float(abs(transform.a)), int(nrows))
+
+
+def class_area_sqkm(class_arr, transform, classes):
+    """
+    Geodesic area (km2) occupied by each class value in a raster array. Areas are summed as weighted bincount of the
+    pixels' row area, so it costs the same as counting pixels.
+
+    Parameters:
+    class_arr : Raster array of class values (in EPSG:4326).
+    transform : Affine transformation of the raster array.
+    classes : Tuple of class values to compute area for.
+
+    Returns : Numpy array of area (km2) for each class value (in order of classes).
+    """
+    classes = np.asarray(classes)
+    row_area = pixel_area_by_row(transform=transform, nrows=class_arr.shape[0])
+
+    rows, cols = np.nonzero(np.isin(class_arr, classes))
+    order = np.argsort(classes)
+    class_index = order[np.searchsorted(classes[order], class_arr[rows, cols])]
+
+    return np.bincount(class_index, weights=row_area[rows], minlength=len(classes))
+
+
+def read_raster_block(raster_file, row_start, num_rows, band=1, change_dtype=True):
+    """
+    Read a block of consecutive rows (full width) from an opened raster.
+
+    Parameters:
+    raster_file : Rasterio raster object.
+    row_start : Index of the first row of the block.
+    num_rows : Number of rows in the block.
+    band : Selected band to read (Default 1).
+    change_dtype : Change block data type to float32 and nodata to nan if true.
+
+    Returns : Raster block array.
+    """
+    block_arr = raster_file.read(band, window=Window(0, row_start, raster_file.width, num_rows))
+
+    if change_dtype:
+        block_arr = block_arr.astype(np.float32)
+        if raster_file.nodata:
+            block_arr[np.isclose(block_arr, raster_file.nodata)] = np.nan
+
+    return block_arr
+
+
+def encode_raster_classes(raster_arr, classes=None, bins=None):
+    """
+    Encode a raster array into uint8 (uint16 if more than 255 classes) class codes. Code 0 is reserved for pixels that
+    don't fall in any class (or nan).
+
+    Parameters:
+    raster_arr : Raster array.
+    classes : Tuple of class values of a categorical raster. Class value classes[i] gets code i+1.
+    bins : List of increasing bin edges to classify a continuous raster (used if classes is None). Values < bins[0]
+           get code 1, bins[0] <= values < bins[1] get code 2 and so on. Edges are compared in the data type of a
+           float raster, as comparing the array with the edges does.
+
+    Returns : Raster array of class codes.
+    """
+    if classes is not None:
+        classes = np.asarray(classes)
+        codes = np.zeros(raster_arr.shape, dtype=np.uint8 if len(classes) < 256 else np.uint16)
+
+        if np.all(classes == np.round(classes)) and classes.min() >= 0:
+            # integer classes (i.e. land use, country id) are encoded with a lookup table in a single pass
+            lookup = np.zeros(int(classes.max()) + 1, dtype=codes.dtype)
+            lookup[classes.astype(np.intp)] = np.arange(1, len(classes) + 1)
+
+            valid = (raster_arr >= 0) & (raster_arr <= classes.max())
+            values = raster_arr[valid]
+            int_values = values.astype(np.intp)
+            codes[valid] = np.where(int_values == values, lookup[int_values], 0)
+        else:
+            for code, value in enumerate(classes, start=1):
+                codes[raster_arr == value] = code
+    else:
+        codes = np.zeros(raster_arr.shape, dtype=np.uint8)
+        valid = ~np.isnan(raster_arr)
+        if np.issubdtype(raster_arr.dtype, np.floating):
+            bins = np.asarray(bins, dtype=raster_arr.dtype)
+        codes[valid] = np.digitize(raster_arr[valid], bins) + 1
+
+    return codes
+
+
+def crosstab_arrays(raster_arrays, classes_list, bins_list=None, row_area=None):
+    """
+    Cross-tabulation (contingency table) of class codes of multiple raster arrays of same shape.
+
+    Parameters:
+    raster_arrays : List of raster arrays.
+    classes_list : List of class value tuples (one for each raster). Set None for a raster that is classified by bins.
+    bins_list : List of bin edges (one for each raster). Set None for a categorical raster.
+    row_area : Pixel area of each row. If given, the table sums pixel area instead of counting pixels.
+
+    Returns : Numpy array of counts (or area) with one axis per raster. Index 0 of each axis holds pixels outside the
+              classes/nan, index i holds class code i (see encode_raster_classes()).
+    """
+    if bins_list is None:
+        bins_list = [None] * len(raster_arrays)
+
+    table_shape = tuple(len(classes) + 1 if classes is not None else len(bins) + 2
+                        for classes, bins in zip(classes_list, bins_list))
+    num_cells = int(np.prod(table_shape))
+
+    combined = np.zeros(raster_arrays[0].shape, dtype=np.intp)
+    for raster_arr, classes, bins, size in zip(raster_arrays, classes_list, bins_list, table_shape):
+        combined *= size
+        combined += encode_raster_classes(raster_arr, classes, bins)
+
+    if row_area is None:
+        table = np.bincount(combined.ravel(), minlength=num_cells)
+    else:
+        # counting each table cell row by row, then summing row counts weighted by row area
+        num_rows = combined.shape[0]
+        combined += (np.arange(num_rows, dtype=np.intp) * num_cells)[:, np.newaxis]
+        row_counts = np.bincount(combined.ravel(), minlength=num_rows * num_cells).reshape(num_rows, num_cells)
+        table = row_area @ row_counts
+
+    return table.reshape(table_shape)
+
+
+def crosstab_rasters(input_rasters, classes_list, bins_list=None, block_rows=512, area_weighted=False):
+    """
+    Cross-tabulation (contingency table) of class codes of multiple (usually 2 or 3) rasters of the same grid. Reads
+    the rasters block by block in one pass, so memory use doesn't depend on raster size.
+
+    Parameters:
+    input_rasters : List of raster filepaths.
+    classes_list : List of class value tuples (one for each raster). Set None for a raster that is classified by bins.
+    bins_list : List of bin edges (one for each raster). Set None for a categorical raster.
+    block_rows : Number of rows read in each block. Defaults to 512.
+    area_weighted : Set True to sum geodesic pixel area (km2) instead of counting pixels.
+
+    Returns : Numpy array of counts (or area) with one axis per raster (see crosstab_arrays()).
+    """
+    raster_files = [rio.open(raster) for raster in input_rasters]
+    height, width = raster_files[0].shape
+    for raster_file in raster_files[1:]:
+        if raster_file.shape != (height, width):
+            raise ValueError('Rasters must have the same shape to compute cross-tabulation')
+
+    row_area = pixel_area_by_row(transform=raster_files[0].transform, nrows=height) if area_weighted else None
+
+    table = 0
+    for row_start in range(0, height, block_rows):
+        num_rows = min(block_rows, height - row_start)
+        block_arrays = [read_raster_block(raster_file, row_start, num_rows) for raster_file in raster_files]
+        block_area = row_area[row_start:row_start + num_rows] if area_weighted else None
+        table = table + crosstab_arrays(block_arrays, classes_list, bins_list, block_area)
+
+    for raster_file in raster_files:
+        raster_file.close()
+
+    return table
+
+
+def points_to_grid_index(xs, ys, transform, shape):
+    """
+    Compute (row, col) pixel indices of point coordinates on a raster grid with the inverse affine transform.
+
+    Parameters:
+    xs : Array of point x coordinates (longitude).
+    ys : Array of point y coordinates (latitude).
+    transform : Affine transformation of the raster grid.
+    shape : Raster grid shape (rows, cols).
+
+    Returns : Linear (row * cols + col) pixel index array of the points and a boolean array marking points inside the
+              grid. Index of outside points is 0.
+    """
+    inverse = ~transform
+    xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+    cols = np.floor(inverse.a * xs + inverse.b * ys + inverse.c).astype(np.int64)
+    rows = np.floor(inverse.d * xs + inverse.e * ys + inverse.f).astype(np.int64)
+
+    inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+    pixel_index = np.where(inside, rows * shape[1] + cols, 0)
+
+    return pixel_index, inside
+
+
+def points_to_grid_arr(xs, ys, values, transform, shape, reducer='mean', nodata=No_Data_Value):
+    """
+    Bin point values onto a raster grid, reducing all points that fall in a pixel to a single value.
+
+    Parameters:
+    xs : Array of point x coordinates (longitude).
+    ys : Array of point y coordinates (latitude).
+    values : Array of point values. Not used (can be None) if reducer is 'count'.
+    transform : Affine transformation of the raster grid.
+    shape : Raster grid shape (rows, cols).
+    reducer : Reducer of the point values in a pixel. Can be 'mean', 'sum', 'max', 'min' or 'count'. Defaults to
+              'mean'.
+    nodata : Value of pixels without any point. Default set to -9999.
+
+    Returns : Float32 raster array of the grid shape.
+    """
+    if reducer not in ('mean', 'sum', 'max', 'min', 'count'):
+        raise ValueError("reducer must be 'mean', 'sum', 'max', 'min' or 'count'")
+
+    pixel_index, inside = points_to_grid_index(xs, ys, transform, shape)
+
+    # reduce over the occupied pixels only, points are sparse compared to the grid
+    occupied_pixels, point_pixel = np.unique(pixel_index[inside], return_inverse=True)
+    num_occupied = occupied_pixels.size
+
+    value_count = np.bincount(point_pixel, minlength=num_occupied)
+    if reducer == 'count':
+        reduced = value_count
+    else:
+        values = np.asarray(values, dtype=np.float64)[inside]
+        if reducer in ('mean', 'sum'):
+            reduced = np.bincount(point_pixel, weights=values, minlength=num_occupied)
+            if reducer == 'mean':
+                reduced = reduced / value_count
+        elif reducer == 'max':
+            reduced = np.full(num_occupied, -np.inf)
+            np.maximum.at(reduced, point_pixel, values)
+        else:
+            reduced = np.full(num_occupied, np.inf)
+            np.minimum.at(reduced, point_pixel, values)
+
+    grid_arr = np.full(shape[0] * shape[1], nodata, dtype=np.float32)
+    grid_arr[occupied_pixels] = reduced
+
+    return grid_arr.reshape(shape)
@@ -2,15 +2,26 @@
 # Email: Fahim.Hasan@colostate.edu
 
 import os
+import threading
 import numpy as np
 import pandas as pd
+import rasterio as rio
 from glob import glob
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 import geopandas as gpd
 from rasterio.mask import mask
 from shapely.geometry import mapping
 from System_operations import makedirs
 from Raster_operations import read_raster_arr_object, write_raster, mask_by_ref_raster, clip_resample_raster_cutline, \
-    paste_val_on_ref_raster
+    paste_val_on_ref_raster, shapefile_to_raster, pixel_area_by_row, class_area_sqkm, read_raster_block, \
+    crosstab_arrays, crosstab_rasters, encode_raster_classes
+
+# Aridity class bin edges. Rasters are read as float32 and encode_raster_classes() compares in the raster data type, so
+# classes match comparing the array with the thresholds. The last edge is the next float32 after 0.65, so an aridity
+# of exactly 0.65 gets a class of its own that is neither dry sub-humid (< 0.65) nor humid (> 0.65).
+aridity_bins = [0.03, 0.2, 0.5, 0.65, float(np.nextafter(np.float32(0.65), np.float32(1)))]
+aridity_classes = (1, 2, 3, 4, 6)  # hyper arid, arid, semi-arid, dry sub-humid, humid codes with aridity_bins
 
 
 def prediction_landuse_stat(model_prediction, land_use='../Model Run/Predictors_2013_2019/MODIS_Land_Use.tif',
@@ -34,41 +45,52 @@ def prediction_landuse_stat(model_prediction, land_use='../Model Run/Predictors_
 
     Returns : An excel file with '% prediction on different land use' stat.
     """
-    subsidence_prediction = read_raster_arr_object(model_prediction, get_file=False)
-    land_use = read_raster_arr_object(land_use, get_file=False)
-    training = read_raster_arr_object(training_raster, get_file=False)
+    # table axes - training (0: others, 1: class 5, 2: class 10), prediction (same as training),
+    # land use (0: nan, 1-7: land use classes)
+    table = crosstab_rasters([training_raster, model_prediction, land_use],
+                             classes_list=[(5, 10), (5, 10), (1, 2, 3, 4, 5, 6, 7)])
+    landuse_stat_from_table(table, outdir='../Model Run/Stats')
+
+
+# prediction_landuse_stat(model_prediction='../Model Run/Prediction_rasters/RF127_prediction_2013_2019.tif',
+#                         land_use='../Model Run/Predictors_2013_2019/MODIS_Land_Use.tif')
+
+
+def landuse_stat_from_table(table, outdir='../Model Run/Stats'):
+    """
+    Percentage of training and predicted subsidence (>1cm/yr) on different land use types from cross-tabulation of
+    training, prediction and land use rasters.
 
-    training_samples_5_10 = np.count_nonzero(np.where((training == 5) | (training == 10), 1, 0))
-    subsidence_prediction_5_10 = np.count_nonzero(np.where((subsidence_prediction == 5) | (subsidence_prediction == 10),
-                                                           1, 0))
+    Parameters:
+    table : Cross-tabulation table with axes training (0: others, 1: class 5, 2: class 10), prediction (same as
+            training) and land use (0: nan, 1-7: land use classes).
+    outdir : Directory path to save output excel file.
 
-    training_of_cropland = np.count_nonzero(np.where(((training == 5) | (training == 10))
-                                                     & (land_use == 3), 1, 0))
-    prediction_of_cropland = np.count_nonzero(np.where(((subsidence_prediction == 5) | (subsidence_prediction == 10))
-                                                       & (land_use == 3), 1, 0))
+    Returns : An excel file with '% prediction on different land use' stat.
+    """
+    training_lu = table[1:, :, :].sum(axis=(0, 1))  # training samples of 5 and 10 class on each land use
+    prediction_lu = table[:, 1:, :].sum(axis=(0, 1))  # predicted 5 and 10 class on each land use
+
+    training_samples_5_10 = training_lu.sum()
+    subsidence_prediction_5_10 = prediction_lu.sum()
+
+    training_of_cropland = training_lu[3]
+    prediction_of_cropland = prediction_lu[3]
     perc_cropland_in_training = round(training_of_cropland * 100 / training_samples_5_10, 2)
     perc_cropland_in_subsidence = round(prediction_of_cropland * 100 / subsidence_prediction_5_10, 2)
 
-    training_of_urban = np.count_nonzero(np.where(((training == 5) | (training == 10))
-                                                  & (land_use == 4), 1, 0))
-    prediction_of_urban = np.count_nonzero(np.where(((subsidence_prediction == 5) | (subsidence_prediction == 10))
-                                                    & (land_use == 4), 1, 0))
+    training_of_urban = training_lu[4]
+    prediction_of_urban = prediction_lu[4]
     perc_urban_in_training = round(training_of_urban * 100 / training_samples_5_10, 2)
     perc_urban_in_subsidence = round(prediction_of_urban * 100 / subsidence_prediction_5_10, 2)
 
-    training_of_vegetation = np.count_nonzero(np.where(((training == 5) | (training == 10))
-                                                       & (land_use == 2), 1, 0))
-    prediction_of_vegetation = np.count_nonzero(np.where(((subsidence_prediction == 5) | (subsidence_prediction == 10))
-                                                         & (land_use == 2), 1, 0))
+    training_of_vegetation = training_lu[2]
+    prediction_of_vegetation = prediction_lu[2]
     perc_vegetation_in_training = round(training_of_vegetation * 100 / training_samples_5_10, 2)
     perc_vegetation_in_subsidence = round(prediction_of_vegetation * 100 / subsidence_prediction_5_10, 2)
 
-    training_of_others = np.count_nonzero(np.where(((training == 5) | (training == 10))
-                                                   & ((land_use == 1) | (land_use == 5) | (land_use == 6) |
-                                                      (land_use == 7)), 1, 0))
-    prediction_of_others = np.count_nonzero(np.where(((subsidence_prediction == 5) | (subsidence_prediction == 10))
-                                                     & ((land_use == 1) | (land_use == 5) | (land_use == 6) |
-                                                        (land_use == 7)), 1, 0))
+    training_of_others = training_lu[[1, 5, 6, 7]].sum()
+    prediction_of_others = prediction_lu[[1, 5, 6, 7]].sum()
     perc_others_in_training = round(training_of_others * 100 / training_samples_5_10, 4)
     perc_others_in_subsidence = round(prediction_of_others * 100 / subsidence_prediction_5_10, 2)
 
@@ -92,16 +114,11 @@ def prediction_landuse_stat(model_prediction, land_use='../Model Run/Predictors_
     stat_df = pd.DataFrame.from_dict(stat_dict, orient='index', columns=['percent'])
     print(stat_df)
 
-    outdir = '../Model Run/Stats'
     makedirs([outdir])
     out_excel = outdir + '/' + 'Subsidence_on_LandUse.xlsx'
     stat_df.to_excel(out_excel, index=True)
 
 
-# prediction_landuse_stat(model_prediction='../Model Run/Prediction_rasters/RF127_prediction_2013_2019.tif',
-#                         land_use='../Model Run/Predictors_2013_2019/MODIS_Land_Use.tif')
-
-
 def stat_irrigation_datasets(gfsad_lu='../Data/Raw_Data/Land_Use_Data/Raw/'
                                       'Global Food Security- GFSAD1KCM/GFSAD1KCM.tif',
                              meier_irrigated='../Data/Raw_Data/Land_Use_Data/Raw/global_irrigated_areas/'
@@ -116,17 +133,19 @@ def stat_irrigation_datasets(gfsad_lu='../Data/Raw_Data/Land_Use_Data/Raw/'
 
     Returns : An excel file with stats calculated.
     """
-    gfsad_raster = read_raster_arr_object(gfsad_lu, get_file=False)
-    meier_raster = read_raster_arr_object(meier_irrigated, get_file=False)
+    # rasters are on different grids, so tabulated separately
+    gfsad_table = crosstab_rasters([gfsad_lu], classes_list=[(1, 2)])
+    # meier table - 0: other values/nan, 1: not irrigated (0), 2-5: irrigation classes 1-4
+    meier_table = crosstab_rasters([meier_irrigated], classes_list=[(0, 1, 2, 3, 4)])
 
     # in gfsad_major only major irrigation (areas irrigated by large reservoirs created by large and medium dams,
     # barrages, and even large ground water pumping
-    gfsad_major = np.count_nonzero(np.where((gfsad_raster == 1), 1, 0))
-    gfsad_all = np.count_nonzero(np.where((gfsad_raster == 1) | (gfsad_raster == 2), 1, 0))
+    gfsad_major = gfsad_table[1]
+    gfsad_all = gfsad_table[1:].sum()
 
     # in meier_high_suitability only high suitability classes, low agricultural suitability not considered
-    meier_high_suitability = np.count_nonzero(np.where((meier_raster == 1) | (meier_raster == 3), 1, 0))
-    meier_all = np.count_nonzero(meier_raster)
+    meier_high_suitability = meier_table[2] + meier_table[4]
+    meier_all = meier_table.sum() - meier_table[1]  # all non-zero (nan included) cells
 
     perc_higher_meier_from_gfsad = round((meier_high_suitability - gfsad_major) * 100 / gfsad_major, 2)
     perc_higher_gfsad_from_meier = round((gfsad_all - meier_all) * 100 / meier_all, 2)
@@ -148,53 +167,86 @@ def stat_irrigation_datasets(gfsad_lu='../Data/Raw_Data/Land_Use_Data/Raw/'
 # stat_irrigation_datasets()
 
 
-def overlap_all_irrigation_gw_irrigation(irrigated_area_meier='../Data/Raw_Data/Land_Use_Data/Raw/'
-                                                              'global_irrigated_areas/global_irrigated_areas.tif',
-                                         irrigated_area_gfsad='../Data/Raw_Data/Land_Use_Data/Raw/'
-                                                              'Global Food Security- GFSAD1KCM/GFSAD1KCM.tif',
-                                         gw_irrigation='../Data/Raw_Data/Land_Use_Data/Raw/gmlulca_10classes_global/'
-                                                       'gmlulca_10classes_global.tif', outdir='../Model Run/Stats'):
+def mask_irrigation_datasets(irrigated_area_meier, irrigated_area_gfsad, gw_irrigation):
     """
-    Counting overlap between Irrigation data (Meier), Irrigation data (GFSAD) and GW irrigation data (GIAM).
+    Mask Meier irrigation, GFSAD irrigation and GIAM GW irrigation datasets by the reference raster.
 
     Parameters :
     irrigated_area_meier : Meier irrigated data filepath.
     irrigated_area_gfsad : GFSAD irrigated data filepath.
     gw_irrigation : GIAM GW irrigation data filepath.
-    outdir : Output directory to save created excel file.
 
-    Returns : An excel file with stats calculated.
+    Returns : Filepaths of masked Meier, GFSAD and GIAM GW irrigation rasters.
     """
     irrigation_data = mask_by_ref_raster(irrigated_area_meier,
                                          '../Data/Raw_Data/Land_Use_Data/Raw/global_irrigated_areas',
                                          'global_irrigated_area_ref_clipped.tif')
-    meier_arr = read_raster_arr_object(irrigation_data, get_file=False)
 
     irrigation_gfsad = mask_by_ref_raster(irrigated_area_gfsad, '../Data/Raw_Data/Land_Use_Data/Raw/'
                                                                 'Global Food Security- GFSAD1KCM',
                                           'GFSAD1KCM_ref_clipped.tif')
-    gfsad_arr = read_raster_arr_object(irrigation_gfsad, get_file=False)
 
     gw_irrigation_data = mask_by_ref_raster(gw_irrigation,
                                             '../Data/Raw_Data/Land_Use_Data/Raw/gmlulca_10classes_global',
                                             'gmlulca_10classes_global_ref_clipped.tif')
-    gw_irrigation_raster = read_raster_arr_object(gw_irrigation_data, get_file=False)
 
-    meier_arr = np.where(meier_arr != 0, True, False)
-    meier_arr_count = np.count_nonzero(meier_arr)
+    return irrigation_data, irrigation_gfsad, gw_irrigation_data
 
-    gfsad_arr_all = np.where((gfsad_arr == 1) | (gfsad_arr == 2), True, False)
-    gfsad_arr_major = np.where(gfsad_arr == 1, True, False)
-    gfsad_arr_count = np.count_nonzero(gfsad_arr_all)
-    gfsad_major_arr_count = np.count_nonzero(gfsad_arr_major)
 
-    gw_irrigation = np.where(gw_irrigation_raster == 2, True, False)  # major irrigation (gw) considered
-    gw_irrigation_count = np.count_nonzero(gw_irrigation)
+def overlap_all_irrigation_gw_irrigation(irrigated_area_meier='../Data/Raw_Data/Land_Use_Data/Raw/'
+                                                              'global_irrigated_areas/global_irrigated_areas.tif',
+                                         irrigated_area_gfsad='../Data/Raw_Data/Land_Use_Data/Raw/'
+                                                              'Global Food Security- GFSAD1KCM/GFSAD1KCM.tif',
+                                         gw_irrigation='../Data/Raw_Data/Land_Use_Data/Raw/gmlulca_10classes_global/'
+                                                       'gmlulca_10classes_global.tif', outdir='../Model Run/Stats'):
+    """
+    Counting overlap between Irrigation data (Meier), Irrigation data (GFSAD) and GW irrigation data (GIAM).
 
-    overlap_irrigation_meier_gfsad_major_irrigation = np.count_nonzero(np.logical_and(meier_arr, gfsad_arr_major))
-    overlap_irrigation_meier_gfsad_irrigation = np.count_nonzero(np.logical_and(meier_arr, gfsad_arr_all))
-    overlap_irrigation_meier_gw_irrigation = np.count_nonzero(np.logical_and(meier_arr, gw_irrigation))
-    overlap_irrigation_gfsad_gw_irrigation = np.count_nonzero(np.logical_and(gfsad_arr_major, gw_irrigation))
+    Parameters :
+    irrigated_area_meier : Meier irrigated data filepath.
+    irrigated_area_gfsad : GFSAD irrigated data filepath.
+    gw_irrigation : GIAM GW irrigation data filepath.
+    outdir : Output directory to save created excel file.
+
+    Returns : An excel file with stats calculated.
+    """
+    irrigation_data, irrigation_gfsad, gw_irrigation_data = \
+        mask_irrigation_datasets(irrigated_area_meier, irrigated_area_gfsad, gw_irrigation)
+
+    # table axes - meier (0: other values/nan, 1: not irrigated (0), 2-5: irrigation classes 1-4), gfsad (0: not
+    # irrigated, 1: major, 2: minor), gw irrigation (0: others, 1: major gw irrigation)
+    table = crosstab_rasters([irrigation_data, irrigation_gfsad, gw_irrigation_data],
+                             classes_list=[(0, 1, 2, 3, 4), (1, 2), (2,)])
+
+    irrigation_overlap_stat_from_table(table, outdir)
+
+
+# overlap_all_irrigation_gw_irrigation()
+
+
+def irrigation_overlap_stat_from_table(table, outdir='../Model Run/Stats'):
+    """
+    Counting overlap between Irrigation data (Meier), Irrigation data (GFSAD) and GW irrigation data (GIAM) from
+    cross-tabulation of the three datasets.
+
+    Parameters:
+    table : Cross-tabulation table with axes meier (0: other values/nan, 1: not irrigated (0), 2-5: irrigation
+            classes 1-4), gfsad (0: not irrigated, 1: major, 2: minor) and gw irrigation (0: others, 1: major gw
+            irrigation).
+    outdir : Output directory to save created excel file.
+
+    Returns : An excel file with stats calculated.
+    """
+    meier_irrigated = np.delete(table, 1, axis=0)  # all non-zero (nan included) meier cells
+    meier_arr_count = meier_irrigated.sum()
+    gfsad_arr_count = table[:, 1:].sum()
+    gfsad_major_arr_count = table[:, 1].sum()
+    gw_irrigation_count = table[:, :, 1].sum()  # major irrigation (gw) considered
+
+    overlap_irrigation_meier_gfsad_major_irrigation = meier_irrigated[:, 1].sum()
+    overlap_irrigation_meier_gfsad_irrigation = meier_irrigated[:, 1:].sum()
+    overlap_irrigation_meier_gw_irrigation = meier_irrigated[:, :, 1].sum()
+    overlap_irrigation_gfsad_gw_irrigation = table[:, 1, 1].sum()
 
     dict = {'Number of cells in irrigated Meier data': meier_arr_count,
             'Number of cells in irrigated GFSAD (major) data': gfsad_major_arr_count,
@@ -213,9 +265,6 @@ def overlap_all_irrigation_gw_irrigation(irrigated_area_meier='../Data/Raw_Data/
     df.to_excel(out_excel, index=True)
 
 
-# overlap_all_irrigation_gw_irrigation()
-
-
 def area_subsidence_by_country(subsidence_prediction, outdir='../Model Run/Stats'):
     """
     Estimated area of subsidence >1cm/yr by country.
@@ -231,10 +280,6 @@ def area_subsidence_by_country(subsidence_prediction, outdir='../Model Run/Stats
 
     country_shapes = glob('../Data/Reference_rasters_shapes/Country_shapes/Individual_country' + '/' + '*.shp')
 
-    # Area Calculation (1 deg = ~ 111km)
-    deg_002 = 111 * 0.02  # unit km
-    area_per_002_pixel = deg_002 ** 2
-
     area_sqkm = []
     country_name = []
     area_subsidence = []
@@ -250,13 +295,12 @@ def area_subsidence_by_country(subsidence_prediction, outdir='../Model Run/Stats
                                                                  naming_from_raster=False,
                                                                  assigned_name=save_clipped_raster_as)
 
-        prediction_1_to_5 = np.count_nonzero(np.where(country_arr == 5, 1, 0))
-        prediction_greater_5 = np.count_nonzero(np.where(country_arr == 10, 1, 0))
-        prediction_greater_1 = np.count_nonzero(np.where(country_arr > 1, 1, 0))
+        # geodesic area (km2) of 1-5 cm/yr (class 5) and >5 cm/yr (class 10) pixels
+        area_1_to_5, area_greater_5 = class_area_sqkm(country_arr, country_file.transform, classes=(5, 10))
 
-        area_prediction_1_to_5 = round(prediction_1_to_5 * area_per_002_pixel, 0)
-        area_prediction_greater_5 = round(prediction_greater_5 * area_per_002_pixel, 0)
-        area_prediction_greater_1 = round(prediction_greater_1 * area_per_002_pixel, 0)
+        area_prediction_1_to_5 = round(area_1_to_5, 0)
+        area_prediction_greater_5 = round(area_greater_5, 0)
+        area_prediction_greater_1 = round(area_1_to_5 + area_greater_5, 0)
         area_subsidence.append([area_prediction_greater_1, area_prediction_1_to_5, area_prediction_greater_5])
 
     stat_dict = {'country_name': country_name,
@@ -292,16 +336,32 @@ def subsidence_on_aridity(subsidence_prediction, outdir='../Model Run/Stats'):
     Returns : An excel file with calculated stats.
     """
     makedirs([outdir])
-    aridity = read_raster_arr_object('../Model Run/Predictors_2013_2019/Aridity_Index.tif', get_file=False)
-    subsidence_arr = read_raster_arr_object(subsidence_prediction, get_file=False)
+    # table axes - prediction (0: <1cm/yr, 1: 1-5cm/yr, 2: >5cm/yr), aridity (0: nan, 1-6: aridity_bins classes)
+    table = crosstab_rasters([subsidence_prediction, '../Model Run/Predictors_2013_2019/Aridity_Index.tif'],
+                             classes_list=[(5, 10), None], bins_list=[None, aridity_bins])
+    aridity_stat_from_table(table, outdir)
+
+
+# subsidence_on_aridity(subsidence_prediction='../Model Run/Prediction_rasters/RF127_prediction_2013_2019.tif')
+
 
-    subsidence_pixels = np.count_nonzero(np.where(subsidence_arr > 1, 1, 0))
+def aridity_stat_from_table(table, outdir='../Model Run/Stats'):
+    """
+    Percentage of subsidence of >1cm/yr in different aridity regions from cross-tabulation of prediction and aridity
+    rasters.
+
+    Parameters:
+    table : Cross-tabulation table with axes prediction (0: <1cm/yr, 1: 1-5cm/yr, 2: >5cm/yr) and aridity (0: nan,
+            1-6: classes of aridity_bins).
+    outdir : Directory path to save output excel file.
+
+    Returns : An excel file with calculated stats.
+    """
+    makedirs([outdir])
+    subsidence_aridity = table[1:].sum(axis=0)
 
-    hyper_arid = np.count_nonzero(np.where(((subsidence_arr > 1) & (aridity < 0.03)), 1, 0))
-    arid = np.count_nonzero(np.where(((subsidence_arr > 1) & ((0.03 <= aridity) & (aridity < 0.2))), 1, 0))
-    semi_arid = np.count_nonzero(np.where(((subsidence_arr > 1) & ((0.2 <= aridity) & (aridity < 0.5))), 1, 0))
-    dry_subhumid = np.count_nonzero(np.where(((subsidence_arr > 1) & ((0.5 <= aridity) & (aridity < 0.65))), 1, 0))
-    humid = np.count_nonzero(np.where(((subsidence_arr > 1) & (aridity > 0.65)), 1, 0))
+    subsidence_pixels = subsidence_aridity.sum()
+    hyper_arid, arid, semi_arid, dry_subhumid, humid = subsidence_aridity[list(aridity_classes)]
 
     perc_hyper_arid = hyper_arid * 100 / subsidence_pixels
     perc_arid = arid * 100 / subsidence_pixels
@@ -316,9 +376,6 @@ def subsidence_on_aridity(subsidence_prediction, outdir='../Model Run/Stats'):
     df.to_excel(os.path.join(outdir, 'subsidence_perc_by_aridity.xlsx'), index=False)
 
 
-# subsidence_on_aridity(subsidence_prediction='../Model Run/Prediction_rasters/RF127_prediction_2013_2019.tif')
-
-
 def classify_gw_depletion_data(input_raster='../Data/result_comparison_Wada/georeferenced/gw_depletion_cmyr.tif',
                                referenceraster='../Data/Reference_rasters_shapes/Global_continents_ref_raster.tif'):
     """
@@ -498,17 +555,19 @@ def country_subsidence_on_aridity_stats(countries='../shapefiles/Country_contine
         subside_arr, subside_transform = mask(dataset=subsidence_file, shapes=[geom_geojson], filled=True, crop=True)
         subside_arr = subside_arr.squeeze()
 
-        hyper_arid = np.count_nonzero(np.where(((subside_arr > 1) & (arid_arr < 0.03)), 1, 0))
-        arid = np.count_nonzero(np.where(((subside_arr > 1) & ((0.03 <= arid_arr) & (arid_arr < 0.2))), 1, 0))
-        semi_arid = np.count_nonzero(np.where(((subside_arr > 1) & ((0.2 <= arid_arr) & (arid_arr < 0.5))), 1, 0))
-        dry_subhumid = np.count_nonzero(np.where(((subside_arr > 1) & ((0.5 <= arid_arr) & (arid_arr < 0.65))), 1, 0))
-        humid = np.count_nonzero(np.where(((subside_arr > 1) & (arid_arr > 0.65)), 1, 0))
+        # aridity class (see aridity_bins) of subsiding pixels, 0 for others
+        aridity_class = np.where(subside_arr > 1, encode_raster_classes(arid_arr, bins=aridity_bins), 0)
+
+        num_cells = [np.count_nonzero(aridity_class == code) for code in aridity_classes]
+        # geodesic area (km2) of the cells
+        area_cells = class_area_sqkm(aridity_class, subside_transform, classes=aridity_classes)
 
-        return hyper_arid, arid, semi_arid, dry_subhumid, humid
+        return tuple(num_cells) + tuple(area_cells)
 
-    countries_df['hyperarid_pixels'], countries_df['arid_pixels'], \
-        countries_df['semiarid_pixels'], countries_df['drysubhumid_pixels'], countries_df['humid_pixels'] = \
-         zip(*countries_df['geom_geojson'].apply(compute_num_cells_in_aridity))
+    pixel_columns = ['hyperarid_pixels', 'arid_pixels', 'semiarid_pixels', 'drysubhumid_pixels', 'humid_pixels']
+    area_columns = [column.replace('pixels', 'sqkm') for column in pixel_columns]  # only used for percent area
+    countries_df[pixel_columns + area_columns] = \
+        pd.DataFrame(list(countries_df['geom_geojson'].apply(compute_num_cells_in_aridity)), index=countries_df.index)
 
     area_country_df = pd.read_excel('../Model Run/Stats/country_area_record_google.xlsx',
                                     sheet_name='countryarea_corrected')
@@ -517,15 +576,13 @@ def country_subsidence_on_aridity_stats(countries='../shapefiles/Country_contine
     new_df = countries_df.merge(area_country_df, how='left', left_on='CNTRY_NAME', right_on='country_name')
     new_df = new_df.drop(columns='country_name')
 
-    # Area Calculation (1 deg = ~ 111km)
-    deg_002 = 111 * 0.02  # unit km
-    area_per_002_pixel = deg_002 ** 2
+    new_df['perc_hyperarid_area'] = new_df['hyperarid_sqkm'] * 100 / new_df['area_sqkm_google']
+    new_df['perc_arid_area'] = new_df['arid_sqkm'] * 100 / new_df['area_sqkm_google']
+    new_df['perc_semiarid_area'] = new_df['semiarid_sqkm'] * 100 / new_df['area_sqkm_google']
+    new_df['perc_drysubhumid_area'] = new_df['drysubhumid_sqkm'] * 100 / new_df['area_sqkm_google']
+    new_df['perc_humid_area'] = new_df['humid_sqkm'] * 100 / new_df['area_sqkm_google']
 
-    new_df['perc_hyperarid_area'] = new_df['hyperarid_pixels'] * area_per_002_pixel * 100 / new_df['area_sqkm_google']
-    new_df['perc_arid_area'] = new_df['arid_pixels'] * area_per_002_pixel * 100 / new_df['area_sqkm_google']
-    new_df['perc_semiarid_area'] = new_df['semiarid_pixels'] * area_per_002_pixel * 100 / new_df['area_sqkm_google']
-    new_df['perc_drysubhumid_area'] = new_df['drysubhumid_pixels'] * area_per_002_pixel * 100 / new_df['area_sqkm_google']
-    new_df['perc_humid_area'] = new_df['humid_pixels'] * area_per_002_pixel * 100 / new_df['area_sqkm_google']
+    new_df = new_df.drop(columns=area_columns)
 
     new_df = new_df.sort_values(by='perc_semiarid_area', axis=0, ascending=False)
     new_df.to_excel(os.path.join(outdir, 'country_subsidence_on_aridity.xlsx'))
@@ -557,30 +614,268 @@ def compute_volume_gw_loss(countries='../shapefiles/Country_continent_full_shape
                                             invert=False)
         masked_arr = masked_arr.squeeze()
 
-        num_1_5_pixels = np.count_nonzero(np.where(masked_arr == 5, 1, 0))  # pixels with 1-5 cm/year subsidence
-        num_10_pixels = np.count_nonzero(np.where(masked_arr == 10, 1, 0))  # pixels >5 cm/year subsidence
+        num_1_5_pixels = np.count_nonzero(masked_arr == 5)  # pixels with 1-5 cm/year subsidence
+        num_10_pixels = np.count_nonzero(masked_arr == 10)  # pixels >5 cm/year subsidence
+        # geodesic area (km2) of the pixels
+        area_1_5_pixels, area_10_pixels = class_area_sqkm(masked_arr, masked_transform, classes=(5, 10))
 
-        return num_1_5_pixels, num_10_pixels
+        return num_1_5_pixels, num_10_pixels, area_1_5_pixels, area_10_pixels
 
-    countries_df['num 1-5cm/yr pixels'], countries_df['num >5cm/yr pixels'] = \
+    num_1_5_pixels, num_10_pixels, area_1_5_pixels, area_10_pixels = \
         zip(*countries_df['geom_geojson'].apply(compute_num_subsidence_pixel))
+    countries_df['num 1-5cm/yr pixels'], countries_df['num >5cm/yr pixels'] = num_1_5_pixels, num_10_pixels
 
-    # Area Calculation (1 deg = ~ 111km)
-    deg_002 = 111 * 0.02  # unit km (1 side length of a pixel)
-    area_per_002_pixel = deg_002 ** 2
+    countries_df = add_gw_volume_loss(countries_df, np.array(area_1_5_pixels), np.array(area_10_pixels))
+    countries_df.to_excel(os.path.join(outdir, 'country_gw_volume_loss.xlsx'))
+
+
+# compute_volume_gw_loss()
 
+
+def add_gw_volume_loss(countries_df, area_1_5_pixels, area_10_pixels):
+    """
+    Add average volume of permanent groundwater storage loss columns to a country dataframe.
+
+    Parameters:
+    countries_df : Country dataframe.
+    area_1_5_pixels : Geodesic area (km2) of 1-5 cm/year subsidence pixels of each country (in countries_df order).
+    area_10_pixels : Geodesic area (km2) of >5 cm/year subsidence pixels of each country (in countries_df order).
+
+    Returns : Country dataframe with groundwater volume loss columns.
+    """
     # Assumptions on average subsidence in moderate and high subsidence pixels
     avg_subsidence_1_5cm_yr = 3/100000  # unit in km/yr
     avg_subsidence_greater_5cm_yr = 10/100000  # unit in km/yr
 
-    countries_df['vol avg gwloss in 1-5cm/yr (km3/yr)'] = countries_df['num 1-5cm/yr pixels'] * area_per_002_pixel * \
-                                               avg_subsidence_1_5cm_yr
-    countries_df['vol avg gwloss in >5cm/yr (km3/yr)'] = countries_df['num >5cm/yr pixels'] * area_per_002_pixel * \
-                                               avg_subsidence_greater_5cm_yr
+    countries_df['vol avg gwloss in 1-5cm/yr (km3/yr)'] = area_1_5_pixels * avg_subsidence_1_5cm_yr
+    countries_df['vol avg gwloss in >5cm/yr (km3/yr)'] = area_10_pixels * avg_subsidence_greater_5cm_yr
     countries_df['volume avg total gw loss (km3/yr)'] = countries_df['vol avg gwloss in 1-5cm/yr (km3/yr)'] + \
                                                         countries_df['vol avg gwloss in >5cm/yr (km3/yr)']
+    return countries_df
+
+
+def rasterize_country_ids(countries='../shapefiles/Country_continent_full_shapes/World_countries.shp',
+                          outdir='../Model Run/Stats',
+                          ref_raster='../Data/Reference_rasters_shapes/Global_continents_ref_raster.tif'):
+    """
+    Rasterize global country shapefile to a country id raster (on the reference raster grid).
+
+    A pixel gets the id of the country polygon containing its center (alltouched=False), the same pixels the
+    per-country clips (rasterio mask, gdal cutline) select. The only difference is in overlapping country polygons
+    (i.e. disputed areas): the clips count such pixel in each country, the id raster gives it to the country
+    rasterized last. country_id_raster_mismatch() reports these pixels.
+
+    Parameters:
+    countries: filepath of global country shapefile.
+    outdir: filepath of output directory.
+    ref_raster: filepath of reference raster.
+
+    Returns : Filepath of country id raster and list of country names (country id i has name country_names[i-1]).
+    """
+    country_dir = os.path.join(outdir, 'country_id')
+    makedirs([country_dir])
+
+    countries_df = gpd.read_file(countries)
+    countries_df['country_id'] = np.arange(1, len(countries_df) + 1)
+    country_shape = os.path.join(country_dir, 'country_id.shp')
+    countries_df[['CNTRY_NAME', 'country_id', 'geometry']].to_file(country_shape)
+
+    country_raster = shapefile_to_raster(country_shape, country_dir, 'country_id.tif', use_attr=True,
+                                         attribute='country_id', ref_raster=ref_raster, alltouched=False)
+
+    return country_raster, list(countries_df['CNTRY_NAME'])
+
+
+def country_id_raster_mismatch(country_raster,
+                               countries='../shapefiles/Country_continent_full_shapes/World_countries.shp'):
+    """
+    Equivalence check of a country id raster (from rasterize_country_ids()) against clipping by each country polygon
+    (rasterio mask, as compute_volume_gw_loss() does). Counts the pixels inside each country polygon that have
+    another id in the country id raster.
+
+    Parameters:
+    country_raster: filepath of country id raster.
+    countries: filepath of global country shapefile used to create country_raster.
+
+    Returns : Dataframe with country name, number of pixels inside the polygon and number of those pixels with another
+              id, for the countries with mismatch only.
+    """
+    countries_df = gpd.read_file(countries)
+
+    mismatch = []
+    with rio.open(country_raster) as country_file:
+        for country_id, (name, geometry) in enumerate(zip(countries_df['CNTRY_NAME'], countries_df['geometry']),
+                                                      start=1):
+            id_arr, _ = mask(dataset=country_file, shapes=[mapping(geometry)], filled=False, crop=True)
+            inside_ids = id_arr.compressed()
+            num_other_ids = np.count_nonzero(inside_ids != country_id)
+            if num_other_ids > 0:
+                mismatch.append([name, inside_ids.size, num_other_ids])
 
+    return pd.DataFrame(mismatch, columns=['country_name', 'pixels in polygon', 'pixels with other id'])
+
+
+def country_area_stat_from_table(table, country_names, outdir='../Model Run/Stats'):
+    """
+    Estimated area of subsidence >1cm/yr by country from area weighted cross-tabulation of country id and prediction
+    rasters.
+
+    Parameters:
+    table : Area (km2) cross-tabulation table with axes country (0: outside countries, i: country_names[i-1]) and
+            prediction (0: <1cm/yr, 1: 1-5cm/yr, 2: >5cm/yr).
+    country_names : List of country names.
+    outdir : Directory path to save output excel file.
+
+    Returns : An excel file with calculated stats.
+    """
+    stat_dict = {'country_name': country_names,
+                 'area_sqkm': np.round(table[1:].sum(axis=1), 0),
+                 'area subsidence >1cm/yr': np.round(table[1:, 1] + table[1:, 2], 0),
+                 'area subsidence 1-5cm/yr': np.round(table[1:, 1], 0),
+                 'area subsidence >5cm/yr': np.round(table[1:, 2], 0)}
+    stat_df = pd.DataFrame(stat_dict)
+    stat_df['perc_subsidence_of_cntry_area'] = round(stat_df['area subsidence >1cm/yr'] * 100 / stat_df['area_sqkm'], 4)
+    stat_df = stat_df.sort_values(by='area subsidence >1cm/yr', ascending=False)
+
+    makedirs([outdir])
+    stat_df.to_excel(os.path.join(outdir, 'subsidence_area_by_country.xlsx'), index=False)
+
+
+def gw_volume_stat_from_table(table, pixel_table, country_names, outdir='../Model Run/Stats'):
+    """
+    Average volume of permanent groundwater storage loss in confined aquifer country-wise from area weighted and pixel
+    count cross-tabulations of country id and prediction rasters.
+
+    Parameters:
+    table : Area (km2) cross-tabulation table with axes country (0: outside countries, i: country_names[i-1]) and
+            prediction (0: <1cm/yr, 1: 1-5cm/yr, 2: >5cm/yr).
+    pixel_table : Pixel count cross-tabulation table with the same axes as table.
+    country_names : List of country names.
+    outdir : Directory path to save output excel file.
+
+    Returns : An excel file with country level average gw storage loss stats.
+    """
+    countries_df = pd.DataFrame({'CNTRY_NAME': country_names,
+                                 'num 1-5cm/yr pixels': pixel_table[1:, 1],
+                                 'num >5cm/yr pixels': pixel_table[1:, 2]})
+    countries_df = add_gw_volume_loss(countries_df, table[1:, 1], table[1:, 2])
+
+    makedirs([outdir])
     countries_df.to_excel(os.path.join(outdir, 'country_gw_volume_loss.xlsx'))
 
 
-# compute_volume_gw_loss()
\ No newline at end of file
+def run_all_stats(model_prediction='../Model Run/Prediction_rasters/RF127_prediction_2013_2019.tif',
+                  training_raster='../Model Run/Predictors_2013_2019/Subsidence.tif',
+                  land_use='../Model Run/Predictors_2013_2019/MODIS_Land_Use.tif',
+                  aridity='../Model Run/Predictors_2013_2019/Aridity_Index.tif',
+                  countries='../shapefiles/Country_continent_full_shapes/World_countries.shp',
+                  irrigated_area_meier='../Data/Raw_Data/Land_Use_Data/Raw/global_irrigated_areas/'
+                                       'global_irrigated_areas.tif',
+                  irrigated_area_gfsad='../Data/Raw_Data/Land_Use_Data/Raw/Global Food Security- GFSAD1KCM/'
+                                       'GFSAD1KCM.tif',
+                  gw_irrigation='../Data/Raw_Data/Land_Use_Data/Raw/gmlulca_10classes_global/'
+                                'gmlulca_10classes_global.tif',
+                  stats=('landuse', 'aridity', 'country_area', 'gw_volume', 'irrigation_overlap'),
+                  outdir='../Model Run/Stats', block_rows=512, max_workers=4):
+    """
+    Run all result statistics in a single blockwise pass over the input rasters. Each input raster is opened once, its
+    blocks are read once and shared by all statistics. Blocks are tabulated in parallel threads.
+
+    Parameters:
+    model_prediction : filepath of model predicted subsidence. Default set to model 127.
+    training_raster : filepath of training subsidence raster.
+    land_use : filepath of MODIS land use raster.
+    aridity : filepath of aridity raster data.
+    countries : filepath of global country shapefile.
+    irrigated_area_meier : Meier irrigated data filepath.
+    irrigated_area_gfsad : GFSAD irrigated data filepath.
+    gw_irrigation : GIAM GW irrigation data filepath.
+    stats : Tuple of statistics to run. Can be any of 'landuse', 'aridity', 'country_area', 'gw_volume',
+            'irrigation_overlap'.
+    outdir : Directory path to save output excel files.
+    block_rows : Number of rows read in each block. Defaults to 512.
+    max_workers : Number of threads to tabulate blocks. Defaults to 4.
+
+    Returns : Excel files of the selected statistics.
+    """
+    makedirs([outdir])
+    input_rasters = {'prediction': model_prediction, 'training': training_raster, 'land_use': land_use,
+                     'aridity': aridity}
+
+    # registered statistics - cross-tabulation table specs and the writer functions that use them (a writer gets the
+    # tables in the order of its table names)
+    table_specs = {}
+    stat_writers = {}
+    if 'landuse' in stats:
+        table_specs['landuse'] = {'rasters': ('training', 'prediction', 'land_use'),
+                                  'classes_list': [(5, 10), (5, 10), (1, 2, 3, 4, 5, 6, 7)], 'bins_list': None,
+                                  'area_weighted': False}
+        stat_writers['landuse'] = (('landuse',), landuse_stat_from_table)
+
+    if 'aridity' in stats:
+        table_specs['aridity'] = {'rasters': ('prediction', 'aridity'), 'classes_list': [(5, 10), None],
+                                  'bins_list': [None, aridity_bins], 'area_weighted': False}
+        stat_writers['aridity'] = (('aridity',), aridity_stat_from_table)
+
+    if ('country_area' in stats) or ('gw_volume' in stats):
+        input_rasters['country'], country_names = rasterize_country_ids(countries, outdir)
+        table_specs['country'] = {'rasters': ('country', 'prediction'),
+                                  'classes_list': [tuple(range(1, len(country_names) + 1)), (5, 10)],
+                                  'bins_list': None, 'area_weighted': True}
+        if 'country_area' in stats:
+            stat_writers['country_area'] = (('country',), partial(country_area_stat_from_table,
+                                                                  country_names=country_names))
+        if 'gw_volume' in stats:
+            table_specs['country_pixels'] = dict(table_specs['country'], area_weighted=False)
+            stat_writers['gw_volume'] = (('country', 'country_pixels'),
+                                         partial(gw_volume_stat_from_table, country_names=country_names))
+
+    if 'irrigation_overlap' in stats:
+        input_rasters['meier'], input_rasters['gfsad'], input_rasters['gw_irrigation'] = \
+            mask_irrigation_datasets(irrigated_area_meier, irrigated_area_gfsad, gw_irrigation)
+        table_specs['irrigation'] = {'rasters': ('meier', 'gfsad', 'gw_irrigation'),
+                                     'classes_list': [(0, 1, 2, 3, 4), (1, 2), (2,)], 'bins_list': None,
+                                     'area_weighted': False}
+        stat_writers['irrigation_overlap'] = (('irrigation',), irrigation_overlap_stat_from_table)
+
+    # opening each raster (needed by the statistics) once
+    raster_keys = sorted({key for spec in table_specs.values() for key in spec['rasters']})
+    raster_files = {key: rio.open(input_rasters[key]) for key in raster_keys}
+    read_locks = {key: threading.Lock() for key in raster_keys}  # a raster object can't be read by threads at once
+
+    height, width = raster_files[raster_keys[0]].shape
+    for key in raster_keys:
+        if raster_files[key].shape != (height, width):
+            raise ValueError(f'{input_rasters[key]} is not aligned with {input_rasters[raster_keys[0]]}')
+    row_area = pixel_area_by_row(transform=raster_files[raster_keys[0]].transform, nrows=height)
+
+    def tabulate_block(row_start):
+        num_rows = min(block_rows, height - row_start)
+
+        block_arrays = {}
+        for raster_key in raster_keys:
+            with read_locks[raster_key]:
+                block_arrays[raster_key] = read_raster_block(raster_files[raster_key], row_start, num_rows)
+
+        block_tables = {}
+        for table_name, spec in table_specs.items():
+            block_area = row_area[row_start:row_start + num_rows] if spec['area_weighted'] else None
+            block_tables[table_name] = crosstab_arrays([block_arrays[raster_key] for raster_key in spec['rasters']],
+                                                       spec['classes_list'], spec['bins_list'], block_area)
+        return block_tables
+
+    tables = {table_name: 0 for table_name in table_specs}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for block_tables in executor.map(tabulate_block, range(0, height, block_rows)):
+            for table_name, block_table in block_tables.items():
+                tables[table_name] = tables[table_name] + block_table
+
+    for raster_file in raster_files.values():
+        raster_file.close()
+
+    for stat_name, (table_names, writer) in stat_writers.items():
+        print('Writing', stat_name, 'stat...')
+        writer(*[tables[table_name] for table_name in table_names], outdir=outdir)
+
+
+# run_all_stats()
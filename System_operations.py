@@ -2,6 +2,22 @@
 # Email: Fahim.Hasan@colostate.edu
 
 import os
+import sys
+import json
+import multiprocessing
+import pickle
+import hashlib
+import inspect
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+FICLONE = 0x40049409  # linux ioctl for reflink (copy-on-write clone) on btrfs/xfs
 
 
 def make_proper_dir_name(directory_str):
@@ -74,4 +90,364 @@ def make_gdal_sys_call(gdal_command, args, verbose=True):
         return sys_call
 
     else:
-        print('gdal sys call not optimized for linux yet')
\ No newline at end of file
+        print('gdal sys call not optimized for linux yet')
+
+
+def link_file(input_file, output_file):
+    """
+    Make output_file a zero-copy alias of input_file. Tries a hard link, then a reflink (copy-on-write clone, linux
+    only), then a symbolic link, and falls back to a plain copy.
+
+    Parameters:
+    input_file : Input filepath.
+    output_file : Output filepath. Replaced if exists.
+
+    Returns : Method used ('hardlink', 'reflink', 'symlink' or 'copy').
+    """
+    if os.path.lexists(output_file):
+        os.remove(output_file)
+
+    try:
+        os.link(input_file, output_file)
+        return 'hardlink'
+    except OSError:  # cross-device link or filesystem without hard link support
+        pass
+
+    if fcntl is not None:
+        try:
+            with open(input_file, 'rb') as src, open(output_file, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return 'reflink'
+        except OSError:
+            os.remove(output_file)
+
+    try:
+        os.symlink(os.path.abspath(input_file), output_file)
+        return 'symlink'
+    except OSError:  # symlinks need extra privilege on Windows
+        pass
+
+    shutil.copy2(input_file, output_file)
+    return 'copy'
+
+
+Task_cache_dir = '../Data/Task_cache'
+_hash_memo_lock = threading.Lock()
+
+
+def _load_hash_memo(cache_dir=Task_cache_dir):
+    """
+    Load the file hash memo ({abspath: [size, mtime_ns, sha256]}) of the task cache.
+
+    Parameters:
+    cache_dir : Task cache directory.
+
+    Returns : Hash memo dictionary (empty if the memo doesn't exist or is unreadable).
+    """
+    memo_file = os.path.join(cache_dir, 'file_hashes.json')
+    if not os.path.exists(memo_file):
+        return {}
+    try:
+        with open(memo_file) as f:
+            return json.load(f)
+    except (ValueError, OSError):
+        return {}
+
+
+def _save_hash_memo(hash_memo, cache_dir=Task_cache_dir):
+    """
+    Atomically write the file hash memo of the task cache.
+
+    Parameters:
+    hash_memo : Hash memo dictionary.
+    cache_dir : Task cache directory.
+
+    Returns : None.
+    """
+    makedirs([cache_dir])
+    memo_file = os.path.join(cache_dir, 'file_hashes.json')
+    with _hash_memo_lock:
+        tmp_file = memo_file + '.tmp{}'.format(threading.get_ident())
+        with open(tmp_file, 'w') as f:
+            json.dump(hash_memo, f)
+        os.replace(tmp_file, memo_file)
+
+
+def file_fingerprint(path, hash_memo, chunk_size=1 << 20):
+    """
+    Content hash of a file or directory. File hashes are memoized by (size, mtime_ns) so unchanged files are not
+    re-read. A directory hash combines the relative paths and hashes of all files inside it.
+
+    Parameters:
+    path : File or directory path.
+    hash_memo : Hash memo dictionary (from _load_hash_memo()). Updated in place.
+    chunk_size : Read chunk size in bytes. Defaults to 1 MB.
+
+    Returns : sha256 hex digest ('missing' if path doesn't exist).
+    """
+    if not os.path.exists(path):
+        return 'missing'
+
+    if os.path.isdir(path):
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                filepath = os.path.join(root, name)
+                digest.update(os.path.relpath(filepath, path).encode())
+                digest.update(file_fingerprint(filepath, hash_memo, chunk_size).encode())
+        return digest.hexdigest()
+
+    abs_path = os.path.abspath(path)
+    stat = os.stat(abs_path)
+    with _hash_memo_lock:
+        memo = hash_memo.get(abs_path)
+    if memo is not None and memo[0] == stat.st_size and memo[1] == stat.st_mtime_ns:
+        return memo[2]
+
+    digest = hashlib.sha256()
+    with open(abs_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    with _hash_memo_lock:
+        hash_memo[abs_path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return digest.hexdigest()
+
+
+def task_source_files(func):
+    """
+    Source files of the code modules a task function reaches: the module of func and, recursively, every module from
+    the same code directory it imports (as a module or through from-imports).
+
+    Parameters:
+    func : Task function.
+
+    Returns : Sorted list of source filepaths. Empty if func has no source file.
+    """
+    module = sys.modules.get(func.__module__)
+    module_file = getattr(module, '__file__', None)
+    if module_file is None:
+        return []
+
+    code_dir = os.path.dirname(os.path.abspath(module_file))
+    source_files = {os.path.abspath(module_file)}
+    pending = [module]
+    while pending:
+        for value in list(vars(pending.pop()).values()):
+            name = value.__name__ if inspect.ismodule(value) else getattr(value, '__module__', None)
+            imported = sys.modules.get(name) if isinstance(name, str) else None
+            imported_file = getattr(imported, '__file__', None)
+            if imported_file is None or not imported_file.endswith('.py'):
+                continue
+            imported_file = os.path.abspath(imported_file)
+            if os.path.dirname(imported_file) == code_dir and imported_file not in source_files:
+                source_files.add(imported_file)
+                pending.append(imported)
+    return sorted(source_files)
+
+
+def task_key(name, func, inputs, params, hash_memo):
+    """
+    Content address of a task: hash of the task name, function, source files of the code modules it reaches (see
+    task_source_files()), parameters and input file contents. Editing any of those modules, including helper
+    functions the task calls, makes the task stale.
+
+    Parameters:
+    name : Task name.
+    func : Task function.
+    inputs : List of input files/directories.
+    params : Dictionary of keyword arguments passed to func.
+    hash_memo : Hash memo dictionary.
+
+    Returns : sha256 hex digest of the task.
+    """
+    digest = hashlib.sha256()
+    digest.update(name.encode())
+    digest.update('{}.{}'.format(func.__module__, func.__qualname__).encode())
+    try:
+        digest.update(inspect.getsource(func).encode())
+    except (OSError, TypeError):  # builtins and functions without source file
+        pass
+    for source_file in task_source_files(func):
+        digest.update(file_fingerprint(source_file, hash_memo).encode())
+    digest.update(json.dumps(params, sort_keys=True, default=repr).encode())
+    for path in sorted(set(inputs)):
+        digest.update(path.encode())
+        digest.update(file_fingerprint(path, hash_memo).encode())
+    return digest.hexdigest()
+
+
+def run_task(name, func, inputs=(), outputs=(), params=None, cache_dir=Task_cache_dir, force=False,
+             hash_memo=None):
+    """
+    Run a task only if it is stale. A task is up to date when its key (hash of code module sources, inputs and
+    parameters) matches the cached record and all of its outputs exist; the cached return value is then loaded
+    instead of calling func.
+
+    Parameters:
+    name : Task name. Used as the cache record name.
+    func : Task function. Called as func(**params).
+    inputs : List of input files/directories the task reads.
+    outputs : List of output files/directories the task writes.
+    params : Dictionary of keyword arguments passed to func.
+    cache_dir : Task cache directory. Defaults to '../Data/Task_cache'.
+    force : Set to True to re-run the task irrespective of the cache.
+    hash_memo : Hash memo dictionary. Set to None to load it from cache_dir.
+
+    Returns : Return value of func (from cache if the task is up to date).
+    """
+    params = params or {}
+    save_memo = hash_memo is None
+    if hash_memo is None:
+        hash_memo = _load_hash_memo(cache_dir)
+
+    makedirs([cache_dir])
+    record_file = os.path.join(cache_dir, name + '.pkl')
+    key = task_key(name, func, inputs, params, hash_memo)
+
+    if not force and os.path.exists(record_file) and all(os.path.exists(output) for output in outputs):
+        try:
+            with open(record_file, 'rb') as f:
+                record = pickle.load(f)
+            if record['key'] == key:
+                print('Task {} is up to date'.format(name))
+                if save_memo:
+                    _save_hash_memo(hash_memo, cache_dir)
+                return record['result']
+        except (pickle.UnpicklingError, EOFError, KeyError, AttributeError, ImportError):
+            pass
+
+    print('Running task {}...'.format(name))
+    result = func(**params)
+
+    tmp_file = record_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump({'key': key, 'result': result}, f)
+    os.replace(tmp_file, record_file)
+    if save_memo:
+        _save_hash_memo(hash_memo, cache_dir)
+    return result
+
+
+def run_tasks(tasks, max_workers=4, cache_dir=Task_cache_dir, force=()):
+    """
+    Run a DAG of cached tasks. Tasks whose dependencies are finished run in parallel; each task re-executes only if
+    its inputs or parameters changed (see run_task()).
+
+    Parameters:
+    tasks : Dictionary of {task name: task dictionary}. A task dictionary has 'func' and optional 'inputs',
+            'outputs', 'params' and 'depends_on' (list of task names) keys. 'inputs' and any value in 'params' can be
+            a function of the results dictionary of finished tasks (e.g. lambda results: results['task'][0]), which
+            is resolved right before the task runs.
+    max_workers : Number of tasks to run in parallel. Defaults to 4.
+    cache_dir : Task cache directory. Defaults to '../Data/Task_cache'.
+    force : Task names to re-run irrespective of the cache.
+
+    Returns : Dictionary of {task name: task result}.
+    """
+    unknown = [dep for task in tasks.values() for dep in task.get('depends_on', ()) if dep not in tasks]
+    if unknown:
+        raise ValueError('Unknown task dependencies: {}'.format(sorted(set(unknown))))
+
+    hash_memo = _load_hash_memo(cache_dir)
+    results = {}
+    pending = dict(tasks)
+    running = {}
+
+    def resolve(value):
+        return value(results) if callable(value) else value
+
+    def submit(executor, name):
+        task = pending.pop(name)
+        inputs = resolve(task.get('inputs', ()))
+        params = {key: resolve(value) for key, value in task.get('params', {}).items()}
+        future = executor.submit(run_task, name, task['func'], inputs, task.get('outputs', ()), params,
+                                 cache_dir, name in force, hash_memo)
+        running[future] = name
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                ready = [name for name, task in pending.items()
+                         if all(dep in results for dep in task.get('depends_on', ()))]
+                for name in ready:
+                    submit(executor, name)
+                if not running:
+                    raise ValueError('Cyclic task dependencies: {}'.format(sorted(pending)))
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+    finally:
+        _save_hash_memo(hash_memo, cache_dir)
+
+    return results
+
+
+def run_parallel_jobs(jobs, max_workers=4, memory_budget_gb=16):
+    """
+    Run independent processing jobs concurrently in a process pool, respecting job dependencies and a global memory
+    budget. A job starts when all of its dependencies are finished and its memory estimate fits in the unused budget
+    (a job larger than the whole budget runs alone).
+
+    Parameters:
+    jobs : Dictionary of {job name: job dictionary}. A job dictionary has 'func' (a module level function) and
+           optional 'kwargs', 'depends_on' (list of job names) and 'memory_gb' (peak memory estimate, defaults to 1)
+           keys. Any value in 'kwargs' can be a function of the results dictionary of finished jobs
+           (e.g. lambda results: results['job']), which is resolved in the main process right before the job starts.
+    max_workers : Number of worker processes (spawned, so the calling script must guard its entry point with
+                  if __name__ == '__main__'). Defaults to 4. Set to 1 to run the jobs sequentially in this process.
+    memory_budget_gb : Total memory (GB) the running jobs are allowed to use. Defaults to 16.
+
+    Returns : Dictionary of {job name: job result}.
+    """
+    unknown = [dep for job in jobs.values() for dep in job.get('depends_on', ()) if dep not in jobs]
+    if unknown:
+        raise ValueError('Unknown job dependencies: {}'.format(sorted(set(unknown))))
+
+    results = {}
+    pending = dict(jobs)
+
+    def ready_jobs():
+        return [name for name, job in pending.items() if all(dep in results for dep in job.get('depends_on', ()))]
+
+    def job_kwargs(job):
+        return {key: value(results) if callable(value) else value for key, value in job.get('kwargs', {}).items()}
+
+    if max_workers == 1:
+        while pending:
+            ready = ready_jobs()
+            if not ready:
+                raise ValueError('Cyclic job dependencies: {}'.format(sorted(pending)))
+            for name in ready:
+                job = pending.pop(name)
+                results[name] = job['func'](**job_kwargs(job))
+        return results
+
+    running = {}
+    memory_in_use = 0
+    # spawned (not forked) workers, as jobs may be started from a run_tasks() thread while other threads hold
+    # GDAL/rasterio or logging locks, which a forked worker would inherit locked
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        while pending or running:
+            for name in ready_jobs():
+                memory_gb = pending[name].get('memory_gb', 1)
+                if len(running) >= max_workers:
+                    break
+                if running and memory_in_use + memory_gb > memory_budget_gb:
+                    continue
+                job = pending.pop(name)
+                future = executor.submit(job['func'], **job_kwargs(job))
+                running[future] = (name, memory_gb)
+                memory_in_use += memory_gb
+                print('Started job {} ({} GB of {} GB memory budget in use)'.format(name, memory_in_use,
+                                                                                     memory_budget_gb))
+            if not running:
+                raise ValueError('Cyclic job dependencies: {}'.format(sorted(pending)))
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, memory_gb = running.pop(future)
+                memory_in_use -= memory_gb
+                results[name] = future.result()
+    return results
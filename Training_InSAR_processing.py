@@ -2,20 +2,143 @@
 # Email: Fahim.Hasan@colostate.edu
 
 import os
+import json
 import numpy as np
 import pandas as pd
+import rasterio as rio
 from osgeo import gdal
 from glob import glob
 import geopandas as gpd
 from datetime import datetime
-from shapely.geometry import Point
-from System_operations import makedirs
-from Raster_operations import read_raster_arr_object, write_raster, shapefile_to_raster
+from rasterio.windows import Window
+from rasterio.transform import from_origin
+from rasterio.warp import transform as warp_transform, transform_bounds
+from System_operations import makedirs, run_parallel_jobs
+from Raster_operations import write_raster, read_raster_block, read_raster_header, points_to_grid_index, \
+    points_to_grid_arr, No_Data_Value, referenceraster
+
+# Subsidence classes. Rates (cm/yr) < -5 -> 10 (>5cm/yr), [-5, -1) -> 5 (1-5cm/yr), [-1, 0) -> 1 (<1cm/yr).
+# Uplift (>= 0) and nan get the nodata class 0.
+subsidence_class_bins = np.array([-5, -1, 0], dtype=np.float32)
+subsidence_class_lookup = np.array([10, 5, 1, 0], dtype=np.uint8)
+subsidence_class_nodata = 0
+
+insar_area_registry = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'InSAR_area_registry.json')
+
+
+def classify_subsidence_arr(subsidence_arr):
+    """
+    Classify subsidence rate (cm/yr) array to project classes (<1cm/yr: 1, 1-5cm/yr: 5, >5cm/yr: 10) with a single
+    np.digitize lookup.
+
+    Parameters:
+    subsidence_arr : Subsidence rate array in cm/yr (negative for subsidence). nan for no data.
+
+    Returns : uint8 class array with subsidence_class_nodata (0) for uplift and no data pixels.
+    """
+    # np.digitize puts nan in the last bin, which is the nodata class
+    return subsidence_class_lookup[np.digitize(subsidence_arr, subsidence_class_bins)]
+
+
+def aggregate_classify_insar_raster(input_raster, output_raster, unit_scale=1, aggregation='mean',
+                                    ref_raster=referenceraster, res=0.02, block_rows=1024):
+    """
+    Aggregate a native resolution InSAR subsidence (velocity) raster directly onto the reference raster grid and
+    classify the aggregated values (see classify_subsidence_arr()), in a single pass over row blocks of the input.
+
+    Parameters:
+    input_raster : Input InSAR subsidence raster filepath (any crs, pixel centers are transformed to EPSG:4326).
+    output_raster : Output classified raster filepath.
+    unit_scale : Scale value to convert input values to cm/yr. Defaults to 1.
+    aggregation : 'mean' to classify the mean velocity of each target cell, 'mode' to assign the most frequent class
+                  of the native pixels in each target cell (ties go to the more severe class). Uplift pixels count
+                  as the no data class in 'mode'. Defaults to 'mean'.
+    ref_raster : Reference raster filepath whose grid origin is used. Default set to global reference raster.
+    res : Target pixel resolution in degree. Default is 0.02 degree.
+    block_rows : Number of input raster rows processed in each block. Defaults to 1024.
+
+    Returns : Classified raster filepath (float32, -9999 as nodata) covering the input raster extent.
+    """
+    if aggregation not in ('mean', 'mode'):
+        raise ValueError("aggregation must be 'mean' or 'mode'")
+
+    ref_header = read_raster_header(ref_raster)
+    ref_left, ref_top = ref_header['transform'].c, ref_header['transform'].f
+
+    with rio.open(input_raster) as src:
+        geographic = src.crs.is_geographic
+        left, bottom, right, top = src.bounds if geographic else transform_bounds(src.crs, 'EPSG:4326', *src.bounds)
+
+        # target cells (on the reference grid) covering the input extent
+        col_offset = int(np.floor((left - ref_left) / res))
+        row_offset = int(np.floor((ref_top - top) / res))
+        num_cols = int(np.ceil((right - ref_left) / res)) - col_offset
+        num_rows = int(np.ceil((ref_top - bottom) / res)) - row_offset
+        num_cells = num_rows * num_cols
+
+        if aggregation == 'mean':
+            value_sum = np.zeros(num_cells)
+            value_count = np.zeros(num_cells, dtype=np.int64)
+        else:
+            class_count = np.zeros(num_cells * len(subsidence_class_lookup), dtype=np.int64)
+
+        affine = src.transform
+        for row_start in range(0, src.height, block_rows):
+            block_height = min(block_rows, src.height - row_start)
+            block_arr = read_raster_block(src, row_start, block_height) * unit_scale
+            pixel_rows, pixel_cols = np.nonzero(~np.isnan(block_arr))
+            values = block_arr[pixel_rows, pixel_cols]
+
+            # pixel center coordinates
+            pixel_cols = pixel_cols + 0.5
+            pixel_rows = pixel_rows + row_start + 0.5
+            xs = affine.a * pixel_cols + affine.b * pixel_rows + affine.c
+            ys = affine.d * pixel_cols + affine.e * pixel_rows + affine.f
+            if not geographic:
+                xs, ys = (np.asarray(coords) for coords in warp_transform(src.crs, 'EPSG:4326', xs, ys))
+
+            cell_cols = np.floor((xs - ref_left) / res).astype(np.int64) - col_offset
+            cell_rows = np.floor((ref_top - ys) / res).astype(np.int64) - row_offset
+            inside = (cell_cols >= 0) & (cell_cols < num_cols) & (cell_rows >= 0) & (cell_rows < num_rows)
+            cells = cell_rows[inside] * num_cols + cell_cols[inside]
+            values = values[inside]
+
+            if aggregation == 'mean':
+                value_sum += np.bincount(cells, weights=values, minlength=num_cells)
+                value_count += np.bincount(cells, minlength=num_cells)
+            else:
+                class_index = np.digitize(values, subsidence_class_bins)  # index in subsidence_class_lookup
+                class_count += np.bincount(cells * len(subsidence_class_lookup) + class_index,
+                                           minlength=class_count.size)
+
+        if aggregation == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean_arr = np.where(value_count > 0, value_sum / value_count, np.nan)
+            class_arr = classify_subsidence_arr(mean_arr)
+        else:
+            class_count = class_count.reshape(num_cells, len(subsidence_class_lookup))
+            # argmax picks the first (most severe) class in a tie
+            class_arr = subsidence_class_lookup[class_count.argmax(axis=1)]
+            class_arr[class_count.sum(axis=1) == 0] = subsidence_class_nodata
+
+    class_arr = class_arr.reshape(num_rows, num_cols).astype(np.float32)
+    class_arr[class_arr == subsidence_class_nodata] = No_Data_Value
+
+    if os.path.dirname(output_raster):
+        makedirs([os.path.dirname(output_raster)])
+    profile = dict(driver='GTiff', height=num_rows, width=num_cols, count=1, dtype='float32', crs=ref_header['crs'],
+                   transform=from_origin(ref_left + col_offset * res, ref_top - row_offset * res, res, res),
+                   nodata=No_Data_Value)
+    with rio.open(output_raster, 'w', **profile) as dst:
+        dst.write(class_arr, 1)
+
+    return output_raster
 
 
 def classify_insar_raster(input_raster, output_raster_name, unit_scale,
                           cnra_data=False, start_date=None, end_date=None, resampled_raster_name='Resampled.tif',
-                          res=0.02, output_dir='../InSAR_Data/Resampled_subsidence_data/resampled_insar_data'):
+                          res=0.02, output_dir='../InSAR_Data/Resampled_subsidence_data/resampled_insar_data',
+                          block_rows=1024, aggregation=None):
     """
     Classify InSAR subsidence raster to project classes (<1cm/yr, 1-5cm/yr and >5cm/yr).
 
@@ -31,58 +154,90 @@ def classify_insar_raster(input_raster, output_raster_name, unit_scale,
     resampled_raster_name : Resampled raster name. Default is 'Resampled.tif'.
     res : Pixel resolution in degree. Default is 0.02 degree.
     output_dir : Output Directory path. Default set to '../InSAR_Data/Resampled_subsidence_data/resampled_insar_data'
+    block_rows : Number of raster rows classified in each block. Defaults to 1024.
+    aggregation : Set to 'mean' or 'mode' to aggregate the velocity directly onto the 0.02 degree reference grid and
+                  classify the aggregated values, writing only the resampled raster (see
+                  aggregate_classify_insar_raster()). Default set to None to classify at native resolution and then
+                  resample with nearest neighbour.
 
     Returns : Classified (and resampled if modify raster=True) subsidence raster.
 
     **** For California cnra data processing cnra_data=True, Unit_scale=1
 
     """
-    arr, file = read_raster_arr_object(input_raster)
-
     if cnra_data:
         start_day = datetime.strptime(start_date, "%Y/%m/%d")
         end_day = datetime.strptime(end_date, "%Y/%m/%d")
         months_between = round(int(str(end_day - start_day).split(" ")[0]) / 30)
-        arr = arr * 30.48 * 12 / months_between  # 1 ft = 30.48 cm
-
-    arr = arr * unit_scale
-
-    # New_classes
-    sub_less_1cm = 1
-    sub_1cm_to_5cm = 5
-    sub_greater_5cm = 10
-    other_values = np.nan
-
-    arr = np.where(arr >= 0, other_values, arr)
-    arr = np.where(arr >= -1, sub_less_1cm, arr)
-    arr = np.where((arr < -1) & (arr >= -5), sub_1cm_to_5cm, arr)
-    arr = np.where(arr < -5, sub_greater_5cm, arr)
+        unit_scale = unit_scale * 30.48 * 12 / months_between  # 1 ft = 30.48 cm
 
     makedirs([output_dir])
+    if aggregation is not None:
+        return aggregate_classify_insar_raster(input_raster, os.path.join(output_dir, resampled_raster_name),
+                                               unit_scale=unit_scale, aggregation=aggregation, res=res,
+                                               block_rows=block_rows)
+
     output_raster = os.path.join(output_dir, output_raster_name)
 
-    outfilepath = write_raster(raster_arr=arr, raster_file=file, transform=file.transform, outfile_path=output_raster)
+    # classified block by block, so memory doesn't depend on the InSAR raster size
+    with rio.open(input_raster) as src:
+        profile = dict(driver='GTiff', height=src.height, width=src.width, count=1, dtype='uint8', crs=src.crs,
+                       transform=src.transform, nodata=subsidence_class_nodata)
+        with rio.open(output_raster, 'w', **profile) as dst:
+            for row_start in range(0, src.height, block_rows):
+                num_rows = min(block_rows, src.height - row_start)
+                block_arr = read_raster_block(src, row_start, num_rows)
+                dst.write(classify_subsidence_arr(block_arr * unit_scale), 1,
+                          window=Window(0, row_start, src.width, num_rows))
 
     resampled_raster = os.path.join(output_dir, resampled_raster_name)
 
-    gdal.Warp(destNameOrDestDS=resampled_raster, srcDSOrSrcDSTab=outfilepath, dstSRS='EPSG:4326', xRes=res, yRes=res,
-              outputType=gdal.GDT_Float32)
+    gdal.Warp(destNameOrDestDS=resampled_raster, srcDSOrSrcDSTab=output_raster, dstSRS='EPSG:4326', xRes=res, yRes=res,
+              outputType=gdal.GDT_Float32, dstNodata=No_Data_Value)
 
     return resampled_raster
 
 
-def process_primary_insar_data(processing_areas=('California', 'Arizona', 'Pakistan_Quetta', 'Iran_Qazvin',
-                                                 'China_Hebei', 'China_Hefei', 'Colorado'),
-                               output_dir='../InSAR_Data/Merged_subsidence_data/resampled_insar_data'):
+def load_insar_area_registry(registry_file=insar_area_registry, areas=None):
+    """
+    Load InSAR area registry (raster path, unit scale, CNRA date range and area code offset of each InSAR area).
+
+    Parameters:
+    registry_file : InSAR area registry json filepath. Default set to 'InSAR_area_registry.json' in code directory.
+    areas : Tuple of area names to load. Default set to None to load all areas.
+
+    Returns : A list of area dictionaries (in registry order) with 'name', 'raster', 'unit_scale', 'cnra_date_range'
+              and 'area_code_offset' keys.
     """
-    Resamples and reclassifies insar data for 'California', 'Arizona', 'Pakistan_Quetta', 'Iran_Qazvin', 'China_Hebei',
-                                              'China_Hefei', 'Colorado'.
+    with open(registry_file) as f:
+        registry = json.load(f)['areas']
+
+    if areas is not None:
+        unknown = [area for area in areas if area not in [entry['name'] for entry in registry]]
+        if unknown:
+            raise ValueError('Areas not in InSAR area registry {}: {}'.format(registry_file, unknown))
+        registry = [entry for entry in registry if entry['name'] in areas]
+
+    return registry
+
+
+def process_primary_insar_data(processing_areas=None,
+                               output_dir='../InSAR_Data/Merged_subsidence_data/resampled_insar_data',
+                               aggregation=None, registry_file=insar_area_registry, max_workers=4):
+    """
+    Resamples and reclassifies insar data of the areas in InSAR area registry ('California', 'Arizona',
+    'Pakistan_Quetta', 'Iran_Qazvin', 'China_Hebei', 'China_Hefei', 'Colorado'). Areas are processed in parallel
+    worker processes.
 
     Parameters:
-    processing_areas : A tuple of insar data areas. Default set as
-                       ('California', 'Arizona', 'Pakistan_Quetta', 'Iran_Qazvin', 'China_Hebei')
+    processing_areas : A tuple of insar data areas. Default set to None to process all areas in the registry.
     output_dir : Output directory filepath to store processed data. Default set to
                  '../InSAR_Data/Resampled_subsidence_data/resampled_insar_data'
+    aggregation : Set to 'mode' or 'mean' to aggregate native resolution InSAR velocity on the 0.02 degree reference
+                  grid before classification (see aggregate_classify_insar_raster()). Default set to None to classify
+                  and then resample with nearest-neighbour.
+    registry_file : InSAR area registry json filepath. Default set to 'InSAR_area_registry.json' in code directory.
+    max_workers : Number of areas to process in parallel. Defaults to 4.
 
     Returns: Resampled and reclassified insar datasets.
     """
@@ -90,125 +245,95 @@ def process_primary_insar_data(processing_areas=('California', 'Arizona', 'Pakis
     existing_files = glob(output_dir + '/' + '*.tif')
     for file in existing_files:
         os.remove(file)
+    makedirs([output_dir])
 
-    data_dict = {'California': '../InSAR_Data/California/California_vert_disp_20150613_20190919.tif',
-                 'Arizona': '../InSAR_Data/Arizona/2010_2019/MS_2010_2019.tif',
-                 'Pakistan_Quetta': '../InSAR_Data/Pakistan_Quetta/Quetta_2017_2021.tif',
-                 'Iran_Qazvin': '../InSAR_Data/Iran/Iran_Qazvin.tif',
-                 'China_Hebei': '../InSAR_Data/China_Hebei/China_Hebei.tif',
-                 'China_Hefei': '../InSAR_Data/China_Hefei/China_Hefei.tif',
-                 'Colorado': '../InSAR_Data/Colorado/Colorado.tif'}
-
-    for area in processing_areas:
-        if area == 'California':
-            classify_insar_raster(input_raster=data_dict[area], output_raster_name='California_reclass.tif',
-                                  cnra_data=True, unit_scale=1, start_date='2015/06/13', end_date='2019/09/19',
-                                  resampled_raster_name='California_reclass_resampled.tif', output_dir=output_dir)
-
-        elif area == 'Arizona':
-            classify_insar_raster(input_raster=data_dict[area], output_raster_name='Arizona_reclass.tif',
-                                  cnra_data=False, unit_scale=1, resampled_raster_name='Arizona_reclass_resampled.tif',
-                                  output_dir=output_dir)
-
-        elif area == 'Pakistan_Quetta':
-            classify_insar_raster(input_raster=data_dict[area], output_raster_name='Pakistan_Quetta_reclass.tif',
-                                  cnra_data=False, unit_scale=100,
-                                  resampled_raster_name='Pakistan_Quetta_reclass_resampled.tif',
-                                  output_dir=output_dir)
-
-        elif area == 'Iran_Qazvin':
-            classify_insar_raster(input_raster=data_dict[area], output_raster_name='Iran_Qazvin_reclass.tif',
-                                  cnra_data=False, unit_scale=0.1,
-                                  resampled_raster_name='Iran_Qazvin_reclass_resampled.tif',
-                                  output_dir=output_dir)
-
-        elif area == 'China_Hebei':
-            classify_insar_raster(input_raster=data_dict[area], output_raster_name='China_Hebei_reclass.tif',
-                                  unit_scale=1, resampled_raster_name='China_Hebei_reclass_resampled.tif',
-                                  output_dir=output_dir)
-
-        elif area == 'China_Hefei':
-            classify_insar_raster(input_raster=data_dict[area], output_raster_name='China_Hefei_reclass.tif',
-                                  unit_scale=0.1, resampled_raster_name='China_Hefei_reclass_resampled.tif',
-                                  output_dir=output_dir)
-        elif area == 'Colorado':
-            classify_insar_raster(input_raster=data_dict[area], output_raster_name='Colorado_reclass.tif',
-                                  unit_scale=1, resampled_raster_name='Colorado_reclass_resampled.tif',
-                                  output_dir=output_dir)
-
-
-def rasterize_coastal_subsidence(mean_output_points, output_dir,
-                                 input_csv='../InSAR_Data/Coastal_Subsidence/Fig3_data.csv'):
+    jobs = {}
+    for area in load_insar_area_registry(registry_file, processing_areas):
+        start_date, end_date = area['cnra_date_range'] if area['cnra_date_range'] else (None, None)
+        jobs[area['name']] = {'func': classify_insar_raster,
+                              'kwargs': dict(input_raster=area['raster'],
+                                             output_raster_name=area['name'] + '_reclass.tif',
+                                             unit_scale=area['unit_scale'],
+                                             cnra_data=area['cnra_date_range'] is not None,
+                                             start_date=start_date, end_date=end_date,
+                                             resampled_raster_name=area['name'] + '_reclass_resampled.tif',
+                                             output_dir=output_dir, aggregation=aggregation)}
+
+    # classification is blockwise, so each job uses little memory
+    resampled_rasters = run_parallel_jobs(jobs, max_workers=max_workers)
+    return resampled_rasters
+
+
+def rasterize_coastal_subsidence(output_dir, input_csv='../InSAR_Data/Coastal_Subsidence/Fig3_data.csv',
+                                 ref_raster=referenceraster, mean_output_points=None):
     """
-    Rasterize coastal subsidence data from Shirzaei_et_al 2020.
+    Rasterize coastal subsidence data from Shirzaei_et_al 2020. Point coordinates are converted to pixel indices of
+    the reference raster grid with the inverse affine transform, and points falling in the same pixel are averaged
+    with np.bincount.
 
     Parameters:
-    mean_output_points : Filepath to save filtered points (with mean subsidence values) from input_csv as point shapefile.
     output_dir : Output directory filepath to save converted Geotiff file.
     input_csv : Input csv filepath. Set to path '../InSAR_Data/Coastal_Subsidence/Fig3_data.csv'.
+    ref_raster : Reference raster filepath. Default set to global reference raster (0.02 degree).
+    mean_output_points : Filepath to save filtered points (with pixel mean subsidence values) from input_csv as point
+                         shapefile. Default set to None to skip saving the points.
 
     Return : A Geotiff file of 0.02 degree containing coastal subsidence data.
     """
-    coastal_df = pd.read_csv(input_csv)
-    new_col_dict = {'Longitude_deg': 'Long_deg', 'Latitude_deg': 'Lat_deg', 'first_epoch': '1st_epoch',
-                    'last_epoch': 'last_epoch', 'VLM_mm_yr': 'VLM_mm_yr','VLM_std_mm_yr': 'VLMstdmmyr'}
-    coastal_df.rename(columns=new_col_dict, inplace=True)
-    coastal_df = coastal_df[(coastal_df['1st_epoch'] >= 2006) & (coastal_df['VLM_mm_yr'] < 0)]
+    coastal_df = pd.read_csv(input_csv, usecols=['Longitude_deg', 'Latitude_deg', 'first_epoch', 'VLM_mm_yr'])
+    coastal_df = coastal_df[(coastal_df['first_epoch'] >= 2006) & (coastal_df['VLM_mm_yr'] < 0)]
     coastal_df['VLM_cm_yr'] = coastal_df['VLM_mm_yr'] / 10
-    coords = [Point(xy) for xy in zip(coastal_df['Long_deg'], coastal_df['Lat_deg'])]
-    coastal_shp = gpd.GeoDataFrame(coastal_df, geometry=coords, crs='EPSG:4326')
-    intermediate_shp = '../InSAR_Data/Coastal_Subsidence/filtered_point.shp'
-    coastal_shp.to_file(intermediate_shp)
-
-    # blank_raster will only be used to pixel locations (indices)
-    blank_raster = shapefile_to_raster(intermediate_shp, output_dir, 'blank_raster.tif',
-                                       use_attr=False, attribute='VLM_cm_yr',
-                                       add=False, burnvalue=0, alltouched=True)
-    blank_arr, blank_file = read_raster_arr_object(blank_raster)
-    index_list = list()
-    for lon, lat in zip(coastal_shp['Long_deg'], coastal_shp['Lat_deg']):
-        row, col = blank_file.index(lon, lat)
-        index_list.append(str(row + col))
-    coastal_shp['pix_index'] = index_list
-    mean_subsidence = coastal_shp.groupby('pix_index', as_index=True)['VLM_cm_yr'].transform('mean')
-    coastal_shp['mean_cm_yr'] = mean_subsidence
-    coastal_shp.to_file(mean_output_points)
-
-    coastal_subsidence_raster = shapefile_to_raster(mean_output_points, output_dir, 'coastal_subsidence.tif',
-                                                    use_attr=True, attribute='mean_cm_yr',
-                                                    add=None, burnvalue=0, alltouched=True)
+
+    ref_header = read_raster_header(ref_raster)
+    coastal_arr = points_to_grid_arr(coastal_df['Longitude_deg'].values, coastal_df['Latitude_deg'].values,
+                                     coastal_df['VLM_cm_yr'].values, ref_header['transform'], ref_header['shape'])
+
+    makedirs([output_dir])
+    coastal_subsidence_raster = os.path.join(output_dir, 'coastal_subsidence.tif')
+    write_raster(coastal_arr, None, None, coastal_subsidence_raster, ref_file=ref_raster)
+
+    if mean_output_points is not None:
+        pixel_index, inside = points_to_grid_index(coastal_df['Longitude_deg'].values,
+                                                   coastal_df['Latitude_deg'].values, ref_header['transform'],
+                                                   ref_header['shape'])
+        coastal_df = coastal_df[inside]
+        coastal_df['mean_cm_yr'] = coastal_arr.ravel()[pixel_index[inside]]
+        coords = gpd.points_from_xy(coastal_df['Longitude_deg'], coastal_df['Latitude_deg'])
+        gpd.GeoDataFrame(coastal_df, geometry=coords, crs='EPSG:4326').to_file(mean_output_points)
+
     return coastal_subsidence_raster
 
 
-def subsidence_point_to_geotiff(inputshp, output_raster, res=0.02):
+def subsidence_point_to_geotiff(inputshp, output_raster, res=0.02, reducer='mean'):
     """
-    Convert point shapefile (*) to geotiff.
+    Convert point shapefile (*) to geotiff. Points are binned onto a grid covering the point extent and all points in a
+    pixel are reduced to a single value. The input shapefile isn't modified.
     * point geometry must have subsidence (z) value. Typically such point shapefile is converted
     from kml file (using QGIS) processed from InSAR.
 
     Parameters :
     inputshp : Input point shapefile path.
-    res : Default set to 0.02 degree.
     output_raster : Output raster filepath.
+    res : Default set to 0.02 degree.
+    reducer : Reducer of the subsidence values of the points in a pixel. Can be 'mean', 'sum', 'max', 'min' or 'count'
+              (see points_to_grid_arr()). Defaults to 'mean'.
 
     Returns : Raster in Geotiff format.
     """
     point_shp = gpd.read_file(inputshp)
-
-    def getXYZ(pt):
-        return pt.x, pt.y, pt.z
-
-    lon, lat, z = [list(t) for t in zip(*map(getXYZ, point_shp['geometry']))]
-
-    minx, maxx = min(lon), max(lon)
-    miny, maxy = min(lat), max(lat)
-    point_shp['value'] = z
-    bounds = [minx, miny, maxx, maxy]
-
-    point_shp.to_file(inputshp)
-
-    cont_raster = gdal.Rasterize(output_raster, inputshp, format='GTiff', outputBounds=bounds,outputSRS='EPSG:4326',
-                                 outputType=gdal.GDT_Float32, xRes=res, yRes=res, noData=-9999, attribute='value',
-                                 allTouched=True)
-    del cont_raster
-
+    lon, lat, z = point_shp.geometry.x.values, point_shp.geometry.y.values, point_shp.geometry.z.values
+
+    # grid origin at the top left point, extended to include points on the right and bottom edges
+    minx, maxy = lon.min(), lat.max()
+    shape = (int(np.floor((maxy - lat.min()) / res)) + 1, int(np.floor((lon.max() - minx) / res)) + 1)
+    transform = from_origin(minx, maxy, res, res)
+    point_arr = points_to_grid_arr(lon, lat, z, transform, shape, reducer=reducer)
+
+    if os.path.dirname(output_raster):
+        makedirs([os.path.dirname(output_raster)])
+    profile = dict(driver='GTiff', height=shape[0], width=shape[1], count=1, dtype='float32', crs='EPSG:4326',
+                   transform=transform, nodata=No_Data_Value)
+    with rio.open(output_raster, 'w', **profile) as dst:
+        dst.write(point_arr, 1)
+
+    return output_raster
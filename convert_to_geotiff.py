@@ -4,8 +4,11 @@
 import os
 import numpy as np
 import rasterio
+from rasterio.windows import Window
 from glob import glob
 import pandas as pd
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 from System_operations import makedirs
 
 NO_DATA_VALUE = -9999
@@ -13,7 +16,8 @@ NO_DATA_VALUE = -9999
 
 def Alexi_dat_to_tif_avg(input_dir, output_fname, searchby="*.dat", row=3000, column=7200, data_type="Float32",
                          separator="",
-                         cellsize=0.05, first_x=-180, first_y=90):
+                         cellsize=0.05, first_x=-180, first_y=90, use_memmap=True, valid_range=(0, 100),
+                         block_rows=250, max_workers=4):
     """
     convert .dat (binary file) to geotiff.
 
@@ -29,19 +33,57 @@ def Alexi_dat_to_tif_avg(input_dir, output_fname, searchby="*.dat", row=3000, co
     cellsize : Pixel size. Default is 0.05 degree for GCS WGS 1984.
     first_x : X coordinate of first cell at top left corner.
     first_y : Y coordinate of first cell at top left corner.
+    use_memmap : Set True to memory-map the daily (binary) files and average them in row blocks with a thread pool.
+                 Each pixel gets the mean of its valid days and nan if it has none. Set False to sum all days (invalid
+                 values as 0) and divide by 365. Defaults to True.
+    valid_range : (min, max) of valid daily values. Values outside the range are invalid. Adjust according to the
+                  raster values. Defaults to (0, 100).
+    block_rows : Number of rows averaged in each block when use_memmap is True. Defaults to 250.
+    max_workers : Number of threads reading the row blocks when use_memmap is True. Defaults to 4.
     """
-    arr_year = np.zeros((row, column), dtype=data_type)
-
+    data_type = np.dtype(data_type.lower())
     days_dat = glob(os.path.join(input_dir, searchby))
 
-    for each in days_dat:
-        arr = np.fromfile(each, dtype=data_type, count=-1, sep=separator, offset=0)
-        arr_day = np.flipud(arr.reshape((row, column)))  # check this for other dataset. flipud may/may not be needed
-        arr_day[(arr_day < 0) | (arr_day > 100)] = 0  # adjust the filter values according to the raster values
-        arr_year = arr_year + arr_day
+    if use_memmap:
+        if separator != "":
+            raise ValueError('use_memmap needs binary .dat files (separator="")')
+
+        day_arrs = [np.memmap(each, dtype=data_type, mode='r', shape=(row, column)) for each in days_dat]
+        arr_year = np.full((row, column), np.nan, dtype=data_type)
+
+        def average_block(row_start):
+            row_end = min(row_start + block_rows, row)
+            # output rows are flipped (flipud) data rows. check this for other dataset, flip may/may not be needed
+            data_rows = slice(row - row_end, row - row_start)
+            block_sum = np.zeros((row_end - row_start, column), dtype=np.float64)
+            valid_days = np.zeros((row_end - row_start, column), dtype=np.uint16)
+
+            for day_arr in day_arrs:
+                block = day_arr[data_rows]
+                valid = (block >= valid_range[0]) & (block <= valid_range[1])
+                block_sum += np.where(valid, block, 0)
+                valid_days += valid
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                arr_year[row_start:row_end] = np.flipud(np.where(valid_days > 0, block_sum / valid_days, np.nan))
+
+        # reading the daily files is I/O bound, so threads overlap the reads of different row blocks
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(average_block, range(0, row, block_rows)))
+
+        del day_arrs
+    else:
+        arr_year = np.zeros((row, column), dtype=data_type)
+
+        for each in days_dat:
+            arr = np.fromfile(each, dtype=data_type, count=-1, sep=separator, offset=0)
+            # check this for other dataset. flipud may/may not be needed
+            arr_day = np.flipud(arr.reshape((row, column)))
+            arr_day[(arr_day < valid_range[0]) | (arr_day > valid_range[1])] = 0
+            arr_year = arr_year + arr_day
 
-    arr_year = arr_year / 365
-    arr_year[arr_year == 0] = np.nan
+        arr_year = arr_year / 365
+        arr_year[arr_year == 0] = np.nan
 
     with rasterio.open(output_fname, 'w',
                        driver='GTiff',
@@ -58,17 +100,43 @@ def Alexi_dat_to_tif_avg(input_dir, output_fname, searchby="*.dat", row=3000, co
 # Alexi_dat_to_tif_avg(input_dir="E:\\Alexi\\2013",output_fname="E:\\NGA_Project_Data\\ET_products\\Alexi_ET\\year_wise\\Alexi_ET_2013.tif")
 
 
+def read_esri_ascii_header(input_file):
+    """
+    Read the header (ncols, nrows, xllcorner/xllcenter, yllcorner/yllcenter, cellsize, NODATA_value) of an ESRI ASCII
+    grid file.
+
+    Parameters:
+    input_file : Input ascii filepath.
+
+    Returns: A dictionary of header values with lower case keys. Empty if the file doesn't have an ESRI ASCII header.
+    """
+    header_keys = ('ncols', 'nrows', 'xllcorner', 'yllcorner', 'xllcenter', 'yllcenter', 'cellsize', 'nodata_value')
+    header = {}
+    with open(input_file) as ascii_file:
+        for line in ascii_file:
+            parts = line.split()
+            if len(parts) != 2 or parts[0].lower() not in header_keys:
+                break
+            header[parts[0].lower()] = float(parts[1])
+
+    return header
+
+
 def txt_to_tif(input_file, outdir=None, raster_name=None, skiprows=0, separator=None, nrows=360, ncols=720,
-               datatype="Float32", cellsize=0.5, first_x=-180, first_y=90, nodata=NO_DATA_VALUE):
+               datatype="Float32", cellsize=0.5, first_x=-180, first_y=90, nodata=NO_DATA_VALUE, block_rows=1024):
     """
-    Converts an ascii file (with initial rows as text as to GeoTIFF).
+    Converts an ascii file (with initial rows as text as to GeoTIFF). If the file has an ESRI ASCII grid header, grid
+    size, extent, cellsize and nodata value are read from the header and skiprows, nrows, ncols, cellsize, first_x,
+    first_y are ignored. The values are parsed in blocks of text lines with numpy's C parser (np.fromstring) and
+    written block by block to a tiled, compressed GeoTIFF, so the whole grid is never in memory. Text lines don't have
+    to match raster rows.
 
     Params:
     input_file : Input .ascii/.dat file.
     output_dir : Output raster directory.
     output_raster_name : Output raster name.
     skiprows : Number of starting rows to Skip. Defaults to 0.
-    separator : Separator. Defaults to None.
+    separator : Separator (in addition to whitespace). Defaults to None for whitespace only.
     nrows : Number of rows to read. Defaults to 360.
     ncols : Number of rows to read. Defaults to 720.
     datatype : Datatype. Defaults to "Float32".
@@ -76,12 +144,21 @@ def txt_to_tif(input_file, outdir=None, raster_name=None, skiprows=0, separator=
     first_x : X coordinate of first cell at top left corner.
     first_y : Y coordinate of first cell at top left corner.
     nodata: No data value in the final raster. Defaults to No_Data_Value of -9999.
+    block_rows : Number of text lines parsed (and raster rows written) in each block. Defaults to 1024.
 
     Returns:None.
     """
+    datatype = np.dtype(datatype.lower())
+    source_nodata = None
 
-    data = np.loadtxt(fname=input_file, skiprows=skiprows, dtype=datatype, delimiter=separator)
-    arr = data.reshape((nrows, ncols))
+    header = read_esri_ascii_header(input_file)
+    if header:
+        nrows, ncols, cellsize = int(header['nrows']), int(header['ncols']), header['cellsize']
+        first_x = header['xllcorner'] if 'xllcorner' in header else header['xllcenter'] - cellsize / 2
+        last_y = header['yllcorner'] if 'yllcorner' in header else header['yllcenter'] - cellsize / 2
+        first_y = last_y + nrows * cellsize
+        source_nodata = header.get('nodata_value')
+        skiprows = len(header)
 
     if outdir == None:
         split = input_file.split(os.sep)
@@ -96,14 +173,48 @@ def txt_to_tif(input_file, outdir=None, raster_name=None, skiprows=0, separator=
 
     with rasterio.open(output_raster, 'w',
                        driver='GTiff',
-                       height=arr.shape[0],
-                       width=arr.shape[1],
-                       dtype=arr.dtype,
+                       height=nrows,
+                       width=ncols,
+                       dtype=datatype,
                        crs="EPSG:4326",
                        transform=(cellsize, 0.0, first_x, 0.0, -cellsize, first_y),
                        nodata=nodata,
-                       count=1) as dest:
-        dest.write(arr, 1)
+                       count=1,
+                       tiled=True,
+                       blockxsize=256,
+                       blockysize=256,
+                       compress='deflate') as dest:
+        row_start = 0
+        leftover = np.empty(0, dtype=datatype)
+        with open(input_file) as ascii_file:
+            for _ in range(skiprows):
+                next(ascii_file)
+
+            while True:
+                text = ''.join(islice(ascii_file, block_rows))
+                if not text:
+                    break
+                if separator:
+                    text = text.replace(separator, ' ')
+
+                # text lines don't have to match raster rows, values are carried over to the next block
+                block_values = np.fromstring(text, dtype=datatype, sep=' ')
+                if block_values.size != len(text.split()):
+                    raise ValueError('{} has values that can not be parsed as {}'.format(input_file, datatype))
+                values = np.concatenate([leftover, block_values])
+                num_rows = min(values.size // ncols, nrows - row_start)
+                arr = values[:num_rows * ncols].reshape((num_rows, ncols))
+                leftover = values[num_rows * ncols:]
+
+                if num_rows == 0:
+                    continue
+                if source_nodata is not None:
+                    arr[arr == source_nodata] = nodata
+                dest.write(arr, 1, window=Window(0, row_start, ncols, num_rows))
+                row_start += num_rows
+
+        if row_start != nrows:
+            raise ValueError('{} has {} rows of data, expected {}'.format(input_file, row_start, nrows))
 
 
 # # Converting Global Lithology Data
@@ -115,50 +226,97 @@ def txt_to_tif(input_file, outdir=None, raster_name=None, skiprows=0, separator=
 #                cellsize=0.5, first_x=-180, first_y=90, nodata=No_Data_Value)
 
 
-def sedthick_csv_to_tif(sed_thickness_csv='../Data/Raw_Data/Global_Sediment_Thickness/'
-                                           'EXXON_Sediment_Thickness/sedthk.csv',
-                        output_ras='../Data/Raw_Data/Global_Sediment_Thickness/'
-                                           'EXXON_Sediment_Thickness/Global_Sediment_thickness_EXX.tif'):
+def infer_grid_cellsize(coords):
     """
-    Convert Global EXXON Sediment thickness csv to tif.
+    Infer grid cell size along one axis from point (cell center) coordinates.
 
     Parameters:
-    sed_thickness_csv: Filepath of csv.
-    output_ras: Filepath of output raster.
+    coords : Array of x or y coordinates of the points.
 
-    Returns: A raster file of Global Sediment thickness in GeoTiff format.
+    Returns: Cell size (smallest spacing between distinct coordinates).
+    """
+    spacing = np.diff(np.unique(coords))
+    spacing = spacing[spacing > 1e-9]
+    if spacing.size == 0:
+        raise ValueError('Cell size can not be inferred from a single coordinate. Set cellsize.')
+    return spacing.min()
+
+
+def point_csv_to_tif(input_csv, output_raster, lon_col=0, lat_col=1, value_col=2, header=None, cellsize=None,
+                     chunksize=1000000, nodata=NO_DATA_VALUE):
+    """
+    Convert a point grid csv (one row per grid cell center with lon, lat and value) to GeoTIFF. Rows can be in any
+    order and missing cells are set to nodata. The csv is read in chunks in a single pass, then the cell size and
+    extent are inferred from the coordinates and the values are placed with a single scatter into the grid array.
+
+    Parameters:
+    input_csv : Input csv filepath.
+    output_raster : Output raster filepath.
+    lon_col : Column name (or position if header is None) of longitude. Defaults to 0.
+    lat_col : Column name (or position if header is None) of latitude. Defaults to 1.
+    value_col : Column name (or position if header is None) of value. Defaults to 2.
+    header : Header row number passed to pd.read_csv(). Defaults to None for csv without header.
+    cellsize : Pixel size in degree. Defaults to None to infer from the coordinates (separately for x and y).
+    chunksize : Number of csv rows read in each chunk. Defaults to 1000000.
+    nodata : No data value in the final raster. Defaults to -9999.
+
+    Returns: Output raster filepath.
     """
-    sed_df = pd.read_csv(sed_thickness_csv, header=None)
-    sed_df = sed_df.rename(columns={0: 'lon', 1: 'lat', 2: 'z'})
-    lon_list = list(sed_df['lon'])
-    lat_list = list(sed_df['lat'])
-    z_list = list(sed_df['z'])
+    lon_chunks, lat_chunks, value_chunks = [], [], []
+    for chunk in pd.read_csv(input_csv, header=header, usecols=[lon_col, lat_col, value_col], chunksize=chunksize):
+        lon_chunks.append(chunk[lon_col].to_numpy(dtype=np.float64))
+        lat_chunks.append(chunk[lat_col].to_numpy(dtype=np.float64))
+        value_chunks.append(chunk[value_col].to_numpy(dtype=np.float32))
+
+    lon, lat, values = np.concatenate(lon_chunks), np.concatenate(lat_chunks), np.concatenate(value_chunks)
+    del lon_chunks, lat_chunks, value_chunks
 
-    cell_size = lon_list[1] - lon_list[0]
-    num_cell_x_dir = ((max(lon_list) - min(lon_list)) / cell_size) + 1
-    num_cell_y_dir = ((max(lat_list) - min(lat_list)) / cell_size) + 1
+    cellsize_x = cellsize if cellsize else infer_grid_cellsize(lon)
+    cellsize_y = cellsize if cellsize else infer_grid_cellsize(lat)
+    min_lon, max_lat = lon.min(), lat.max()
 
-    modified_z_list = []
-    first_index = 0
-    last_index = int(num_cell_x_dir)
+    # points are cell centers, so rounding gives the (row, col) index
+    cols = np.rint((lon - min_lon) / cellsize_x).astype(np.int64)
+    rows = np.rint((max_lat - lat) / cellsize_y).astype(np.int64)
+    nrows, ncols = rows.max() + 1, cols.max() + 1
 
-    for i in range(1, int(num_cell_y_dir) + 1):
-        modified_z_list.append(list(z_list[first_index: last_index]))
-        first_index += 360
-        last_index += 360
+    arr = np.full(nrows * ncols, nodata, dtype=np.float32)
+    arr[rows * ncols + cols] = values
+    arr = arr.reshape((nrows, ncols))
+    arr[np.isnan(arr)] = nodata
 
-    z_array = np.array(modified_z_list)
+    if os.path.dirname(output_raster):
+        makedirs([os.path.dirname(output_raster)])
 
-    with rasterio.open(output_ras, 'w',
+    first_x, first_y = min_lon - cellsize_x / 2, max_lat + cellsize_y / 2
+    with rasterio.open(output_raster, 'w',
                        driver='GTiff',
-                       height=z_array.shape[0],
-                       width=z_array.shape[1],
-                       dtype=z_array.dtype,
+                       height=arr.shape[0],
+                       width=arr.shape[1],
+                       dtype=arr.dtype,
                        crs="EPSG:4326",
-                       transform=(cell_size, 0.0, -180, 0.0, -cell_size, 90),
-                       nodata=NO_DATA_VALUE,
+                       transform=(cellsize_x, 0.0, first_x, 0.0, -cellsize_y, first_y),
+                       nodata=nodata,
                        count=1) as dest:
-        dest.write(z_array, 1)
+        dest.write(arr, 1)
+
+    return output_raster
+
+
+def sedthick_csv_to_tif(sed_thickness_csv='../Data/Raw_Data/Global_Sediment_Thickness/'
+                                           'EXXON_Sediment_Thickness/sedthk.csv',
+                        output_ras='../Data/Raw_Data/Global_Sediment_Thickness/'
+                                           'EXXON_Sediment_Thickness/Global_Sediment_thickness_EXX.tif'):
+    """
+    Convert Global EXXON Sediment thickness csv (lon, lat, thickness without header) to tif.
+
+    Parameters:
+    sed_thickness_csv: Filepath of csv.
+    output_ras: Filepath of output raster.
+
+    Returns: A raster file of Global Sediment thickness in GeoTiff format.
+    """
+    return point_csv_to_tif(sed_thickness_csv, output_ras, lon_col=0, lat_col=1, value_col=2, header=None)
 
 
 # sedthick_csv_to_tif()
@@ -0,0 +1,8 @@
+# Author: Md Fahim Hasan
+# Email: Fahim.Hasan@colostate.edu
+
+import os
+import sys
+
+# modules are flat scripts in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,119 @@
+# Author: Md Fahim Hasan
+# Email: Fahim.Hasan@colostate.edu
+
+import os
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest.mock import patch
+import pytest
+
+pytest.importorskip('osgeo')
+pytest.importorskip('ee')
+requests = pytest.importorskip('requests')
+
+# Data_operations changes directory to ../Codes_Global_GW on import, which depends on the checkout directory name
+with patch('os.chdir'):
+    import Data_operations
+    from Data_operations import download_file, make_download_session
+
+payload = os.urandom(300000)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Serves payload, answering each request with the next scripted response ('429', '503', '404', 'truncated' or
+    'ok'). 'ok' is served once the script is used up.
+    """
+    script = []
+    num_requests = 0
+
+    def do_GET(self):
+        StandInHandler.num_requests += 1
+        response = StandInHandler.script.pop(0) if StandInHandler.script else 'ok'
+
+        if response in ('429', '503', '404'):
+            self.send_response(int(response))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            # a truncated response sends half of the promised bytes and closes the connection
+            self.wfile.write(payload if response == 'ok' else payload[:len(payload) // 2])
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stand_in_server():
+    StandInHandler.num_requests = 0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/tile.zip'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    waits = []
+    monkeypatch.setattr(Data_operations.time, 'sleep', waits.append)
+    return waits
+
+
+def test_download_file_retries_429_503_and_truncated_response(stand_in_server, sleeps, tmp_path):
+    StandInHandler.script = ['429', '503', 'truncated']
+    local_file = str(tmp_path / 'tile.zip')
+
+    size, checksum = download_file(stand_in_server, local_file, session=make_download_session(), max_retries=5,
+                                   backoff=2, chunk_size=65536)
+
+    assert StandInHandler.num_requests == 4
+    assert sleeps == [1, 2, 4]  # exponential backoff
+    assert size == len(payload) == os.path.getsize(local_file)
+    assert checksum == hashlib.sha256(payload).hexdigest()
+    with open(local_file, 'rb') as file:
+        assert file.read() == payload
+    assert not os.path.exists(local_file + '.part')
+
+
+def test_download_file_overwrites_stale_part_file(stand_in_server, sleeps, tmp_path):
+    StandInHandler.script = []
+    local_file = str(tmp_path / 'tile.zip')
+    with open(local_file + '.part', 'wb') as file:
+        file.write(b'left over from an interrupted run')
+
+    size, _ = download_file(stand_in_server, local_file)
+
+    assert size == len(payload) == os.path.getsize(local_file)
+    assert not os.path.exists(local_file + '.part')
+
+
+def test_download_file_gives_up_and_removes_part_file(stand_in_server, sleeps, tmp_path):
+    StandInHandler.script = ['truncated'] * 3
+    local_file = str(tmp_path / 'tile.zip')
+
+    with pytest.raises((requests.exceptions.ChunkedEncodingError, requests.ConnectionError)):
+        download_file(stand_in_server, local_file, max_retries=2, backoff=2)
+
+    assert StandInHandler.num_requests == 3
+    assert sleeps == [1, 2]
+    assert not os.path.exists(local_file + '.part')
+    assert not os.path.exists(local_file)
+
+
+def test_download_file_does_not_retry_client_error(stand_in_server, sleeps, tmp_path):
+    StandInHandler.script = ['404']
+    local_file = str(tmp_path / 'tile.zip')
+
+    with pytest.raises(requests.HTTPError):
+        download_file(stand_in_server, local_file)
+
+    assert StandInHandler.num_requests == 1
+    assert sleeps == []
+    assert not os.path.exists(local_file)
@@ -0,0 +1,55 @@
+# Author: Md Fahim Hasan
+# Email: Fahim.Hasan@colostate.edu
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+apc = pytest.importorskip('astropy.convolution')
+
+from Raster_operations import normalized_convolution, gaussian_kernel
+
+
+@pytest.fixture(scope='module')
+def nan_raster():
+    rng = np.random.default_rng(0)
+    raster_arr = rng.normal(10, 3, size=(61, 47))
+    raster_arr[rng.random(raster_arr.shape) < 0.15] = np.nan
+    raster_arr[20:26, :] = np.nan  # rows without any valid pixel
+    raster_arr[:, 40:] = np.nan  # nan block at the edge
+    return raster_arr
+
+
+@pytest.mark.parametrize('method', ['direct', 'fft'])
+@pytest.mark.parametrize('block_rows', [1, 5, 16, 60, 61, 256])
+def test_normalized_convolution_matches_astropy(nan_raster, block_rows, method):
+    kernel = apc.Gaussian2DKernel(x_stddev=1, x_size=5, y_size=5).array
+    expected = apc.convolve(nan_raster, kernel, preserve_nan=True)
+
+    convolved_arr = normalized_convolution(nan_raster, kernel, block_rows=block_rows, method=method)
+
+    np.testing.assert_allclose(convolved_arr, expected, rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize('sigma', [2, 3, 4])
+@pytest.mark.parametrize('block_rows', [7, 64])
+def test_fft_matches_direct_for_gaussian_kernels(nan_raster, sigma, block_rows):
+    kernel = gaussian_kernel(sigma)
+
+    direct_arr = normalized_convolution(nan_raster, kernel, block_rows=block_rows, method='direct')
+    fft_arr = normalized_convolution(nan_raster, kernel, block_rows=block_rows, method='fft')
+
+    np.testing.assert_allclose(fft_arr, direct_arr, rtol=1e-10, atol=1e-10)
+
+
+@pytest.mark.parametrize('sigma', range(1, 21))
+def test_gaussian_kernel_size_is_odd(sigma):
+    kernel = gaussian_kernel(sigma)
+
+    assert kernel.shape[0] % 2 == 1 and kernel.shape[1] % 2 == 1
+    assert kernel.shape[0] >= 3 * sigma
+
+
+def test_normalized_convolution_rejects_even_kernel(nan_raster):
+    with pytest.raises(ValueError):
+        normalized_convolution(nan_raster, np.ones((4, 4)))
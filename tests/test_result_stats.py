@@ -0,0 +1,78 @@
+# Author: Md Fahim Hasan
+# Email: Fahim.Hasan@colostate.edu
+
+import numpy as np
+import pytest
+
+pytest.importorskip('osgeo')
+pytest.importorskip('geopandas')
+
+from Raster_operations import crosstab_arrays
+from Result_Analysis import aridity_bins, aridity_classes
+
+
+@pytest.fixture(scope='module')
+def rng():
+    return np.random.default_rng(1)
+
+
+def test_aridity_table_matches_pixel_comparisons(rng):
+    aridity = rng.random((120, 150)).astype(np.float32)
+    aridity.flat[rng.choice(aridity.size, 800)] = rng.choice(np.float32([0.03, 0.2, 0.5, 0.65]), 800)  # bin edges
+    aridity.flat[rng.choice(aridity.size, 200)] = np.nan
+    prediction = rng.choice(np.float32([1, 5, 10, np.nan]), aridity.shape)
+
+    table = crosstab_arrays([prediction, aridity], [(5, 10), None], [None, aridity_bins])
+    subsidence_aridity = table[1:].sum(axis=0)
+
+    subsiding = prediction > 1
+    expected = [np.count_nonzero(subsiding & (aridity < 0.03)),
+                np.count_nonzero(subsiding & (0.03 <= aridity) & (aridity < 0.2)),
+                np.count_nonzero(subsiding & (0.2 <= aridity) & (aridity < 0.5)),
+                np.count_nonzero(subsiding & (0.5 <= aridity) & (aridity < 0.65)),
+                np.count_nonzero(subsiding & (aridity > 0.65))]
+    assert list(subsidence_aridity[list(aridity_classes)]) == expected
+    assert subsidence_aridity.sum() == np.count_nonzero(subsiding)
+
+
+def test_meier_table_counts_non_zero_cells(rng):
+    meier = rng.choice(np.float32([0, 1, 2, 3, 4, 7, np.nan]), (120, 150))
+    gfsad = rng.choice(np.float32([0, 1, 2, np.nan]), meier.shape)
+
+    table = crosstab_arrays([meier, gfsad], [(0, 1, 2, 3, 4), (1, 2)])
+    meier_irrigated = np.delete(table, 1, axis=0)
+
+    assert meier_irrigated.sum() == np.count_nonzero(meier)
+    assert meier_irrigated[:, 1].sum() == np.count_nonzero((meier != 0) & (gfsad == 1))
+    assert table[2].sum() + table[4].sum() == np.count_nonzero((meier == 1) | (meier == 3))
+
+
+def test_country_id_raster_matches_country_clips(tmp_path):
+    gpd = pytest.importorskip('geopandas')
+    rio = pytest.importorskip('rasterio')
+    from shapely.geometry import Point, Polygon
+    from Result_Analysis import rasterize_country_ids, country_id_raster_mismatch
+
+    transform = rio.transform.from_origin(-0.1, 1.1, 0.02, 0.02)
+    ref_raster = str(tmp_path / 'ref.tif')
+    with rio.open(ref_raster, 'w', driver='GTiff', height=60, width=60, count=1, dtype='float32', crs='EPSG:4326',
+                  transform=transform, nodata=-9999) as ref_file:
+        ref_file.write(np.ones((1, 60, 60), dtype=np.float32))
+
+    # A and B share a slanted border off the pixel grid, C overlaps both
+    polygons = [Polygon([(0, 0), (0.517, 0), (0.31, 0.6), (0, 0.6)]),
+                Polygon([(0.517, 0), (1, 0), (1, 0.6), (0.31, 0.6)]),
+                Polygon([(0.2, 0.545), (0.8, 0.545), (0.8, 1), (0.2, 1)])]
+    countries = str(tmp_path / 'countries.shp')
+    gpd.GeoDataFrame({'CNTRY_NAME': ['A', 'B', 'C']}, geometry=polygons, crs='EPSG:4326').to_file(countries)
+
+    country_raster, country_names = rasterize_country_ids(countries, str(tmp_path), ref_raster=ref_raster)
+    mismatch = country_id_raster_mismatch(country_raster, countries).set_index('country_name')
+
+    # pixels are only lost where polygons overlap, to the country rasterized last (C)
+    centers = [Point(transform * (col + 0.5, row + 0.5)) for row in range(60) for col in range(60)]
+    for name, polygon in zip(['A', 'B'], polygons[:2]):
+        num_overlap = sum(polygon.contains(center) and polygons[2].contains(center) for center in centers)
+        assert mismatch.loc[name, 'pixels with other id'] == num_overlap
+    assert country_names == ['A', 'B', 'C']
+    assert 'C' not in mismatch.index
@@ -0,0 +1,40 @@
+# Author: Md Fahim Hasan
+# Email: Fahim.Hasan@colostate.edu
+
+import os
+import sys
+import importlib
+import pytest
+
+from System_operations import task_key, task_source_files
+
+
+@pytest.fixture
+def task_modules(tmp_path, monkeypatch):
+    (tmp_path / 'stage_helpers.py').write_text('def scale(value):\n    return value * 2\n')
+    (tmp_path / 'stage_task.py').write_text('from stage_helpers import *\n\n\n'
+                                            'def run_stage(value):\n    return scale(value)\n')
+    monkeypatch.syspath_prepend(str(tmp_path))
+    yield tmp_path
+    for name in ('stage_task', 'stage_helpers'):
+        sys.modules.pop(name, None)
+
+
+def test_task_source_files_follows_from_imports(task_modules):
+    stage_task = importlib.import_module('stage_task')
+
+    source_files = task_source_files(stage_task.run_stage)
+
+    assert [os.path.basename(file) for file in source_files] == ['stage_helpers.py', 'stage_task.py']
+
+
+def test_task_key_changes_with_helper_source(task_modules):
+    stage_task = importlib.import_module('stage_task')
+    hash_memo = {}
+    key = task_key('stage', stage_task.run_stage, [], {'value': 1}, hash_memo)
+
+    assert task_key('stage', stage_task.run_stage, [], {'value': 1}, hash_memo) == key
+
+    (task_modules / 'stage_helpers.py').write_text('def scale(value):\n    return value * 3  # changed\n')
+
+    assert task_key('stage', stage_task.run_stage, [], {'value': 1}, hash_memo) != key